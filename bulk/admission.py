@@ -0,0 +1,168 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import time
+import logging
+
+# Bulk Imports
+from bulk import metrics
+
+
+DEFERRALS = metrics.registry.counter(
+    'bulk_deferrals_total',
+    'Connections and messages turned away with a temporary failure',
+    ['reason'])
+
+
+class AdmissionControl(object):
+    """
+    Limits how much work the proxy takes on at once.
+
+    Sessions ask before taking a connection, before starting a message
+    and before holding more message data in memory. Past a limit they
+    answer with a temporary failure, 421 or 451, so the sending MTA
+    backs off and retries later instead of the relay running out of
+    memory under a burst. Only used from the event loop.
+    """
+
+    def __init__(self, max_connections=0, max_pending_scans=0,
+                 max_buffered_bytes=0, pending_scans=None):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        max_connections -- most client connections open at once
+        max_pending_scans -- most scans waiting for a verdict before new
+        messages are turned away
+        max_buffered_bytes -- most bytes of message data held in memory,
+        by messages being received or waiting for a verdict
+        pending_scans -- callable returning the number of scans waiting
+        for a verdict, such as from a ScanEngine
+
+        A limit of 0 is no limit.
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._max_connections = max_connections
+        self._max_pending_scans = max_pending_scans
+        self._max_buffered_bytes = max_buffered_bytes
+        self._pending_scans = pending_scans or (lambda: 0)
+        self._last_warning = 0
+
+        self.connections = 0
+        self.buffered = 0
+
+        metrics.registry.callback('bulk_connections',
+                                  'Client connections open',
+                                  lambda: self.connections)
+        metrics.registry.callback('bulk_buffered_bytes',
+                                  'Bytes of message data held in memory',
+                                  lambda: self.buffered)
+
+    def __str__(self):
+        """
+        Pretty way to print the limits.
+        """
+        return ('AdmissionControl; Connections: %s; Pending scans: %s; '
+                'Buffered bytes: %s' % (self._max_connections,
+                                        self._max_pending_scans,
+                                        self._max_buffered_bytes))
+
+    def connect(self):
+        """
+        Take a connection.
+
+        Returns False, without taking it, when there are too many.
+
+        """
+        if self._max_connections and \
+                self.connections >= self._max_connections:
+            self._defer('connections')
+            return False
+
+        self.connections += 1
+        return True
+
+    def disconnect(self):
+        """
+        Give back a connection.
+        """
+        self.connections -= 1
+
+    def busy(self):
+        """
+        Check whether new messages should be turned away.
+
+        Returns the reason they should be, or None.
+
+        """
+        if self._max_pending_scans and \
+                self._pending_scans() >= self._max_pending_scans:
+            return self._defer('pending_scans')
+
+        if self._max_buffered_bytes and \
+                self.buffered >= self._max_buffered_bytes:
+            return self._defer('buffered_bytes')
+
+        return None
+
+    def buffer(self, size):
+        """
+        Take room for more message data held in memory.
+
+        Keyword arguments:
+        size -- bytes about to be held
+
+        Returns False, without taking the room, when there is too little.
+
+        """
+        if self._max_buffered_bytes and \
+                self.buffered + size > self._max_buffered_bytes:
+            self._defer('buffered_bytes')
+            return False
+
+        self.buffered += size
+        return True
+
+    def release(self, size):
+        """
+        Give back room taken for message data.
+        """
+        self.buffered -= size
+
+    def _defer(self, reason):
+        """
+        Count a deferral, and log now and then that they are happening.
+        """
+        DEFERRALS.labels(reason).inc()
+
+        now = time.time()
+        if now - self._last_warning >= 10:
+            self._last_warning = now
+            self.logger.warning('Deferring mail, limit reached: %s; '
+                                'Connections: %s; Buffered bytes: %s'
+                                % (reason, self.connections, self.buffered))
+
+        return reason
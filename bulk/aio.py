@@ -0,0 +1,423 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import logging
+
+# Optional Imports, asyncio where the standard library has it, or else
+# trollius, its backport to Python 2
+try:
+    import asyncio
+
+except ImportError:
+    try:
+        import trollius as asyncio
+
+    except ImportError:
+        asyncio = None
+
+# Bulk Imports
+from bulk.scanner import Pending
+from bulk.session import SMTPSession
+from bulk.pipeline import Pipeline
+from bulk.processors import Result
+
+
+_Protocol = asyncio.Protocol if asyncio is not None else object
+
+
+class Executor(object):
+    """
+    Makes blocking calls on the executor threads of an asyncio loop.
+
+    Hands BulkProxy a way to deliver and store messages without
+    blocking the event loop, through its defer option.
+    """
+
+    def __init__(self, loop, executor=None):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        loop -- the asyncio event loop
+        executor -- concurrent.futures executor to run calls on,
+        defaults to the loop's own
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._loop = loop
+        self._executor = executor
+
+    def call(self, func, *args):
+        """
+        Run func(*args) on an executor thread. Call it on the loop.
+
+        Returns a scanner.Pending result that fires, on the loop, with
+        what func returned. Should func raise, the error is logged and
+        the result is an SMTP error reply instead.
+
+        """
+        pending = Pending()
+
+        def done(future):
+            if future.cancelled() or future.exception() is not None:
+                self.logger.error('Processing failed: %s'
+                                  % (future.exception()
+                                     if not future.cancelled()
+                                     else 'cancelled'))
+                pending.fire('451 4.3.0 Error: processing failed')
+
+            else:
+                pending.fire(future.result())
+
+        future = self._loop.run_in_executor(self._executor, func, *args)
+        future.add_done_callback(done)
+        return pending
+
+
+class ExecutorEngine(object):
+    """
+    Scans attachments on the executor threads of an asyncio loop.
+
+    Stands in for a scanner.ScanEngine when there are no scanning
+    worker processes, so the processors run beside the event loop
+    rather than on it. The processors are shared by the threads, and
+    rule reloads change them in place.
+    """
+
+    def __init__(self, processors, executor, short_circuit=False):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        processors -- list of processors
+        executor -- the Executor to scan on
+        short_circuit -- whether to stop scanning a batch of
+        attachments at its first match
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._pipeline = Pipeline(processors, short_circuit)
+        self._executor = executor
+        self._pending = 0
+
+    def __str__(self):
+        """
+        Pretty way to print the engine.
+        """
+        return 'ExecutorEngine scanning with %s' % self._pipeline
+
+    @property
+    def pending(self):
+        """
+        Number of submitted scans without a verdict yet.
+        """
+        return self._pending
+
+    def submit(self, attachments):
+        """
+        Queue attachments for scanning. Call it on the loop.
+
+        Keyword arguments:
+        attachments -- list of message.Attachments
+
+        Returns a pending result that fires, on the loop, with the
+        list of processor Results for each attachment.
+
+        """
+        self._pending += 1
+
+        def done(verdicts):
+            self._pending -= 1
+            return verdicts
+
+        return self._executor.call(self._scan, attachments).then(done)
+
+    def reload(self, swap=None):
+        """
+        Start scanning with new rules, which swap hands the processors.
+        """
+        if swap is not None:
+            swap()
+
+    def close(self):
+        """
+        Nothing to do, the loop owns the threads.
+        """
+        pass
+
+    def _scan(self, attachments):
+        """
+        Run the processors against a list of attachments, on an
+        executor thread.
+
+        Returns a list holding the list of processor Results for each
+        attachment, failed ones if scanning failed.
+
+        """
+        try:
+            return self._pipeline.match_batch(attachments)
+
+        except Exception as e:
+            self.logger.exception('Scanning failed')
+            return [[Result(__name__, False, error=str(e), failed=True)]
+                    for attachment in attachments]
+
+
+class SMTPProtocol(_Protocol):
+    """
+    Speaks SMTP with one client on an asyncio event loop.
+
+    The conversation itself is a session.SMTPSession, the protocol only
+    moves data between it and the transport. Reading stops while the
+    session waits on a verdict, and a client that sends nothing for
+    the front end's timeout is told so and disconnected.
+    """
+
+    def __init__(self, frontend):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        frontend -- the SMTPServer that accepted the connection
+
+        """
+        self._frontend = frontend
+        self._loop = frontend.loop
+        self._timeout = frontend.timeout
+        self._transport = None
+        self._session = None
+        self._timer = None
+        self._last = 0
+        self._closing = False
+
+    def connection_made(self, transport):
+        self._transport = transport
+        self._session = SMTPSession(self._frontend,
+                                    transport.get_extra_info('peername'),
+                                    self._write, self._close,
+                                    self._pause_reading,
+                                    self._resume_reading,
+                                    self._frontend.max_message_size,
+                                    self._frontend.admission)
+        self._frontend.sessions.add(self)
+
+        if self._timeout:
+            self._last = self._loop.time()
+            self._timer = self._loop.call_later(self._timeout, self._check)
+
+        self._session.start()
+
+    def data_received(self, data):
+        self._last = self._loop.time()
+        self._session.feed(data)
+
+    def eof_received(self):
+        # Let the transport close itself
+        return False
+
+    def connection_lost(self, exc):
+        self._closing = True
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        self._session.close()
+        self._frontend.sessions.discard(self)
+
+    def close(self):
+        """
+        Tell the client we are going away and disconnect.
+        """
+        self._session.push('421 4.3.2 Service shutting down')
+        self._session.quit()
+
+    def _write(self, data):
+        if not self._closing:
+            self._transport.write(data)
+
+    def _close(self):
+        # The transport sends what is buffered before closing
+        if not self._closing:
+            self._closing = True
+            self._transport.close()
+
+    def _pause_reading(self):
+        if not self._closing:
+            self._transport.pause_reading()
+
+    def _resume_reading(self):
+        if not self._closing:
+            self._transport.resume_reading()
+
+    def _check(self):
+        """
+        Disconnect the client if it has been idle too long.
+        """
+        now = self._loop.time()
+        if self._session.waiting:
+            # The client is waiting on us, not the other way round
+            self._last = now
+
+        idle = now - self._last
+        if idle < self._timeout:
+            self._timer = self._loop.call_later(self._timeout - idle,
+                                                self._check)
+            return
+
+        self._timer = None
+        self._session.push('421 4.4.2 Error: timeout exceeded')
+        self._session.quit()
+
+
+class SMTPServer(object):
+    """
+    Accepts SMTP connections on an asyncio event loop.
+
+    Stands in front of a BulkProxy made with listen=False, in place of
+    the asyncore loop, so thousands of mostly idle connections cost
+    little more than their sockets. The proxy's process_message may
+    return a scanner.Pending result, as it does when scanning on a
+    ScanEngine or ExecutorEngine or delivering through an Executor, or
+    an asyncio future or coroutine, which lets subclasses wait on the
+    loop instead of blocking it.
+    """
+
+    def __init__(self, server, sock, loop=None, timeout=300):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        server -- the BulkProxy to hand messages to
+        sock -- listening socket, such as one from prefork.listen
+        loop -- the asyncio event loop, defaults to the current one
+        timeout -- seconds a client may sit idle before it is
+        disconnected, 0 for no limit
+
+        """
+        if asyncio is None:
+            raise ImportError('asyncio, or trollius on Python 2, is '
+                              'needed for the asyncio front end')
+
+        self.logger = logging.getLogger('bulk')
+
+        self.loop = loop or asyncio.get_event_loop()
+        self.timeout = timeout
+        self.sessions = set()
+
+        self._server = server
+        self._sock = sock
+        self._listener = None
+
+    @property
+    def max_message_size(self):
+        return self._server.max_message_size
+
+    @property
+    def admission(self):
+        return self._server.admission
+
+    def __str__(self):
+        """
+        Pretty way to print the front end.
+        """
+        return 'SMTPServer with %s sessions' % len(self.sessions)
+
+    def begin_message(self, peer, mailfrom, rcpttos):
+        return self._server.begin_message(peer, mailfrom, rcpttos)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, stream=None):
+        """
+        Hand a message to the proxy, turning an asyncio result into a
+        pending one the session can wait on.
+        """
+        status = self._server.process_message(peer, mailfrom, rcpttos,
+                                              data, stream=stream)
+        if isinstance(status, Pending):
+            return status
+
+        if not (asyncio.iscoroutine(status) or
+                isinstance(status, asyncio.Future)):
+            return status
+
+        # ensure_future was called async before Python 3.4.4 and
+        # trollius 2.0
+        ensure_future = (getattr(asyncio, 'ensure_future', None) or
+                         getattr(asyncio, 'async'))
+        future = ensure_future(status, loop=self.loop)
+        pending = Pending()
+
+        def done(future):
+            if future.cancelled() or future.exception() is not None:
+                self.logger.error('Processing failed: %s'
+                                  % (future.exception()
+                                     if not future.cancelled()
+                                     else 'cancelled'))
+                pending.fire('451 4.3.0 Error: processing failed')
+
+            else:
+                pending.fire(future.result())
+
+        future.add_done_callback(done)
+        return pending
+
+    def start(self):
+        """
+        Start accepting connections.
+        """
+        self._listener = self.loop.run_until_complete(
+            self.loop.create_server(lambda: SMTPProtocol(self),
+                                    sock=self._sock))
+
+    def run(self):
+        """
+        Accept connections until the loop is stopped.
+        """
+        if self._listener is None:
+            self.start()
+
+        self.loop.run_forever()
+
+    def stop(self):
+        """
+        Stop the loop. Thread safe.
+        """
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def close(self):
+        """
+        Stop accepting connections and disconnect every client.
+        """
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+        for protocol in list(self.sessions):
+            protocol.close()
+
+        # Let the goodbyes go out, on this loop whichever is current
+        done = asyncio.Future(loop=self.loop)
+        self.loop.call_soon(done.set_result, None)
+        self.loop.run_until_complete(done)
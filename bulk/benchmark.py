@@ -0,0 +1,369 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import gzip
+import email
+import random
+import shutil
+import tarfile
+import zipfile
+import logging
+import platform
+import tempfile
+import multiprocessing
+import StringIO
+import timeit
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+
+# Bulk Imports
+from bulk import message
+from bulk.stream import MessageStream
+from bulk.store import AttachmentStore
+from bulk.unpack import Unpacker, archive_type
+from bulk.writer import SyncWriter
+from bulk.processors import match
+
+
+# Words text attachments and message bodies are made of
+WORDS = ('invoice', 'payment', 'account', 'report', 'meeting', 'please',
+         'attached', 'review', 'quarterly', 'update', 'the', 'and', 'for',
+         'your', 'with', 'from', 'this', 'that', 'will', 'have', 'macro',
+         'document', 'enable', 'content', 'regards', 'thanks', 'urgent')
+
+# Kinds of attachment in the corpus, and how they are transfer encoded
+KINDS = ('text', 'binary', 'zip', 'tgz')
+ENCODINGS = {'text': (encoders.encode_base64, encoders.encode_quopri,
+                      encoders.encode_7or8bit),
+             'binary': (encoders.encode_base64,),
+             'zip': (encoders.encode_base64,),
+             'tgz': (encoders.encode_base64,)}
+
+# Everything the benchmarks measure, in the order they run
+BENCHMARKS = ('parse', 'stream', 'extract', 'hash', 'unpack', 'match',
+              'store', 'save')
+
+
+def _text(rng, size):
+    """
+    Returns size bytes of text, in lines of words.
+    """
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word + ('\n' if rng.random() < 0.1 else ' '))
+        length += len(word) + 1
+
+    return ''.join(words)[:size]
+
+
+def _binary(rng, size):
+    """
+    Returns size random bytes.
+    """
+    if not size:
+        return ''
+
+    return ('%x' % rng.getrandbits(size * 8)).zfill(size * 2).decode('hex')
+
+
+def _content(rng, kind, size):
+    """
+    Returns attachment contents of a kind, about size bytes long.
+    """
+    if kind == 'text':
+        return _text(rng, size)
+
+    if kind == 'binary':
+        return _binary(rng, size)
+
+    # Archives of a few members, with fixed dates so they
+    # come out the same every time
+    members = []
+    for i in xrange(rng.randint(1, 3)):
+        member_kind = rng.choice(('text', 'binary'))
+        members.append(('member%s.%s' % (i, 'txt' if member_kind == 'text'
+                                         else 'bin'),
+                        _content(rng, member_kind, size // 2 or 1)))
+
+    buf = StringIO.StringIO()
+    if kind == 'zip':
+        archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+        for name, data in members:
+            archive.writestr(zipfile.ZipInfo(name, (2014, 1, 1, 0, 0, 0)),
+                             data)
+
+        archive.close()
+
+    else:
+        gz = gzip.GzipFile('corpus.tar', 'wb', fileobj=buf, mtime=0)
+        archive = tarfile.open(fileobj=gz, mode='w')
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, StringIO.StringIO(data))
+
+        archive.close()
+        gz.close()
+
+    return buf.getvalue()
+
+
+def _message(rng, i, max_size):
+    """
+    Returns the text of one corpus message.
+    """
+    body = MIMEText(_text(rng, rng.randint(100, 4000)))
+    parts = rng.randint(0, 4)
+    if parts:
+        msg = MIMEMultipart()
+        # Generated boundaries are random, fixed ones keep the corpus
+        # the same from run to run
+        msg.set_boundary('bulk-benchmark-%s' % i)
+        msg.attach(body)
+
+    else:
+        msg = body
+
+    for j in xrange(parts):
+        kind = rng.choice(KINDS)
+        # Sizes are spread evenly on a log scale, from 256 bytes up
+        size = int(256 * (max_size / 256.0) ** rng.random())
+        part = MIMEBase('application', 'octet-stream')
+        part.set_payload(_content(rng, kind, size))
+        rng.choice(ENCODINGS[kind])(part)
+        part.add_header('Content-Disposition', 'attachment',
+                        filename='attachment%s.%s' % (j, kind))
+        msg.attach(part)
+
+    msg['From'] = 'sender%s@example.com' % rng.randint(0, 50)
+    msg['To'] = 'recipient%s@example.com' % rng.randint(0, 50)
+    msg['Subject'] = 'Benchmark message %s' % i
+    msg['Message-ID'] = '<%s@bulk-benchmark>' % i
+
+    return msg.as_string()
+
+
+def generate_corpus(count=200, seed=0, max_size=1024 * 1024):
+    """
+    Generate a synthetic mail corpus.
+
+    Keyword arguments:
+    count -- number of messages
+    seed -- random seed; the same seed always gives the same corpus
+    max_size -- largest attachment, before archiving and encoding
+
+    Messages have zero to four attachments of text, random bytes, zip or
+    gzipped tar archives, transfer encoded as base64, quoted-printable or
+    plain 7bit text, with sizes spread evenly on a log scale.
+
+    Returns a list of message texts, as smtpd hands them over.
+
+    """
+    rng = random.Random(seed)
+    return [_message(rng, i, max_size) for i in xrange(count)]
+
+
+def _percentile(latencies, percent):
+    """
+    Returns the latency percent of the sorted latencies are within.
+    """
+    index = int(round(percent / 100.0 * len(latencies) + 0.5)) - 1
+    return latencies[max(0, min(index, len(latencies) - 1))]
+
+
+def measure(name, func, items, sizes):
+    """
+    Time a function over each of a list of items.
+
+    Keyword arguments:
+    name -- name to report the benchmark under
+    func -- callable taking an item
+    items -- list of items
+    sizes -- list of the size in bytes of each item
+
+    Returns a dictionary with the count, bytes and seconds, throughput
+    in items and megabytes per second, and latency percentiles in
+    milliseconds.
+
+    """
+    latencies = []
+    for item in items:
+        start = timeit.default_timer()
+        func(item)
+        latencies.append(timeit.default_timer() - start)
+
+    seconds = sum(latencies)
+    latencies.sort()
+
+    result = {'name': name,
+              'count': len(items),
+              'bytes': sum(sizes),
+              'seconds': seconds,
+              'per_second': len(items) / seconds if seconds else 0.0,
+              'mb_per_second': (sum(sizes) / 1048576.0 / seconds
+                                if seconds else 0.0)}
+
+    if latencies:
+        result['latency_ms'] = dict(
+            [('mean', seconds / len(latencies) * 1000),
+             ('max', latencies[-1] * 1000)] +
+            [('p%s' % percent, _percentile(latencies, percent) * 1000)
+             for percent in (50, 90, 99)])
+
+    return result
+
+
+def _smtp_data(data):
+    """
+    Returns message text the way a client sends it during DATA.
+    """
+    return '\r\n'.join('.' + line if line.startswith('.') else line
+                       for line in data.split('\n'))
+
+
+def _stream(data, chunk_size=64 * 1024):
+    """
+    Parse message text through a MessageStream, a chunk at a time.
+    """
+    s = MessageStream()
+    for offset in xrange(0, len(data), chunk_size):
+        s.feed(data[offset:offset + chunk_size])
+
+    s.close()
+
+
+def run_benchmarks(corpus, processors=(), benchmarks=BENCHMARKS,
+                   repeat=1, fsync=False):
+    """
+    Measure each part of handling mail over a corpus, in isolation.
+
+    Keyword arguments:
+    corpus -- list of message texts
+    processors -- processors to time match for, one benchmark each
+    benchmarks -- names of the benchmarks to run
+    repeat -- times to go over the corpus in each benchmark
+    fsync -- whether the storage benchmarks sync what they write
+
+    The benchmarks are:
+    parse -- parsing a message with message.Message
+    stream -- parsing a message as it arrives with stream.MessageStream
+    extract -- pulling the attachments out of a parsed message, which
+    decodes and hashes them
+    hash -- hashing an attachment's decoded contents
+    unpack -- unpacking an archive attachment
+    match -- scanning an attachment, for each processor
+    store -- adding an attachment to a store.AttachmentStore
+    save -- saving a message to disk
+
+    Returns a list of results, as returned by measure.
+
+    """
+    def sized(items, size):
+        return items * repeat, [size(item) for item in items] * repeat
+
+    results = []
+    messages, message_sizes = sized(corpus, len)
+
+    parsed = [(data, email.message_from_string(data)) for data in corpus]
+    saved = [message.Message(None, None, None, data, parsed_message)
+             for data, parsed_message in parsed]
+    attachments = sum([m.get_attachments() for m in saved], [])
+    contents, content_sizes = sized([a.content for a in attachments], len)
+    parts, part_sizes = sized(attachments, lambda a: a.size)
+
+    if 'parse' in benchmarks:
+        results.append(measure(
+            'parse', lambda data: message.Message(None, None, None, data),
+            messages, message_sizes))
+
+    if 'stream' in benchmarks:
+        smtp, smtp_sizes = sized([_smtp_data(data) for data in corpus], len)
+        results.append(measure('stream', _stream, smtp, smtp_sizes))
+
+    if 'extract' in benchmarks:
+        # Fresh messages each time, as attachments are only pulled once
+        results.append(measure(
+            'extract',
+            lambda item: message.Message(None, None, None,
+                                         *item).get_attachments(),
+            parsed * repeat, message_sizes))
+
+    if 'hash' in benchmarks:
+        results.append(measure(
+            'hash', lambda content: message.Attachment('hash', content),
+            contents, content_sizes))
+
+    if 'unpack' in benchmarks:
+        unpacker = Unpacker()
+        archives, archive_sizes = sized(
+            [a for a in attachments if archive_type(a.content[:512])],
+            lambda a: a.size)
+        results.append(measure('unpack', unpacker.expand,
+                               archives, archive_sizes))
+
+    if 'match' in benchmarks:
+        for p in processors:
+            results.append(measure('match:%s' % p.__module__,
+                                   lambda part, p=p: match(p, part),
+                                   parts, part_sizes))
+
+    if 'store' in benchmarks or 'save' in benchmarks:
+        directory = tempfile.mkdtemp(prefix='bulk-benchmark-')
+        try:
+            writer = SyncWriter(fsync)
+            if 'store' in benchmarks:
+                store = AttachmentStore(os.path.join(directory, 'attachments'),
+                                        writer)
+                results.append(measure(
+                    'store', lambda a: store.add(a, {'email': None}),
+                    parts, part_sizes))
+
+            if 'save' in benchmarks:
+                location = os.path.join(directory, 'messages') + os.sep
+                os.mkdir(location)
+                results.append(measure(
+                    'save', lambda m: m.save(location, writer),
+                    saved * repeat, message_sizes))
+
+        finally:
+            shutil.rmtree(directory)
+
+    return results
+
+
+def environment():
+    """
+    Describe where the benchmarks ran, to tell runs apart.
+    """
+    return {'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpus': multiprocessing.cpu_count()}
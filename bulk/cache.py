@@ -0,0 +1,170 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import time
+import logging
+import threading
+import collections
+
+
+class VerdictCache(object):
+    """
+    A bounded LRU cache of attachment verdicts.
+
+    Entries are keyed by attachment digest and the fingerprint
+    of the rule set that produced the verdict, and expire after
+    a time to live. Changing the fingerprint drops every entry.
+    The fingerprint can be changed from another thread, such as
+    when rules are reloaded.
+    """
+
+    def __init__(self, max_entries=10000, ttl=3600, fingerprint=None):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        max_entries -- most verdicts to hold before evicting the oldest
+        ttl -- seconds a verdict stays valid, 0 to never expire
+        fingerprint -- fingerprint of the active rule set
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._fingerprint = fingerprint
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __str__(self):
+        """
+        Pretty way to print the cache.
+        """
+        return 'VerdictCache holding %s of %s entries; Hits: %s; ' \
+               'Misses: %s; Evictions: %s; Expirations: %s' % (
+                   len(self._entries), self._max_entries, self.hits,
+                   self.misses, self.evictions, self.expirations)
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    def set_fingerprint(self, fingerprint, swap=None):
+        """
+        Switch to a new rule set fingerprint.
+
+        Keyword arguments:
+        fingerprint -- fingerprint of the new rule set
+        swap -- callable that starts using the new rule set, called
+        with the cache locked so no verdict is looked up or stored
+        between the rules and the fingerprint changing
+
+        Verdicts from the old rule set are dropped.
+
+        """
+        with self._lock:
+            if swap is not None:
+                swap()
+
+            if fingerprint == self._fingerprint:
+                return
+
+            dropped = len(self._entries)
+            self._entries.clear()
+            self._fingerprint = fingerprint
+
+        self.logger.info('Rule set changed, cleared %s cached verdicts'
+                         % dropped)
+
+    def get(self, digest):
+        """
+        Look up the verdict for an attachment.
+
+        Keyword arguments:
+        digest -- hex digest of the attachment contents
+
+        Returns the cached verdict, or None if there is none.
+
+        """
+        with self._lock:
+            key = (self._fingerprint, digest)
+            try:
+                verdict, stored = self._entries.pop(key)
+
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if self._ttl and time.time() - stored > self._ttl:
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # Re-insert to mark it as most recently used
+            self._entries[key] = (verdict, stored)
+            self.hits += 1
+            return verdict
+
+    def put(self, digest, verdict, fingerprint=None):
+        """
+        Store the verdict for an attachment.
+
+        Keyword arguments:
+        digest -- hex digest of the attachment contents
+        verdict -- the verdict to cache
+        fingerprint -- fingerprint of the rule set the attachment was
+        scanned with, if known. A verdict from a rule set that has
+        since been replaced is not stored
+
+        """
+        with self._lock:
+            if fingerprint is not None and fingerprint != self._fingerprint:
+                return
+
+            key = (self._fingerprint, digest)
+            self._entries.pop(key, None)
+            self._entries[key] = (verdict, time.time())
+
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """
+        Returns a dictionary of cache counters.
+        """
+        return {'entries': len(self._entries),
+                'max_entries': self._max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
@@ -0,0 +1,105 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+# Standard Imports
+import errno
+import socket
+import logging
+import asynchat
+
+# Bulk Imports
+from bulk.session import SMTPSession
+
+
+class BulkChannel(asynchat.async_chat):
+    """
+    An SMTP channel for the asyncore front end.
+
+    Behaves like smtpd.SMTPChannel, but hands everything read from the
+    client to a session.SMTPSession, which can wait on a message
+    verdict. Nothing more is read from the client while it does.
+    """
+
+    def __init__(self, server, conn, addr):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        server -- the BulkProxy that accepted the connection
+        conn -- the connected socket
+        addr -- address of the client
+
+        """
+        asynchat.async_chat.__init__(self, conn)
+        self.logger = logging.getLogger('bulk')
+
+        self._server = server
+        self._addr = addr
+        self._session = None
+
+        try:
+            peer = conn.getpeername()
+
+        except socket.error as e:
+            # The client may have hung up before we could ask
+            self.close()
+            if e.args[0] != errno.ENOTCONN:
+                raise
+
+            return
+
+        self._session = SMTPSession(server, peer, self.push,
+                                    self.close_when_done,
+                                    max_size=server.max_message_size,
+                                    admission=server.admission)
+        self._session.start()
+
+    def readable(self):
+        """
+        Stop reading from the client while a verdict is pending.
+        """
+        return (self._session is not None and
+                not self._session.waiting and
+                asynchat.async_chat.readable(self))
+
+    def handle_read(self):
+        """
+        Hand whatever the client sent to the session.
+        """
+        try:
+            data = self.recv(self.ac_in_buffer_size)
+
+        except socket.error:
+            self.handle_error()
+            return
+
+        if data:
+            self._session.feed(data)
+
+    def close(self):
+        """
+        Close the connection and let the session know.
+        """
+        if self._session is not None:
+            self._session.close()
+
+        asynchat.async_chat.close(self)
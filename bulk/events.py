@@ -0,0 +1,372 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import time
+import Queue
+import sqlite3
+import logging
+import threading
+
+# Bulk Imports
+from bulk import metrics
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id TEXT PRIMARY KEY,
+    time REAL,
+    peer TEXT,
+    mailfrom TEXT,
+    size INTEGER,
+    malicious INTEGER,
+    elapsed REAL,
+    path TEXT
+);
+CREATE TABLE IF NOT EXISTS recipients (
+    message_id TEXT,
+    rcptto TEXT
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    message_id TEXT,
+    name TEXT,
+    size INTEGER,
+    md5 TEXT,
+    sha1 TEXT,
+    sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS scans (
+    message_id TEXT,
+    sha256 TEXT,
+    processor TEXT,
+    matched INTEGER,
+    elapsed REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS hits (
+    message_id TEXT,
+    sha256 TEXT,
+    processor TEXT,
+    rule TEXT,
+    namespace TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+CREATE INDEX IF NOT EXISTS messages_mailfrom ON messages (mailfrom);
+CREATE INDEX IF NOT EXISTS recipients_message ON recipients (message_id);
+CREATE INDEX IF NOT EXISTS recipients_rcptto ON recipients (rcptto);
+CREATE INDEX IF NOT EXISTS attachments_message ON attachments (message_id);
+CREATE INDEX IF NOT EXISTS attachments_md5 ON attachments (md5);
+CREATE INDEX IF NOT EXISTS attachments_sha1 ON attachments (sha1);
+CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256);
+CREATE INDEX IF NOT EXISTS scans_message ON scans (message_id);
+CREATE INDEX IF NOT EXISTS hits_message ON hits (message_id);
+CREATE INDEX IF NOT EXISTS hits_rule ON hits (rule);
+CREATE INDEX IF NOT EXISTS hits_sha256 ON hits (sha256);
+"""
+
+
+def connect(path):
+    """
+    Open an event database, creating its tables if needed.
+
+    Keyword arguments:
+    path -- path to the SQLite database file
+
+    Returns a sqlite3 connection.
+
+    """
+    conn = sqlite3.connect(path)
+    # Headers and file names are byte strings, in whatever encoding
+    conn.text_factory = str
+    # Readers do not block the writer and vice versa
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def search(conn, rule=None, mailfrom=None, rcptto=None, digest=None,
+           since=None, until=None, malicious=None, limit=None):
+    """
+    Find recorded messages.
+
+    Keyword arguments:
+    conn -- connection from connect()
+    rule -- name of a rule that hit on one of the message's attachments
+    mailfrom -- envelope sender
+    rcptto -- one of the envelope recipients
+    digest -- MD5, SHA1 or SHA256 of one of the message's attachments
+    since -- only messages received at or after this Unix time
+    until -- only messages received before this Unix time
+    malicious -- only malicious (True) or clean (False) messages
+    limit -- most messages to return
+
+    Returns a list of (id, time, peer, mailfrom, size, malicious,
+    elapsed, path) rows, newest first.
+
+    """
+    where = []
+    params = []
+
+    if rule is not None:
+        where.append('id IN (SELECT message_id FROM hits WHERE rule = ?)')
+        params.append(rule)
+
+    if mailfrom is not None:
+        where.append('mailfrom = ?')
+        params.append(mailfrom)
+
+    if rcptto is not None:
+        where.append('id IN (SELECT message_id FROM recipients '
+                     'WHERE rcptto = ?)')
+        params.append(rcptto)
+
+    if digest is not None:
+        column = {32: 'md5', 40: 'sha1', 64: 'sha256'}.get(len(digest))
+        if column is None:
+            raise ValueError('Not an MD5, SHA1 or SHA256 digest: %s' % digest)
+
+        where.append('id IN (SELECT message_id FROM attachments '
+                     'WHERE %s = ?)' % column)
+        params.append(digest.lower())
+
+    if since is not None:
+        where.append('time >= ?')
+        params.append(since)
+
+    if until is not None:
+        where.append('time < ?')
+        params.append(until)
+
+    if malicious is not None:
+        where.append('malicious = ?')
+        params.append(int(malicious))
+
+    sql = 'SELECT id, time, peer, mailfrom, size, malicious, elapsed, path ' \
+          'FROM messages'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+
+    sql += ' ORDER BY time DESC'
+    if limit:
+        sql += ' LIMIT %d' % limit
+
+    return conn.execute(sql, params).fetchall()
+
+
+class EventStore(object):
+    """
+    Records message verdicts and attachment sightings to SQLite.
+
+    Events are queued and inserted by a background thread in batched
+    transactions, so recording adds no disk latency to message
+    processing. If the queue fills up, events are dropped and counted
+    rather than holding up mail.
+    """
+
+    def __init__(self, path, batch_size=500, flush_interval=1.0,
+                 max_queue=10000):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        path -- path to the SQLite database file
+        batch_size -- most messages inserted per transaction
+        flush_interval -- most seconds an event waits to be inserted
+        max_queue -- most events waiting before new ones are dropped
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._path = path
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._queue = Queue.Queue(max_queue)
+
+        self.dropped = 0
+        self.recorded = 0
+        self.lost = 0
+
+        # Fail early on a bad path, and make sure the tables exist
+        connect(path).close()
+
+        self._thread = threading.Thread(target=self._run, name='bulk-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __str__(self):
+        """
+        Pretty way to print the store.
+        """
+        return 'EventStore at %s; Recorded: %s; Dropped: %s; Lost: %s' % (
+            self._path, self.recorded, self.dropped, self.lost)
+
+    @property
+    def depth(self):
+        """
+        Number of events waiting to be inserted.
+        """
+        return self._queue.qsize()
+
+    def record(self, msg, verdicts, malicious):
+        """
+        Queue a processed message to be recorded.
+
+        Keyword arguments:
+        msg -- the message.Message
+        verdicts -- list holding the processor Results for each of
+        the message's attachments
+        malicious -- whether the message was found malicious
+
+        """
+        now = time.time()
+        event = {'message': (msg.id, msg.received, str(msg.peer),
+                             msg.mailfrom, len(msg.data), int(malicious),
+                             now - msg.received, msg.saved_path),
+                 'recipients': [(msg.id, r) for r in msg.rcpttos or []],
+                 'attachments': [],
+                 'scans': [],
+                 'hits': []}
+
+        for attachment, results in zip(msg.get_attachments(), verdicts):
+            # Members unpacked from an archive are recorded alongside it
+            for scanned in [attachment] + attachment.members:
+                event['attachments'].append((msg.id, scanned.name,
+                                             scanned.size, scanned.md5,
+                                             scanned.sha1, scanned.sha256))
+
+            for result in results:
+                sha256 = result.sha256 or attachment.sha256
+                event['scans'].append((msg.id, sha256, result.processor,
+                                       int(result.matched), result.elapsed,
+                                       result.error))
+
+                for rule, namespace in result.hits:
+                    event['hits'].append((msg.id, sha256, result.processor,
+                                          rule, namespace))
+
+        try:
+            self._queue.put_nowait(event)
+
+        except Queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                self.logger.warning('Event store is falling behind; '
+                                    'Dropped: %s' % self.dropped)
+
+    def close(self):
+        """
+        Insert every queued event and stop the store.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        """
+        Inserter thread main loop.
+        """
+        conn = connect(self._path)
+        done = False
+
+        while not done:
+            batch = []
+            event = self._queue.get()
+            deadline = time.time() + self._flush_interval
+
+            while event is not None:
+                batch.append(event)
+                if len(batch) >= self._batch_size:
+                    break
+
+                try:
+                    event = self._queue.get(
+                        timeout=max(deadline - time.time(), 0.001))
+
+                except Queue.Empty:
+                    break
+
+            if event is None:
+                done = True
+
+            if batch:
+                self._insert(conn, batch)
+
+        conn.close()
+
+    def _insert(self, conn, batch):
+        """
+        Insert a batch of events in a single transaction.
+
+        If the batch cannot be inserted, its events are inserted one at
+        a time, so a single bad event only loses itself.
+        """
+        start = time.time()
+        try:
+            self._execute(conn, batch)
+
+        except sqlite3.Error as e:
+            self.logger.error('Cannot record %s events to %s, recording '
+                              'them one at a time: %s'
+                              % (len(batch), self._path, e))
+
+            for event in batch:
+                try:
+                    self._execute(conn, [event])
+
+                except sqlite3.Error as e:
+                    self.lost += 1
+                    self.logger.error('Cannot record message %s to %s: %s'
+                                      % (event['message'][0], self._path,
+                                         e))
+                    continue
+
+                self.recorded += 1
+
+            return
+
+        self.recorded += len(batch)
+        metrics.STAGE_SECONDS.labels('events').observe(time.time() - start)
+
+    def _execute(self, conn, batch):
+        """
+        Insert events in a single transaction.
+
+        Keyword arguments:
+        conn -- connection from connect()
+        batch -- list of events queued by record
+
+        """
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO messages VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?)',
+                [event['message'] for event in batch])
+
+            for table, columns in [('recipients', 2),
+                                   ('attachments', 6),
+                                   ('scans', 6),
+                                   ('hits', 5)]:
+                conn.executemany(
+                    'INSERT INTO %s VALUES (%s)'
+                    % (table, ', '.join(['?'] * columns)),
+                    [row for event in batch for row in event[table]])
@@ -23,9 +23,23 @@
 
 # Standard Imports
 import os
+import re
 import sys
 import time
 import errno
+import Queue
+import hashlib
+import argparse
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Bulk Imports
+from bulk.processors import takes_attachments
+
+
+# Matches the file named by a yara include statement
+INCLUDE = re.compile(r'^\s*include\s+"([^"]+)"', re.MULTILINE)
 
 
 def directory_name(dn):
@@ -71,31 +85,99 @@ def create_sub_directories(basedir):
     """
     # Create the sub directories for the log
     for each in ['messages', 'quarantine', 'attachments']:
-        dir = directory_name(basedir + each)
+        make_directory(directory_name(basedir + each))
 
-        try:
-            os.makedirs(dir)
 
-        except OSError as e:
-            # If file exists
-            if e.args[0] == errno.EEXIST:
-                pass
+def make_directory(dn):
+    """
+    Create a directory, and any missing parents, if it does not exist.
+
+    Keyword arguments:
+    dn -- the directory path
+
+    """
+    try:
+        os.makedirs(dn)
+
+    except OSError as e:
+        # If file exists
+        if e.args[0] == errno.EEXIST:
+            pass
+
+        else:
+            raise
+
+
+def fsync_directory(dn):
+    """
+    Flush a directory's entries to disk, so files created or renamed
+    into it survive a crash.
+
+    Keyword arguments:
+    dn -- the directory path
+
+    """
+    fd = os.open(dn, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+
+    finally:
+        os.close(fd)
+
+
+class CreateProcessor(argparse.Action):
+    """
+    A custom argparse action.
+
+    Checks the rule files of a processing engine to be used in Bulk
+    and appends how to build it, a (module_name, rules) tuple, to the
+    list of actively used processing engines. The engines are built
+    once all arguments are parsed, so they can be built together.
+
+    """
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        """
+        Check a processing engine and append it to the active set.
+        """
+        module_name = values[0]
+        rule_files = values[1:]
+
+        # check the rules files
+        for fn in rule_files:
+            if os.path.isfile(fn):
+                try:
+                    with open(fn):
+                        pass
+
+                except IOError:
+                    raise IOError((errno.EACCES,
+                                  'Cannot open and read rules file.', fn))
 
             else:
-                raise
+                raise IOError((errno.ENOENT, 'Cannot find rules file.', fn))
+
+        rules = convert_rules(rule_files)
+        current_processors = getattr(namespace, self.dest)
+        current_processors.append((module_name, rules))
+        setattr(namespace, self.dest, current_processors)
 
 
-def build_processor(module_name, rules=None):
+def build_processor(module_name, rules=None, **options):
     """
     Imports a module and instantiates a Processor.
 
     Keyword arguments:
     module_name -- name of the module to import
     rules -- dictionary of rule files
+    options -- processor options, such as cache_directory. Options
+    that are None are left out
 
     Returns a processor instance.
 
     """
+    options = dict((k, v) for k, v in options.items() if v is not None)
+
     try:
         mod = __import__(module_name, fromlist=['processors'])
 
@@ -104,13 +186,216 @@ def build_processor(module_name, rules=None):
         sys.exit(1)
 
     try:
-        return mod.Processor(rules)
+        processor_class = mod.Processor
 
     except AttributeError:
         print "Module %s must define a 'Processor' class." \
               "See README" % module_name
         sys.exit(1)
 
+    # Processors from before options existed only take the rules
+    if not takes_attachments(processor_class):
+        return processor_class(rules)
+
+    return processor_class(rules, **options)
+
+
+def _warm_processor(spec):
+    """
+    Build a processor and throw it away, leaving its compiled
+    rules in the rule cache.
+
+    Keyword arguments:
+    spec -- (module_name, rules, options) tuple
+
+    """
+    module_name, rules, options = spec
+    try:
+        build_processor(module_name, rules, **options)
+
+    except BaseException:
+        # Building it again in the parent reports the problem
+        pass
+
+
+def build_processors(specs, **options):
+    """
+    Build several processors at once.
+
+    Keyword arguments:
+    specs -- list of (module_name, rules) tuples
+    options -- processor options passed to build_processor
+
+    With a rule cache directory, the rules are first compiled into the
+    cache by a process each, then every processor loads its compiled
+    rules from the cache. Either way the processors are built on a
+    thread each.
+
+    Returns a list of processor instances, in the same order as specs.
+
+    """
+    if len(specs) < 2:
+        return [build_processor(module_name, rules, **options)
+                for module_name, rules in specs]
+
+    if options.get('cache_directory'):
+        pool = multiprocessing.Pool(min(len(specs),
+                                        multiprocessing.cpu_count()))
+        try:
+            pool.map(_warm_processor, [(module_name, rules, options)
+                                       for module_name, rules in specs])
+
+        finally:
+            pool.close()
+            pool.join()
+
+    def build(spec):
+        # Pool threads die on SystemExit, so hand it back instead
+        try:
+            return build_processor(spec[0], spec[1], **options)
+
+        except BaseException as e:
+            return e
+
+    pool = ThreadPool(len(specs))
+    try:
+        processors = pool.map(build, specs)
+
+    finally:
+        pool.close()
+        pool.join()
+
+    for processor in processors:
+        if isinstance(processor, BaseException):
+            raise processor
+
+    return processors
+
+
+def rule_sources(path, includes=True):
+    """
+    Read a rule file and every file it includes.
+
+    Keyword arguments:
+    path -- the rule file
+    includes -- whether to follow yara include statements, which are
+    relative to the file they appear in
+
+    Yields (path, contents) for each file once, the rule file first.
+    Raises IOError when a file cannot be read.
+
+    """
+    seen = set()
+    paths = [path]
+    while paths:
+        path = os.path.abspath(paths.pop())
+        if path in seen:
+            continue
+
+        seen.add(path)
+        with open(path, 'rb') as f:
+            source = f.read()
+
+        yield path, source
+
+        if includes:
+            paths.extend(os.path.join(os.path.dirname(path), include)
+                         for include in INCLUDE.findall(source))
+
+
+def rules_fingerprint(specs):
+    """
+    Fingerprint a set of processors and the rules they were built with.
+
+    Keyword arguments:
+    specs -- list of (module_name, rules) tuples, rules being a
+    dictionary of rule files as returned by convert_rules
+
+    The fingerprint changes whenever a processor module, rule file
+    name or the contents of a rule file or of a file it includes
+    change.
+
+    Returns a hex digest.
+
+    """
+    digest = hashlib.sha1()
+    for module_name, rules in specs:
+        digest.update(module_name)
+
+        for namespace in sorted(rules or {}):
+            digest.update(namespace)
+            digest.update(rules[namespace])
+
+            try:
+                for path, source in rule_sources(rules[namespace]):
+                    digest.update(path)
+                    digest.update(source)
+
+            except IOError:
+                # The processor will complain about it
+                pass
+
+    return digest.hexdigest()
+
+
+def _apply_chunk(func, chunk):
+    """
+    Run a function on a chunk of tasks, in a pool worker.
+
+    Returns (True, list of results), or (False, the exception) if one
+    of them failed.
+    """
+    try:
+        return True, [func(task) for task in chunk]
+
+    except Exception as e:
+        return False, e
+
+
+def imap_windowed(pool, func, tasks, window, chunk_size=1):
+    """
+    Map a function over tasks on a process pool, a window at a time.
+
+    Keyword arguments:
+    pool -- multiprocessing.Pool to map on
+    func -- function to run on each task
+    tasks -- iterable of tasks, possibly too many to hold at once
+    window -- most tasks handed to the pool at a time
+    chunk_size -- tasks handed to a worker at a time
+
+    Pool.imap_unordered queues up every task right away, so only a
+    window of them is taken from tasks at a time. Another chunk is
+    handed to the pool as each one finishes, so the workers are kept
+    busy rather than waiting for the slowest task of the window.
+
+    Yields each task's result, in no particular order.
+
+    """
+    tasks = iter(tasks)
+    chunks = iter(lambda: list(itertools.islice(tasks, chunk_size)), [])
+    # Filled from the pool's result thread
+    done = Queue.Queue()
+
+    def submit(count):
+        submitted = 0
+        for chunk in itertools.islice(chunks, count):
+            pool.apply_async(_apply_chunk, (func, chunk),
+                             callback=done.put)
+            submitted += 1
+
+        return submitted
+
+    in_flight = submit(max(window // chunk_size, 1))
+    while in_flight:
+        ok, results = done.get()
+        in_flight -= 1
+        if not ok:
+            raise results
+
+        in_flight += submit(1)
+        for result in results:
+            yield result
+
 
 def timeit(func):
     """
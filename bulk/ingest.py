@@ -0,0 +1,394 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import json
+import time
+import email
+import signal
+import logging
+import multiprocessing
+
+# Bulk Imports
+from bulk import scanner
+from bulk.message import Message
+from bulk.cache import VerdictCache
+from bulk.helpers import imap_windowed
+
+
+# Separates the messages in an mbox, along with the start of the file
+FROM_LINE = '\nFrom '
+
+# What the rest of an ingest worker process works with, set by _init_worker
+_worker = {}
+
+
+def mbox_messages(path, block_size=1024 * 1024):
+    """
+    Find the messages in an mbox file without reading it all in.
+
+    Keyword arguments:
+    path -- path to the mbox file
+    block_size -- bytes read at a time
+
+    Like the mailbox module, every line starting with 'From ' starts
+    a message. Anything before the first one is left out.
+
+    Yields (offset, length) tuples, each covering a message and its
+    'From ' line.
+
+    """
+    with open(path, 'rb') as f:
+        data = f.read(max(block_size, len(FROM_LINE)))
+        # File offset of the start of data
+        offset = 0
+        start = 0 if data.startswith(FROM_LINE[1:]) else None
+
+        while data:
+            i = data.find(FROM_LINE)
+            while i >= 0:
+                found = offset + i + 1
+                if start is not None:
+                    yield start, found - start
+
+                start = found
+                i = data.find(FROM_LINE, i + 1)
+
+            # Hold on to what could be the start of a separator cut in
+            # two by the read, too short to be matched on its own
+            tail = data[-(len(FROM_LINE) - 1):]
+            more = f.read(block_size)
+            if not more:
+                offset += len(data)
+                break
+
+            offset += len(data) - len(tail)
+            data = tail + more
+
+    if start is not None and offset > start:
+        yield start, offset - start
+
+
+def maildir_messages(path):
+    """
+    Find the messages in a Maildir, and any Maildir folders inside it.
+
+    Keyword arguments:
+    path -- path to the Maildir
+
+    Yields the path of each message file.
+
+    """
+    for dn, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        if os.path.basename(dn) not in ('cur', 'new'):
+            continue
+
+        for fn in sorted(filenames):
+            if not fn.startswith('.'):
+                yield os.path.join(dn, fn)
+
+
+def messages(sources):
+    """
+    Find the messages in mbox files and Maildirs.
+
+    Keyword arguments:
+    sources -- list of paths, directories being read as Maildirs and
+    files as mbox files
+
+    Yields (path, offset, length) tuples, offset and length being None
+    for a message that is a whole file.
+
+    """
+    for source in sources:
+        if os.path.isdir(source):
+            for path in maildir_messages(source):
+                yield path, None, None
+
+        else:
+            for offset, length in mbox_messages(source):
+                yield source, offset, length
+
+
+def read_message(path, offset=None, length=None):
+    """
+    Read a message found by messages().
+
+    Keyword arguments:
+    path -- path to the mbox file or message file
+    offset -- where the message starts in an mbox file
+    length -- how long the message is
+
+    Returns a (data, mailfrom) tuple holding the message and its
+    envelope sender, taken from the mbox 'From ' line, or None.
+
+    """
+    with open(path, 'rb') as f:
+        if offset is None:
+            data = f.read()
+
+        else:
+            f.seek(offset)
+            data = f.read(length)
+
+    mailfrom = None
+    if offset is not None:
+        line, _, data = data.partition('\n')
+        fields = line.split()
+        if len(fields) > 1:
+            mailfrom = fields[1]
+
+        # Leave out the blank line written after each message
+        if data.endswith('\n\n'):
+            data = data[:-1]
+
+    return data, mailfrom
+
+
+def _text(value):
+    """
+    Make a header value or file name safe to write out as JSON.
+    """
+    if value is None or isinstance(value, unicode):
+        return value
+
+    return str(value).decode('utf-8', 'replace')
+
+
+def _init_worker(specs, options, unpacker, memory_limit, cache_size):
+    """
+    Build the processors for an ingest worker process.
+
+    Keyword arguments:
+    specs -- list of (module_name, rules) tuples
+    options -- processor options passed to build_processor
+    unpacker -- unpack.Unpacker for archives, if any
+    memory_limit -- largest attachment, encoded, to decode in memory
+    cache_size -- number of attachment verdicts to cache, 0 for none
+
+    """
+    # Interrupting the parent stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    scanner._init_worker(specs, options)
+
+    _worker['unpacker'] = unpacker
+    _worker['memory_limit'] = memory_limit
+    _worker['cache'] = VerdictCache(cache_size, 0) if cache_size else None
+
+
+def _scan(attachments):
+    """
+    Scan attachments, answering from the worker's verdict cache when
+    possible.
+
+    Keyword arguments:
+    attachments -- list of message.Attachments
+
+    Returns a tuple holding the list of processor Results for each
+    attachment, empty where scanning failed, and the indexes of the
+    attachments whose verdicts were cached.
+
+    """
+    cache = _worker['cache']
+    verdicts = [cache.get(attachment.sha256) if cache is not None else None
+                for attachment in attachments]
+    misses = [i for i, verdict in enumerate(verdicts) if verdict is None]
+    cached = [i for i, verdict in enumerate(verdicts) if verdict is not None]
+
+    results = []
+    if misses:
+        results = scanner._scan([attachments[i] for i in misses])
+        if results is None:
+            results = [[] for i in misses]
+
+    for i, result in zip(misses, results):
+        verdicts[i] = result
+        # Failed scans are tried again when the attachment turns up again
+        if cache is not None and result and \
+                not any(r.failed for r in result):
+            cache.put(attachments[i].sha256, result)
+
+    return verdicts, cached
+
+
+def _ingest(task):
+    """
+    Parse and scan one message.
+
+    Keyword arguments:
+    task -- (path, offset, length) tuple from messages()
+
+    Returns a dictionary describing the message and its verdict, ready
+    to be written out as JSON.
+
+    """
+    path, offset, length = task
+    start = time.time()
+    record = {'source': _text(path), 'offset': offset}
+
+    try:
+        data, mailfrom = read_message(path, offset, length)
+        parsed = email.message_from_string(data)
+        mailfrom = mailfrom or parsed.get('return-path')
+        msg = Message(None, mailfrom, parsed.get_all('delivered-to', []),
+                      data, parsed, memory_limit=_worker['memory_limit'])
+
+        attachments = list(msg.get_attachments())
+        problems = []
+        if _worker['unpacker']:
+            for attachment in list(attachments):
+                members, failures = _worker['unpacker'].expand(attachment)
+                attachments.extend(members)
+                problems.extend(failure.error for failure in failures)
+
+    except Exception as e:
+        logging.getLogger('bulk').exception('Cannot read message; '
+                                            'Source: %s; Offset: %s'
+                                            % (path, offset))
+        record['error'] = _text(str(e) or e.__class__.__name__)
+        record['verdict'] = 'error'
+        return record
+
+    verdicts, cached = _scan(attachments)
+
+    described = []
+    for i, (attachment, results) in enumerate(zip(attachments, verdicts)):
+        described.append({
+            'name': _text(attachment.name),
+            'size': attachment.size,
+            'md5': attachment.md5,
+            'sha1': attachment.sha1,
+            'sha256': attachment.sha256,
+            'matched': any(results),
+            'failed': not results or any(r.failed for r in results),
+            'cached': i in cached,
+            'results': [{'processor': r.processor,
+                         'matched': bool(r.matched),
+                         'hits': [{'rule': rule, 'namespace': namespace}
+                                  for rule, namespace in r.hits],
+                         'elapsed': r.elapsed,
+                         'error': _text(r.error)}
+                        for r in results]})
+
+    if any(attachment['matched'] for attachment in described):
+        verdict = 'malicious'
+
+    elif any(attachment['failed'] for attachment in described):
+        verdict = 'failed'
+
+    elif problems:
+        # What could not be unpacked was not scanned either
+        verdict = 'incomplete'
+
+    else:
+        verdict = 'clean'
+
+    record.update({
+        'id': msg.id,
+        'mailfrom': _text(mailfrom),
+        'rcpttos': [_text(rcptto) for rcptto in msg.rcpttos],
+        'message_id': _text(parsed.get('message-id')),
+        'date': _text(parsed.get('date')),
+        'from': _text(parsed.get('from')),
+        'to': _text(parsed.get('to')),
+        'subject': _text(parsed.get('subject')),
+        'size': len(data),
+        'verdict': verdict,
+        'attachments': described,
+        'problems': [_text(problem) for problem in problems],
+        'elapsed': time.time() - start})
+    return record
+
+
+def ingest(sources, specs, options, output, workers=None, unpacker=None,
+           memory_limit=0, cache_size=10000, chunk_size=32,
+           progress_interval=60):
+    """
+    Run archived mail through the processors, with a process pool.
+
+    Keyword arguments:
+    sources -- list of mbox files and Maildirs
+    specs -- list of (module_name, rules) tuples to build processors from
+    options -- processor options passed to build_processor
+    output -- file object to write a JSON line for each message to
+    workers -- number of worker processes, the number of CPUs by default
+    unpacker -- unpack.Unpacker for archives, if any
+    memory_limit -- largest attachment, encoded, to decode in memory
+    cache_size -- attachment verdicts each worker caches, 0 for none
+    chunk_size -- messages handed to a worker at a time
+    progress_interval -- seconds between progress log lines
+
+    mbox files are split into messages in a single streaming pass that
+    only notes where each message is; the workers read, parse, unpack
+    and scan the messages themselves. Results come out in the order the
+    messages are done, and each says where its message came from.
+
+    Returns a dictionary of counts describing the run.
+
+    """
+    logger = logging.getLogger('bulk.ingest')
+    workers = workers or multiprocessing.cpu_count()
+
+    summary = {'messages': 0, 'attachments': 0, 'malicious': 0,
+               'failed': 0, 'incomplete': 0, 'errors': 0, 'bytes': 0}
+    start = reported = time.time()
+
+    pool = multiprocessing.Pool(workers, _init_worker,
+                                (specs, options, unpacker, memory_limit,
+                                 cache_size))
+    try:
+        for record in imap_windowed(pool, _ingest, messages(sources),
+                                    workers * chunk_size * 64, chunk_size):
+            output.write(json.dumps(record, sort_keys=True) + '\n')
+
+            summary['messages'] += 1
+            summary['bytes'] += record.get('size', 0)
+            summary['attachments'] += len(record.get('attachments', []))
+            summary['malicious'] += record['verdict'] == 'malicious'
+            summary['failed'] += record['verdict'] == 'failed'
+            summary['incomplete'] += record['verdict'] == 'incomplete'
+            summary['errors'] += record['verdict'] == 'error'
+
+            now = time.time()
+            if now - reported >= progress_interval:
+                reported = now
+                logger.info('Ingested %s messages in %.1f s, %.1f '
+                            'messages/s; Malicious: %s'
+                            % (summary['messages'], now - start,
+                               summary['messages'] / max(now - start, 1e-6),
+                               summary['malicious']))
+
+        pool.close()
+
+    except BaseException:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+        output.flush()
+
+    summary['seconds'] = time.time() - start
+    return summary
@@ -23,12 +23,213 @@
 
 # Standard Imports
 import os
+import time
 import uuid
 import email
+import quopri
+import binascii
 import datetime
 import logging
 import hashlib
-import pickle
+import tempfile
+import StringIO
+
+# Bulk Imports
+from bulk import metrics
+
+
+class Attachment(object):
+    """
+    An attachment pulled out of a message.
+
+    Carries the decoded contents along with their size and digests,
+    which are computed once, together, in a single pass.
+
+    Large attachments are kept in a temporary file instead of in memory.
+    Their path is set, and the file is removed once the attachment is no
+    longer used.
+    """
+
+    # Bytes hashed per step of the single pass
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, name, content=None, path=None, keep=False):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        name -- the attachment's file name
+        content -- the decoded attachment contents
+        path -- temporary file holding the decoded contents instead,
+        which the attachment takes over
+        keep -- leave the file at path in place, for attachments read
+        from a file that is not temporary, such as a stored one
+
+        """
+        self.name = name
+        self.path = path
+        # Attachments unpacked from this one, once it has been scanned
+        self.members = []
+        self._content = None
+        # Only the attachment that took the file over removes it
+        self._owned = path is not None and not keep
+
+        if path is None:
+            self._content = content or ''
+            self.size = len(self._content)
+            view = memoryview(self._content)
+            chunks = (view[offset:offset + self.CHUNK_SIZE]
+                      for offset in xrange(0, self.size, self.CHUNK_SIZE))
+
+        else:
+            self.size = os.path.getsize(path)
+            f = open(path, 'rb')
+            chunks = iter(lambda: f.read(self.CHUNK_SIZE), '')
+
+        start = time.time()
+        md5 = hashlib.md5()
+        sha1 = hashlib.sha1()
+        sha256 = hashlib.sha256()
+
+        for chunk in chunks:
+            md5.update(chunk)
+            sha1.update(chunk)
+            sha256.update(chunk)
+
+        if path is not None:
+            f.close()
+
+        self.md5 = md5.hexdigest()
+        self.sha1 = sha1.hexdigest()
+        self.sha256 = sha256.hexdigest()
+        metrics.STAGE_SECONDS.labels('hash').observe(time.time() - start)
+
+    def __str__(self):
+        """
+        A nice way to print an attachment.
+        """
+        return 'Name: %s; Size: %s; MD5: %s' % (self.name, self.size,
+                                                self.md5)
+
+    def __getstate__(self):
+        """
+        Copies, such as those sent to scanning workers, share the file
+        but leave removing it to the original.
+        """
+        state = self.__dict__.copy()
+        state['_owned'] = False
+        return state
+
+    def __del__(self):
+        if self._owned:
+            try:
+                os.remove(self.path)
+
+            except OSError:
+                pass
+
+    @property
+    def content(self):
+        """
+        The decoded contents.
+
+        For an attachment kept in a file this reads the whole file into
+        memory, so prefer open() or path for those.
+        """
+        if self.path is None:
+            return self._content
+
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def open(self):
+        """
+        Returns a file object to read the decoded contents from.
+        """
+        if self.path is None:
+            return StringIO.StringIO(self._content)
+
+        return open(self.path, 'rb')
+
+
+def _decoded_chunks(payload, encoding, size=Attachment.CHUNK_SIZE):
+    """
+    Decode a part's payload a chunk at a time.
+
+    Keyword arguments:
+    payload -- the encoded payload
+    encoding -- its content transfer encoding, in lower case
+    size -- encoded bytes to decode at a time
+
+    Yields chunks of decoded contents.
+
+    """
+    if encoding == 'base64':
+        leftover = ''
+        for offset in xrange(0, len(payload), size):
+            data = leftover + ''.join(payload[offset:offset + size].split())
+            usable = len(data) - len(data) % 4
+            leftover = data[usable:]
+            yield binascii.a2b_base64(data[:usable])
+
+        if leftover:
+            yield binascii.a2b_base64(leftover)
+
+    elif encoding == 'quoted-printable':
+        # Split after line endings, which soft line breaks end with too
+        offset = 0
+        while offset < len(payload):
+            end = payload.find('\n', offset + size)
+            end = len(payload) if end < 0 else end + 1
+            yield quopri.decodestring(payload[offset:end])
+            offset = end
+
+    else:
+        for offset in xrange(0, len(payload), size):
+            yield payload[offset:offset + size]
+
+
+def attachment_from_part(name, part, memory_limit=0):
+    """
+    Decode the attachment carried in a message part.
+
+    Keyword arguments:
+    name -- the attachment's file name
+    part -- the email.message.Message part carrying it
+    memory_limit -- largest encoded payload to decode in memory, 0 for
+    no limit. Larger ones are decoded a chunk at a time into a
+    temporary file.
+
+    Returns an Attachment.
+
+    """
+    payload = part.get_payload()
+    encoding = str(part.get('content-transfer-encoding', '')).strip().lower()
+
+    if not memory_limit or part.is_multipart() or \
+            len(payload) <= memory_limit or \
+            encoding not in ('base64', 'quoted-printable', '7bit', '8bit',
+                             'binary', ''):
+        return Attachment(name, part.get_payload(decode=True))
+
+    fd, path = tempfile.mkstemp(prefix='bulk-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            try:
+                for chunk in _decoded_chunks(payload, encoding):
+                    f.write(chunk)
+
+            except binascii.Error:
+                # Like the email package, fall back to the raw payload
+                f.seek(0)
+                f.truncate()
+                f.write(payload)
+
+    except Exception:
+        os.remove(path)
+        raise
+
+    return Attachment(name, path=path)
 
 
 class Message(object):
@@ -36,12 +237,21 @@ class Message(object):
     A simple wrapper to access email data.
     """
 
-    def __init__(self, peer, mailfrom, rcpttos, data):
+    def __init__(self, peer, mailfrom, rcpttos, data,
+                 parsed_message=None, attachments=None, memory_limit=0):
         """
         Default initializer
 
         Sets up logging and parses pieces of the message.
 
+        Keyword arguments:
+        parsed_message -- the already parsed email.message.Message, if any
+        attachments -- list of Attachments already pulled out of
+        parsed_message, even if empty, or None to pull them out when
+        first asked for
+        memory_limit -- largest attachment, encoded, to decode in memory
+        rather than into a temporary file, 0 for no limit
+
         """
         self.logger = logging.getLogger('bulk')
 
@@ -49,12 +259,55 @@ class Message(object):
         self._mailfrom = mailfrom
         self._rcpttos = rcpttos
         self._data = data
+        self._id = uuid.uuid4().hex
+        self._received = time.time()
 
-        self._parsed_message = email.message_from_string(data)
+        if parsed_message is None:
+            parsed_message = email.message_from_string(data)
 
-        # Attachments
-        self._attachment_names = []
-        self._attachment_contents = []
+        self._parsed_message = parsed_message
+
+        # Attachments, None until pulled out
+        self._attachments = attachments
+        self._memory_limit = memory_limit
+        self._saved_path = None
+
+    @property
+    def id(self):
+        """
+        Unique identifier for the message.
+        """
+        return self._id
+
+    @property
+    def received(self):
+        """
+        Unix time the message was received at.
+        """
+        return self._received
+
+    @property
+    def peer(self):
+        return self._peer
+
+    @property
+    def mailfrom(self):
+        return self._mailfrom
+
+    @property
+    def rcpttos(self):
+        return self._rcpttos
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def saved_path(self):
+        """
+        Where the message was last saved to, if anywhere.
+        """
+        return self._saved_path
 
     def __str__(self):
         """
@@ -69,17 +322,23 @@ class Message(object):
 
         return s
 
-    def save(self, location):
+    def save(self, location, writer=None):
         """
         Writes the message to a unique file in the
         supplied location.
 
         Keyword arguments:
         location -- path to write message to
+        writer -- writer.StorageWriter to hand the write to, if any
 
         """
         fn = self.get_unique_filepath(location)
         self.logger.info('Saving message to %s' % fn)
+        self._saved_path = fn
+
+        if writer:
+            writer.write(fn, str(self))
+            return
 
         try:
             with open(fn, 'wb') as f:
@@ -117,74 +376,45 @@ class Message(object):
         """
         Pull attachments from a message.
 
-        Returns two lists, one of the attachment names
-        and another of the attachment contents.
+        Returns a list of Attachments.
 
         """
+        # Already pulled out, possibly while the message was streaming in,
+        # even if there were none
+        if self._attachments is not None:
+            return self._attachments
 
-        attachment_names = []
-        attachment_contents = []
+        attachments = []
 
         for part in self._parsed_message.walk():
             attachment_name = part.get_filename()
 
             if attachment_name:
                 self.logger.info('Found attachment; Name: %s' % attachment_name)
-                attachment_names.append(attachment_name)
-                attachment_contents.append(part.get_payload(decode=True))
+                attachments.append(attachment_from_part(attachment_name,
+                                                        part,
+                                                        self._memory_limit))
 
-        self._attachment_names = attachment_names
-        self._attachment_contents = attachment_contents
-        return (attachment_names, attachment_contents)
+        self._attachments = attachments
+        return attachments
 
-    def save_attachments(self, location):
+    def save_attachments(self, store):
         """
-        Save attachments and report to a directory.
+        Save attachments and record where they were seen.
 
         Keyword arguments:
-        location -- directory to save attachements to
+        store -- store.AttachmentStore to save attachments to
 
-        Attachments are saved to <md5>.file.
-        Reported info is saved to <md5>.report.
+        Each attachment is stored once, by content, no matter how many
+        messages it turns up in. The sighting recorded for it refers to
+        where this message was saved, if it was.
         """
         self.logger.debug('Saving attachments to disk')
-        # In case the attachments have not been
-        # populated, we can try ourselves.
-        if not self._attachment_names:
-            self.logger.debug('No attachments found, trying to parse them now')
-            self.get_attachments()
-
-        for i, filename in enumerate(self._attachment_names):
-            # Write a report file
-            md5 = hashlib.md5(self._attachment_contents[i]).hexdigest()
-            report = location + md5 + '.pkl'
-
-            fn = location + md5 + '.file'
-            try:
-                with open(fn, 'wb') as f:
-                    f.write(str(self._attachment_contents[i]))
-
-            except IOError:
-                self.logger.error('Cannot write to %s' % fn)
-                self.logger.error('Ensure the directory exists \
-                                  and permissions are correct')
-
-            # Going to pickle this data to disk for now
-            content = {}
-            content['name'] = filename
-            content['size'] = str(os.path.getsize(fn))
-            content['from'] = str(self._peer)
-            content['mailed_from'] = str(self._mailfrom)
-            content['to'] = str(self._rcpttos)
-            content['email'] = str(self)
-            content['attachment'] = fn
-            content['md5'] = md5
-
-            try:
-                with open(report, 'wb') as f:
-                    pickle.dump(content, f)
-
-            except IOError:
-                self.logger.error('Cannot write to %s' % report)
-                self.logger.error('Ensure the directory exists \
-                                  and permissions are correct')
+        for attachment in self.get_attachments():
+            sighting = {}
+            sighting['from'] = str(self._peer)
+            sighting['mailed_from'] = str(self._mailfrom)
+            sighting['to'] = str(self._rcpttos)
+            sighting['email'] = self._saved_path
+
+            store.add(attachment, sighting)
@@ -0,0 +1,469 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import bisect
+import logging
+import threading
+import collections
+import BaseHTTPServer
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(names, values, extra=None):
+    """
+    Format label names and values the Prometheus way, {name="value",...}.
+    """
+    pairs = zip(names, values)
+    if extra:
+        pairs.append(extra)
+
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                                     .replace('"', r'\"')
+                                     .replace('\n', r'\n'))
+        for name, value in pairs)
+
+
+def _format_value(value):
+    """
+    Format a sample value the Prometheus way.
+    """
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+class _Metric(object):
+    """
+    A metric whose values are kept per thread.
+
+    Each thread updates its own shard of the values, so updates never
+    wait on a lock. Reading the metric sums up the shards.
+    """
+
+    type = None
+
+    def __init__(self, name, description, labels=()):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        name -- the metric's name
+        description -- what the metric measures
+        labels -- names of the metric's labels
+
+        """
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._children = {}
+
+    def labels(self, *values):
+        """
+        Returns the metric for a set of label values.
+        """
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = _Child(self, values)
+
+        return child
+
+    def _shard(self):
+        """
+        Returns the calling thread's values, keyed by label values.
+        """
+        try:
+            return self._local.values
+
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append(values)
+
+            return values
+
+    def _snapshots(self):
+        """
+        Returns a copy of every thread's values.
+        """
+        with self._lock:
+            shards = list(self._shards)
+
+        # items() copies a dictionary in one go, while holding the GIL
+        return [shard.items() for shard in shards]
+
+
+class _Child(object):
+    """
+    A metric with its label values filled in.
+    """
+
+    def __init__(self, metric, values):
+        self._metric = metric
+        self._values = values
+
+    def inc(self, amount=1):
+        """
+        Add to a counter.
+        """
+        shard = self._metric._shard()
+        shard[self._values] = shard.get(self._values, 0) + amount
+
+    def observe(self, value):
+        """
+        Record an observation in a histogram.
+        """
+        metric = self._metric
+        shard = metric._shard()
+        counts = shard.get(self._values)
+        if counts is None:
+            # A count per bucket and the +Inf bucket, then the sum
+            counts = shard[self._values] = [0] * (len(metric.buckets) + 1)
+            counts.append(0.0)
+
+        counts[bisect.bisect_left(metric.buckets, value)] += 1
+        counts[-1] += value
+
+
+class Counter(_Metric):
+    """
+    A count that only goes up.
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        """
+        Returns a list of (suffix, label values, extra label, value).
+        """
+        totals = {}
+        for items in self._snapshots():
+            for values, count in items:
+                totals[values] = totals.get(values, 0) + count
+
+        return [('', values, None, total)
+                for values, total in sorted(totals.items())]
+
+
+class Histogram(_Metric):
+    """
+    A distribution of observations, such as latencies, in buckets.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=BUCKETS):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        name -- the metric's name
+        description -- what the metric measures
+        labels -- names of the metric's labels
+        buckets -- sorted upper bounds of the buckets
+
+        """
+        _Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        """
+        Returns a list of (suffix, label values, extra label, value).
+        """
+        totals = {}
+        for items in self._snapshots():
+            for values, counts in items:
+                counts = list(counts)
+                total = totals.setdefault(values, [0] * len(counts))
+                for i, count in enumerate(counts):
+                    total[i] += count
+
+        samples = []
+        for values, counts in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', values,
+                                ('le', _format_value(bound)), cumulative))
+
+            samples.append(('_sum', values, None, counts[-1]))
+            samples.append(('_count', values, None, cumulative))
+
+        return samples
+
+
+class Callback(object):
+    """
+    A metric read from a function when the metrics are collected,
+    such as the depth of a queue.
+    """
+
+    def __init__(self, name, description, func, type='gauge'):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        name -- the metric's name
+        description -- what the metric measures
+        func -- callable returning the metric's value, or None
+        type -- 'gauge', or 'counter' for a count kept elsewhere
+
+        """
+        self.name = name
+        self.description = description
+        self.label_names = ()
+        self.type = type
+        self._func = func
+
+    def samples(self):
+        """
+        Returns a list of (suffix, label values, extra label, value).
+        """
+        value = self._func()
+        if value is None:
+            return []
+
+        return [('', (), None, value)]
+
+
+def merge(snapshots):
+    """
+    Add up snapshots of the same metrics, such as those taken by
+    several worker processes.
+
+    Keyword arguments:
+    snapshots -- list of snapshots returned by Registry.snapshot
+
+    Returns the merged snapshot, with the metrics in the order
+    they were first seen.
+
+    """
+    merged = collections.OrderedDict()
+    for snapshot in snapshots:
+        for name, description, type, label_names, samples in snapshot:
+            if name not in merged:
+                merged[name] = (description, type, label_names,
+                                collections.OrderedDict())
+
+            totals = merged[name][3]
+            for suffix, values, extra, value in samples:
+                key = (suffix, values, extra)
+                totals[key] = totals.get(key, 0) + value
+
+    return [(name, description, type, label_names,
+             [key + (value,) for key, value in totals.items()])
+            for name, (description, type, label_names, totals)
+            in merged.items()]
+
+
+def render(snapshot):
+    """
+    Render a snapshot in the Prometheus text format.
+
+    Keyword arguments:
+    snapshot -- snapshot returned by Registry.snapshot or merge
+
+    """
+    lines = []
+    for name, description, type, label_names, samples in snapshot:
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, type))
+        for suffix, values, extra, value in samples:
+            lines.append('%s%s%s %s' % (
+                name, suffix, _format_labels(label_names, values, extra),
+                _format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+class Registry(object):
+    """
+    A set of metrics, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger('bulk')
+        self._metrics = []
+
+    def counter(self, name, description, labels=()):
+        """
+        Returns a new Counter.
+        """
+        return self._add(Counter(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=BUCKETS):
+        """
+        Returns a new Histogram.
+        """
+        return self._add(Histogram(name, description, labels, buckets))
+
+    def callback(self, name, description, func, type='gauge'):
+        """
+        Returns a new Callback, replacing any with the same name.
+        """
+        self._metrics = [metric for metric in self._metrics
+                         if metric.name != name]
+        return self._add(Callback(name, description, func, type))
+
+    def snapshot(self):
+        """
+        Collect every metric.
+
+        Returns a list of (name, description, type, label names,
+        samples) tuples, which can be pickled, merged with snapshots
+        from other processes and rendered.
+
+        """
+        snapshot = []
+        for metric in list(self._metrics):
+            try:
+                samples = metric.samples()
+
+            except Exception as e:
+                self.logger.error('Cannot collect metric %s: %s'
+                                  % (metric.name, e))
+                continue
+
+            snapshot.append((metric.name, metric.description, metric.type,
+                             metric.label_names, samples))
+
+        return snapshot
+
+    def render(self):
+        """
+        Returns every metric in the Prometheus text format.
+        """
+        return render(self.snapshot())
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+
+# The metrics Bulk collects
+registry = Registry()
+
+MESSAGES = registry.counter(
+    'bulk_messages_total', 'Messages received')
+MESSAGE_BYTES = registry.counter(
+    'bulk_message_bytes_total', 'Bytes of message data received')
+ATTACHMENTS = registry.counter(
+    'bulk_attachments_total', 'Attachments found in messages')
+VERDICTS = registry.counter(
+    'bulk_verdicts_total', 'Messages by verdict', ['verdict'])
+STAGE_SECONDS = registry.histogram(
+    'bulk_stage_seconds',
+    'Seconds spent in each stage of handling messages', ['stage'])
+SCAN_SECONDS = registry.histogram(
+    'bulk_scan_seconds',
+    'Seconds each processor spent scanning an attachment', ['processor'])
+
+
+class MetricsServer(object):
+    """
+    Serves metrics over HTTP, from a background thread.
+    """
+
+    def __init__(self, address, registry=registry):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        address -- (host, port) tuple to listen on
+        registry -- the Registry to serve, or anything
+        else with a render method returning the metrics
+
+        """
+        self.logger = logging.getLogger('bulk')
+        self._address = address
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            # Seconds to wait on a slow client
+            timeout = 5
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+
+                body = registry.render()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.getLogger('bulk').debug('Metrics request; %s'
+                                                % (format % args))
+
+        self._server = BaseHTTPServer.HTTPServer(address, Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name='bulk-metrics')
+        self._thread.daemon = True
+
+    def __str__(self):
+        """
+        Pretty way to print the server.
+        """
+        return 'MetricsServer on http://%s:%s/metrics' % self._address
+
+    def start(self):
+        """
+        Start serving metrics.
+        """
+        self._thread.start()
+
+    def fileno(self):
+        """
+        The listening socket, for callers serving requests from their
+        own loop instead of starting the server.
+        """
+        return self._server.fileno()
+
+    def handle_request(self):
+        """
+        Serve a waiting request.
+        """
+        self._server.handle_request()
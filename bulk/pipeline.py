@@ -0,0 +1,253 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import time
+import logging
+
+# Bulk Imports
+from bulk.processors import Result, match_batch
+
+
+class _Stats(object):
+    """
+    What a pipeline has seen of one processor.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.hits = 0
+        # Moving average of seconds per attachment
+        self.seconds = 0.0
+
+    def add(self, elapsed, matched, decay):
+        if self.runs:
+            self.seconds += decay * (elapsed - self.seconds)
+
+        else:
+            self.seconds = elapsed
+
+        self.runs += 1
+        if matched:
+            self.hits += 1
+
+    def rank(self):
+        """
+        Chance of a match per second spent, the higher the sooner the
+        processor runs. Processors never run yet go first, so they
+        get measured.
+        """
+        if not self.runs:
+            return float('inf')
+
+        # Smoothed, so a processor that has not matched yet keeps a chance
+        chance = (self.hits + 1.0) / (self.runs + 2.0)
+        return chance / max(self.seconds, 1e-6)
+
+
+class Pipeline(object):
+    """
+    Runs processors against attachments.
+
+    Every processor is timed, and its cost and how often it matches
+    decide the order processors run in: the ones most likely to match
+    for the time they take go first. With short_circuit on, the
+    pipeline stops scanning a batch as soon as any attachment in it
+    matches, since a batch holds attachments from one message and a
+    single match is enough to decide its verdict. Otherwise every
+    processor runs, for the full list of hits.
+
+    Processors offering match_batch are handed a whole batch of
+    attachments at once.
+    """
+
+    def __init__(self, processors, short_circuit=False, reorder=100,
+                 decay=0.05):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        processors -- list of processors, which may change in place
+        when rules are reloaded
+        short_circuit -- whether to stop scanning a batch at its
+        first match
+        reorder -- attachments to scan between putting the processors
+        in order again
+        decay -- weight of each new timing in a processor's average cost
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._processors = processors
+        self._short_circuit = short_circuit
+        self._reorder = reorder
+        self._decay = decay
+        self._stats = [_Stats() for processor in processors]
+        self._order = range(len(processors))
+        self._scanned = 0
+
+        self.skipped = 0
+
+    def __str__(self):
+        """
+        Pretty way to print the pipeline.
+        """
+        return 'Pipeline of %s; Short circuit: %s; Skipped: %s' % (
+            ', '.join(str(self._processors[i]) for i in self._order),
+            self._short_circuit, self.skipped)
+
+    def match(self, attachment):
+        """
+        Run the processors against an attachment.
+
+        Keyword arguments:
+        attachment -- the message.Attachment to analyze
+
+        Returns the list of processor Results in the order the
+        processors ran, which contains a True Result if any processor
+        matched. With short_circuit on, a True Result is the last one.
+
+        """
+        return self.match_batch([attachment])[0]
+
+    def match_batch(self, attachments):
+        """
+        Run the processors against several attachments, each processor
+        taking every attachment still undecided in one call.
+
+        Keyword arguments:
+        attachments -- list of message.Attachments to analyze
+
+        Returns a list holding the list of processor Results for each
+        attachment, as match would. With short_circuit on, scanning
+        stops after the first processor to match any attachment, so the
+        other attachments may be missing some of their Results, or all
+        of them.
+
+        """
+        verdicts = [[] for attachment in attachments]
+        undecided = range(len(attachments))
+
+        for i in self._order:
+            if not undecided:
+                break
+
+            batch = [attachments[j] for j in undecided]
+            processor = self._processors[i]
+            start = time.time()
+            try:
+                results = match_batch(processor, batch)
+
+            except Exception as e:
+                # One broken processor should not take the others down
+                self.logger.exception('Processor failed: %s' % processor)
+                if len(batch) > 1:
+                    results = self._match_each(processor, batch)
+
+                else:
+                    results = [self._failure(processor, e)]
+
+            # Processors that do not time themselves get a fair share
+            share = (time.time() - start) / len(batch)
+
+            for j, result in zip(undecided, results):
+                if not result.elapsed:
+                    result.elapsed = share
+
+                self._stats[i].add(result.elapsed, result.matched,
+                                   self._decay)
+                verdicts[j].append(result)
+
+            if self._short_circuit and any(verdicts[j][-1]
+                                           for j in undecided):
+                # The message is decided, the rest need not be scanned
+                break
+
+        for verdict in verdicts:
+            self.skipped += len(self._order) - len(verdict)
+
+        before = self._scanned
+        self._scanned += len(attachments)
+        if before // self._reorder != self._scanned // self._reorder:
+            self._sort()
+
+        return verdicts
+
+    def _match_each(self, processor, attachments):
+        """
+        Run a processor against attachments one at a time, after it
+        failed on all of them together, so that only the attachments it
+        fails on are left without a verdict.
+
+        Keyword arguments:
+        processor -- the processor that failed
+        attachments -- list of message.Attachments it failed on
+
+        Returns a list of Results, one for each attachment.
+
+        """
+        results = []
+        for attachment in attachments:
+            try:
+                results.extend(match_batch(processor, [attachment]))
+
+            except Exception as e:
+                self.logger.error('Processor failed: %s; Name: %s; '
+                                  'MD5: %s' % (processor, attachment.name,
+                                               attachment.md5))
+                results.append(self._failure(processor, e))
+
+        return results
+
+    def _failure(self, processor, error):
+        """
+        The Result for an attachment a processor failed on.
+
+        Keyword arguments:
+        processor -- the processor that failed
+        error -- the exception it raised
+
+        """
+        return Result(type(processor).__module__, False,
+                      error='Processor failed: %s' % error, failed=True)
+
+    def stats(self):
+        """
+        Returns a list of (processor, runs, hits, seconds) tuples, in the
+        order the processors run in, seconds being the average cost.
+        """
+        return [(self._processors[i], self._stats[i].runs,
+                 self._stats[i].hits, self._stats[i].seconds)
+                for i in self._order]
+
+    def _sort(self):
+        """
+        Put the processors in order of their chance of a match per
+        second spent.
+        """
+        order = sorted(self._order, key=lambda i: -self._stats[i].rank())
+        if order != self._order:
+            self._order = order
+            self.logger.debug('Processors now run in this order: %s'
+                              % ', '.join(str(self._processors[i])
+                                          for i in order))
@@ -0,0 +1,406 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import socket
+import logging
+import threading
+import multiprocessing
+
+# Bulk Imports
+from bulk import metrics
+
+
+# Not in the socket module before Python 3.3
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+                       15 if sys.platform.startswith('linux') else None)
+
+RESTARTS = metrics.registry.counter(
+    'bulk_worker_restarts_total', 'Worker processes restarted')
+
+# Metrics only the supervisor keeps, which workers inherit a copy of
+SUPERVISOR_METRICS = ('bulk_workers', 'bulk_worker_restarts_total')
+
+
+def listen(address, reuse_port=False, backlog=socket.SOMAXCONN):
+    """
+    Open a listening socket.
+
+    Keyword arguments:
+    address -- (host, port) tuple to listen on
+    reuse_port -- whether to set SO_REUSEPORT, so several processes can
+    each listen on the same port and the kernel spreads the connections
+    between them
+    backlog -- most connections waiting to be accepted
+
+    Returns the socket.
+
+    """
+    if reuse_port and SO_REUSEPORT is None:
+        raise socket.error(errno.ENOPROTOOPT,
+                           'SO_REUSEPORT is not supported here')
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+        sock.bind(address)
+        sock.listen(backlog)
+
+    except socket.error:
+        sock.close()
+        raise
+
+    sock.setblocking(0)
+    return sock
+
+
+class _Reporter(object):
+    """
+    Sends a worker's metrics to the supervisor now and then.
+    """
+
+    def __init__(self, conn, interval):
+        self._conn = conn
+        self._interval = interval
+        self._lock = threading.Lock()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='bulk-reporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def report(self):
+        """
+        Send the metrics now.
+        """
+        snapshot = [metric for metric in metrics.registry.snapshot()
+                    if metric[0] not in SUPERVISOR_METRICS]
+        with self._lock:
+            try:
+                self._conn.send(snapshot)
+
+            except (IOError, OSError):
+                # The supervisor is gone
+                pass
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            self.report()
+
+
+class Supervisor(object):
+    """
+    Runs worker processes and keeps them running.
+
+    Each worker is forked from the supervisor and runs a target
+    function until it is told to stop. A worker that dies is started
+    again, after a delay that doubles every time it dies soon after
+    starting. SIGHUP is passed on to the workers, and SIGTERM or SIGINT
+    stops them all.
+
+    Workers send their metrics to the supervisor, which adds them up.
+    The supervisor can serve the totals in place of its own registry.
+
+    The supervisor runs on a single thread, so workers are never forked
+    while another thread holds a lock they would inherit.
+    """
+
+    # Seconds a worker has to run for to count as having started fine
+    MIN_UPTIME = 5
+    # Most seconds to wait before starting a failing worker again
+    MAX_DELAY = 60
+    # Seconds to wait for workers to stop before killing them
+    STOP_TIMEOUT = 10
+
+    def __init__(self, workers, target, report_interval=5, on_hangup=None):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        workers -- number of worker processes
+        target -- callable run in each worker, taking the worker's index
+        report_interval -- seconds between workers sending their metrics
+        on_hangup -- callable run in the supervisor on SIGHUP, before the
+        signal is passed on to the workers
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._workers = workers
+        self._target = target
+        self._report_interval = report_interval
+        self._on_hangup = on_hangup
+
+        # pid: (index, started, connection)
+        self._children = {}
+        # index: (when to start it, how long it had to wait)
+        self._due = {}
+        self._delays = {}
+
+        # pid: latest metrics, and the totals of workers that exited
+        self._snapshots = {}
+        self._retired = []
+        self._lock = threading.Lock()
+
+        self._stopping = False
+        self._stop_time = None
+        self._hangups = 0
+
+        metrics.registry.callback('bulk_workers', 'Worker processes running',
+                                  lambda: len(self._children))
+
+    def __str__(self):
+        """
+        Pretty way to print the supervisor.
+        """
+        return 'Supervisor of %s worker processes; Running: %s' % (
+            self._workers, len(self._children))
+
+    def render(self):
+        """
+        Returns the metrics of the supervisor and every worker, added
+        up, in the Prometheus text format.
+        """
+        with self._lock:
+            snapshots = self._snapshots.values() + [self._retired]
+
+        return metrics.render(metrics.merge(
+            [metrics.registry.snapshot()] + snapshots))
+
+    def run(self, servers=()):
+        """
+        Start the workers and look after them until told to stop.
+
+        Keyword arguments:
+        servers -- objects with fileno() and handle_request() methods,
+        such as a metrics.MetricsServer that was not started, to serve
+        requests for in between
+
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._hangup)
+
+        for index in xrange(self._workers):
+            self._due[index] = time.time()
+
+        while self._children or not self._stopping:
+            if not self._stopping:
+                self._start_due()
+
+            elif time.time() > self._stop_time:
+                self.logger.warning('Killing %s workers that did not stop'
+                                    % len(self._children))
+                self._signal_all(signal.SIGKILL)
+
+            if self._hangups:
+                self._hangups = 0
+                if self._on_hangup:
+                    self._on_hangup()
+
+                self._signal_all(signal.SIGHUP)
+
+            self._wait(servers, 0.25)
+            self._reap()
+
+        self.logger.info('All workers stopped')
+
+    def _start_due(self):
+        """
+        Start the workers that are due to start.
+        """
+        now = time.time()
+        for index, when in self._due.items():
+            if when <= now:
+                del self._due[index]
+                self._spawn(index)
+
+    def _spawn(self, index):
+        """
+        Fork a worker.
+        """
+        reader, writer = multiprocessing.Pipe(duplex=False)
+
+        pid = os.fork()
+        if pid:
+            writer.close()
+            self._children[pid] = (index, time.time(), reader)
+            self.logger.info('Started worker %s; PID: %s' % (index, pid))
+            return
+
+        # In the worker from here on
+        reader.close()
+        for pid, (_, _, conn) in self._children.items():
+            conn.close()
+
+        self._children = {}
+        # Stop through the usual exit path, so exit handlers run
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        # Until the target sets up its own handling
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        reporter = _Reporter(writer, self._report_interval)
+        try:
+            self._target(index)
+
+        except (SystemExit, KeyboardInterrupt):
+            raise
+
+        except Exception:
+            self.logger.exception('Worker %s failed' % index)
+            sys.exit(1)
+
+        finally:
+            reporter.report()
+
+        sys.exit(0)
+
+    def _wait(self, servers, timeout):
+        """
+        Wait up to timeout seconds for metrics from the workers or
+        requests to the servers, and handle them.
+        """
+        ready = dict((conn.fileno(), (pid, conn)) for pid, (_, _, conn)
+                     in self._children.items() if not conn.closed)
+        ready.update((server.fileno(), (None, server)) for server in servers)
+
+        try:
+            readable, _, _ = select.select(ready.keys(), [], [], timeout)
+
+        except (select.error, OSError) as e:
+            # Interrupted by a signal
+            if e.args[0] != errno.EINTR:
+                raise
+
+            return
+
+        for fd in readable:
+            pid, source = ready[fd]
+            if pid is None:
+                source.handle_request()
+
+            else:
+                self._receive(pid, source)
+
+    def _receive(self, pid, conn):
+        """
+        Read whatever metrics a worker has sent.
+        """
+        try:
+            while conn.poll():
+                snapshot = conn.recv()
+                with self._lock:
+                    self._snapshots[pid] = snapshot
+
+        except (EOFError, IOError):
+            conn.close()
+
+    def _reap(self):
+        """
+        Deal with workers that have exited.
+        """
+        # Only the workers, other children are left to whoever started them
+        for pid in self._children.keys():
+            try:
+                pid, status = os.waitpid(pid, os.WNOHANG)
+
+            except OSError as e:
+                if e.args[0] != errno.ECHILD:
+                    raise
+
+                status = 0
+
+            if not pid:
+                continue
+
+            index, started, conn = self._children.pop(pid)
+
+            # Keep what the worker counted, so totals never go backwards
+            if not conn.closed:
+                self._receive(pid, conn)
+                conn.close()
+
+            with self._lock:
+                snapshot = self._snapshots.pop(pid, [])
+                self._retired = metrics.merge(
+                    [self._retired,
+                     [metric for metric in snapshot if metric[2] != 'gauge']])
+
+            if self._stopping:
+                continue
+
+            if os.WIFSIGNALED(status):
+                how = 'was killed by signal %s' % os.WTERMSIG(status)
+
+            else:
+                how = 'exited with status %s' % os.WEXITSTATUS(status)
+
+            # Back off from workers that keep dying right away
+            delay = 1
+            if time.time() - started < self.MIN_UPTIME:
+                delay = min(self._delays.get(index, 0.5) * 2, self.MAX_DELAY)
+
+            self._delays[index] = delay
+            self._due[index] = time.time() + delay
+            RESTARTS.inc()
+            self.logger.error('Worker %s (PID %s) %s, restarting it in %s '
+                              'seconds' % (index, pid, how, delay))
+
+    def _signal_all(self, signum):
+        """
+        Send a signal to every worker.
+        """
+        for pid in self._children:
+            try:
+                os.kill(pid, signum)
+
+            except OSError:
+                pass
+
+    def _stop(self, signum, frame):
+        """
+        Stop every worker.
+        """
+        if not self._stopping:
+            self.logger.info('Stopping %s workers' % len(self._children))
+            self._stopping = True
+            self._stop_time = time.time() + self.STOP_TIMEOUT
+
+        self._signal_all(signal.SIGTERM)
+
+    def _hangup(self, signum, frame):
+        """
+        Handle SIGHUP, and pass it on to every worker, from the main loop.
+        """
+        self._hangups += 1
@@ -20,3 +20,138 @@
 # LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
 # OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
 # SUCH DAMAGE.
+
+
+class Result(object):
+    """
+    The outcome of a processor looking at an attachment.
+
+    Evaluates as True when the processor found a match, so callers
+    that only care about the verdict can treat it as a boolean.
+    A failed result, from a scan that timed out or crashed, has no
+    verdict of its own: the scan failure policy decides it. Nor has an
+    incomplete one, for an archive that could not be fully unpacked:
+    the unpack failure policy decides that.
+    """
+
+    # Results pickled before failed existed did not fail
+    failed = False
+    # Nor were they incomplete
+    incomplete = False
+    # Digest of the attachment or archive member the result is for,
+    # filled in by the proxy once it has been scanned
+    sha256 = None
+
+    def __init__(self, processor, matched, hits=None, elapsed=0.0,
+                 error=None, failed=False, incomplete=False):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        processor -- name of the processor that produced the result
+        matched -- True if the processor found a match
+        hits -- list of (rule, namespace) tuples that matched
+        elapsed -- seconds the processor took
+        error -- description of what went wrong, if anything did
+        failed -- True if the scan did not finish, so matched
+        says nothing
+        incomplete -- True if part of an archive could not be unpacked,
+        so was never scanned
+
+        """
+        self.processor = processor
+        self.matched = matched
+        self.hits = hits or []
+        self.elapsed = elapsed
+        self.error = error
+        self.failed = failed
+        self.incomplete = incomplete
+
+    def __nonzero__(self):
+        return bool(self.matched)
+
+    def __str__(self):
+        """
+        Pretty way to print a result.
+        """
+        s = 'Processor: %s; Matched: %s; Time: %0.3f ms' % (
+            self.processor, self.matched, self.elapsed * 1000.0)
+
+        if self.hits:
+            s += '; Rules: %s' % ', '.join('%s:%s' % (namespace, rule)
+                                           for rule, namespace in self.hits)
+
+        if self.error:
+            s += '; Error: %s' % self.error
+
+        return s
+
+
+def takes_attachments(processor):
+    """
+    Whether a processor, or processor class, declares that it works with
+    message.Attachments and Results.
+
+    Processors written before Bulk handed them attachments have match
+    take the attachment's contents as a string and return True or False.
+    Processors that take attachments say so by setting the class
+    attribute takes_attachments to True.
+    """
+    return bool(getattr(processor, 'takes_attachments', False))
+
+
+def match_batch(processor, attachments):
+    """
+    Run a processor against several attachments.
+
+    Processors may offer a match_batch method taking a list of
+    attachments, to pay their per-call costs once for all of them.
+    Processors with only match are called once per attachment.
+    Processors that do not take attachments are handed each
+    attachment's contents instead, and whatever they return is turned
+    into a Result.
+
+    Keyword arguments:
+    processor -- the processor to run
+    attachments -- list of message.Attachments to analyze
+
+    Returns a list of Results, one for each attachment.
+
+    """
+    if not takes_attachments(processor):
+        return [_result(processor, processor.match(attachment.content))
+                for attachment in attachments]
+
+    batch = getattr(processor, 'match_batch', None)
+    if batch is not None:
+        results = batch(attachments)
+
+    else:
+        results = [processor.match(attachment) for attachment in attachments]
+
+    return [_result(processor, result) for result in results]
+
+
+def match(processor, attachment):
+    """
+    Run a processor against one attachment.
+
+    Keyword arguments:
+    processor -- the processor to run
+    attachment -- the message.Attachment to analyze
+
+    Returns a Result.
+
+    """
+    return match_batch(processor, [attachment])[0]
+
+
+def _result(processor, value):
+    """
+    The Result for what a processor's match returned, which for older
+    processors is a plain True or False.
+    """
+    if isinstance(value, Result):
+        return value
+
+    return Result(type(processor).__module__, bool(value))
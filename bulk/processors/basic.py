@@ -23,14 +23,20 @@
 
 import logging
 
+# Bulk Imports
+from bulk.processors import Result
+
 
 class Processor(object):
 
-    def __init__(self, rule_files=None):
+    # match is handed message.Attachments and returns Results
+    takes_attachments = True
+
+    def __init__(self, rule_files=None, **options):
         """
         Default initializer.
 
-        Sets up logging and rules.
+        Sets up logging and rules. This processor has no options.
 
         """
         # Handle logger
@@ -47,12 +53,29 @@ class Processor(object):
 
         return s
 
-    def match(self, data):
+    def match(self, attachment):
+        """
+        Processor consumes an attachment and analyzes it for matches
+        against rules.
+
+        Keyword arguments:
+        attachment -- message.Attachment to analyze
+
+        Returns a Result, which is True upon match.
+
         """
-        Processor consumes data and analyzes it for matches against rules.
+        self.logger.info('Always returning true in this basic processor!')
+        return Result(__name__, True)
+
+    def match_batch(self, attachments):
+        """
+        Analyze several attachments at once.
+
+        Keyword arguments:
+        attachments -- list of message.Attachments to analyze
 
-        Returns True upon match.
+        Returns a list of Results, one for each attachment.
 
         """
         self.logger.info('Always returning true in this basic processor!')
-        return True
+        return [Result(__name__, True) for attachment in attachments]
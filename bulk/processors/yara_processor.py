@@ -22,12 +22,67 @@
 # SUCH DAMAGE.
 
 # Standard Imports
-import logging
+import os
+import time
+import uuid
+import math
 import hashlib
+import logging
+import tempfile
+import multiprocessing
 
 # Libary Imports
 import yara
 
+# Bulk Imports
+from bulk import profiler
+from bulk.processors import Result
+from bulk.helpers import make_directory, rule_sources
+
+
+def rules_key(rule_files, options):
+    """
+    Key a set of rule files and the options they are compiled with.
+
+    Keyword arguments:
+    rule_files -- dictionary of namespaces:/path/to/file
+    options -- dictionary of keyword arguments to yara.compile
+
+    The key covers the yara version, each namespace and path, the
+    contents of every rule file and of the files they include, and the
+    compiler options, so it changes whenever any of them would change
+    the compiled rules.
+
+    Returns a hex digest.
+
+    """
+    digest = hashlib.sha256()
+    digest.update(yara.__version__)
+    digest.update(repr(sorted(options.items())))
+
+    for namespace in sorted(rule_files):
+        digest.update(namespace)
+
+        for path, source in rule_sources(rule_files[namespace],
+                                         options.get('includes', True)):
+            digest.update(path)
+            digest.update(source)
+
+    return digest.hexdigest()
+
+
+def _compile(rule_files, options, path):
+    """
+    Compile rule files and save the compiled rules.
+
+    Keyword arguments:
+    rule_files -- dictionary of namespaces:/path/to/file
+    options -- dictionary of keyword arguments to yara.compile
+    path -- file to save the compiled rules to
+
+    """
+    yara.compile(filepaths=rule_files, **options).save(path)
+
 
 class Processor(object):
     """
@@ -38,24 +93,47 @@ class Processor(object):
     extra analysis needs (metrics, reporting, etc)).
     """
 
-    def __init__(self, rule_files):
+    # match is handed message.Attachments and returns Results
+    takes_attachments = True
+
+    def __init__(self, rule_files, cache_directory=None,
+                 profile_directory=None, profile_rate=0.01, scan_timeout=0,
+                 **options):
         """
         Default initializer.
 
         Keyword arguments:
         rules -- dictionary of namespaces:/path/to/file
+        cache_directory -- directory to keep compiled rules in, so they
+        are only compiled again when the rule files change
+        profile_directory -- directory to keep a sample of the scanned
+        attachments in, for the rules to be profiled over
+        profile_rate -- share of the scanned attachments to sample
+        scan_timeout -- seconds yara may spend on an attachment before
+        giving up, 0 for no limit
+        options -- other processor options, not used by this processor
 
         """
         # Handle logger
         self.logger = logging.getLogger('bulk')
 
         self._rule_files = rule_files
+        self._cache_directory = cache_directory
+        self._compile_options = {'includes': True}
         self._rules = None
+        # yara only takes whole seconds
+        self._match_options = {}
+        if scan_timeout:
+            self._match_options['timeout'] = int(math.ceil(scan_timeout))
+
+        self._sampler = None
+        if profile_directory:
+            self._sampler = profiler.Sampler(profile_directory, profile_rate)
 
         # Try to load the rules into yara
         try:
             self.logger.debug('Loading rules into yara: %s' % self._rule_files)
-            self._rules = yara.compile(filepaths=self._rule_files)
+            self._rules = self._load()
 
         except yara.Error as e:
             self.logger.error('Cannot find rules file: %s, \
@@ -72,26 +150,240 @@ class Processor(object):
 
         return s
 
-    def match(self, data):
+    def load_rules(self):
+        """
+        Compile the rule files again without touching the rules in use.
+
+        The rules are compiled in another process, so this can run on a
+        background thread without holding up scanning.
+
+        Returns the compiled rules, to be handed to use_rules.
+
+        """
+        return self._load(isolated=True)
+
+    def use_rules(self, rules):
+        """
+        Start scanning with rules returned by load_rules.
+
+        Keyword arguments:
+        rules -- the compiled yara rules
+
+        Scans already running finish with the rules they started with.
+
+        """
+        self._rules = rules
+
+    def profile(self, paths, isolated=False, **settings):
+        """
+        Work out which rules take the most scanning time.
+
+        Keyword arguments:
+        paths -- list of sample files to scan
+        isolated -- whether to profile in another process, so
+        compiling the rule subsets does not hold up scanning
+        settings -- profiler.RuleProfiler keyword arguments
+
+        Returns a list of profiler.RuleCosts, slowest first.
+
+        """
+        args = (self._rule_files, self._compile_options, paths)
+        if not isolated:
+            return profiler.profile(*args, **settings)
+
+        pool = multiprocessing.Pool(1)
+        try:
+            return pool.apply(profiler.profile, args, settings)
+
+        finally:
+            pool.close()
+            pool.join()
+
+    def _cache_path(self):
+        """
+        Returns where the compiled rules are cached, or None.
+        """
+        if not self._cache_directory:
+            return None
+
+        try:
+            key = rules_key(self._rule_files, self._compile_options)
+
+        except IOError:
+            # Let yara complain about the missing file
+            return None
+
+        return os.path.join(self._cache_directory, key + '.yarc')
+
+    def _load(self, isolated=False):
+        """
+        Load the compiled rules from the cache, compiling and
+        caching them when they are not there.
+
+        Keyword arguments:
+        isolated -- whether to compile in another process
+
+        Returns the compiled yara rules.
+
+        """
+        path = self._cache_path()
+        if path and os.path.exists(path):
+            try:
+                rules = yara.load(path)
+                self.logger.debug('Loaded compiled rules from %s' % path)
+                return rules
+
+            except yara.Error as e:
+                self.logger.warning('Cannot load compiled rules from %s, '
+                                    'compiling them again: %s' % (path, e))
+
+        start = time.time()
+        if isolated:
+            rules = self._compile_isolated(path)
+
+        else:
+            rules = yara.compile(filepaths=self._rule_files,
+                                 **self._compile_options)
+            if path:
+                self._save(rules, path)
+
+        self.logger.info('Compiled rules in %0.3f s: %s'
+                         % (time.time() - start,
+                            ' '.join(self._rule_files.values())))
+
+        return rules
+
+    def _compile_isolated(self, path=None):
+        """
+        Compile the rules in another process.
+
+        yara holds the interpreter lock while it parses rules, but not
+        while it loads compiled ones, so the rules are compiled and saved
+        by a worker process and loaded back here.
+
+        Keyword arguments:
+        path -- where to cache the compiled rules, if anywhere
+
+        Returns the compiled yara rules.
+
+        """
+        if path:
+            make_directory(self._cache_directory)
+            tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+
+        else:
+            fd, tmp = tempfile.mkstemp(suffix='.yarc')
+            os.close(fd)
+
+        pool = multiprocessing.Pool(1)
+        try:
+            pool.apply(_compile, (self._rule_files, self._compile_options,
+                                  tmp))
+            rules = yara.load(tmp)
+            if path:
+                os.rename(tmp, path)
+
+        finally:
+            pool.close()
+            pool.join()
+
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        return rules
+
+    def _save(self, rules, path):
         """
-        Run yara against a blob of data and True or False
-        based on whether a match was found.
+        Cache compiled rules.
 
         Keyword arguments:
-        data -- blob of data to analyze
+        rules -- the compiled yara rules
+        path -- file to cache them in
+
+        """
+        # Only ever show complete files under the cached name
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            make_directory(self._cache_directory)
+            rules.save(tmp)
+            os.rename(tmp, path)
+
+        except (yara.Error, IOError, OSError) as e:
+            self.logger.warning('Cannot cache compiled rules in %s: %s'
+                                % (self._cache_directory, e))
 
-        Returns True or False.
+            if os.path.exists(tmp):
+                os.remove(tmp)
 
+    def match(self, attachment):
         """
-        self.logger.debug('Running yara against data')
-        malicious = self._rules.match(data=data)
-        md5 = hashlib.md5(data).hexdigest()
-        if malicious:
+        Run yara against an attachment and report whether
+        a match was found.
+
+        Keyword arguments:
+        attachment -- message.Attachment to analyze
+
+        Returns a Result, which is True when a match was found.
+
+        """
+        return self.match_batch([attachment])[0]
+
+    def match_batch(self, attachments):
+        """
+        Run yara against several attachments.
+
+        Keyword arguments:
+        attachments -- list of message.Attachments to analyze
+
+        yara has no call that scans several inputs, so each attachment
+        is still matched on its own and costs what it would through
+        match. A batch only shares the lookup of the rules, which keeps
+        it on one set of rules across a reload, and its debug logging.
+
+        Returns a list of Results, one for each attachment, each
+        True when a match was found.
+
+        """
+        self.logger.debug('Running yara against %s attachments'
+                          % len(attachments))
+        # The whole batch is scanned with the same rules,
+        # even if they are reloaded meanwhile
+        rules = self._rules
+        results = []
+        for attachment in attachments:
+            start = time.time()
+            try:
+                if attachment.path:
+                    # Large attachments are kept in a file, which yara maps
+                    malicious = rules.match(filepath=attachment.path,
+                                            **self._match_options)
+
+                else:
+                    malicious = rules.match(data=attachment.content,
+                                            **self._match_options)
+
+            except yara.Error as e:
+                # Timeouts included, the scan policy decides these
+                elapsed = time.time() - start
+                self.logger.error('Cannot scan attachment; MD5: %s; '
+                                  'Error: %s' % (attachment.md5, e))
+                results.append(Result(__name__, False, elapsed=elapsed,
+                                      error=str(e) or 'Scan timed out',
+                                      failed=True))
+                continue
+
+            elapsed = time.time() - start
+
+            hits = []
             for match in malicious:
                 self.logger.info('Match found; Rule: \'%s\';'
                                  'Namespace: \'%s\'; MD5: %s' %
-                                 (match.rule, match.namespace, md5))
+                                 (match.rule, match.namespace, attachment.md5))
+                hits.append((match.rule, match.namespace))
+
+            if self._sampler:
+                self._sampler.offer(attachment)
 
-            return True
+            results.append(Result(__name__, bool(hits), hits, elapsed))
 
-        return False
+        return results
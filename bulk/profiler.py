@@ -0,0 +1,612 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import re
+import time
+import uuid
+import random
+import shutil
+import logging
+import tempfile
+import threading
+import collections
+
+# Optional Imports, only rule profiling needs yara
+try:
+    import yara
+
+except ImportError:
+    yara = None
+
+# Bulk Imports
+from bulk.helpers import INCLUDE, make_directory
+
+
+# Matches the head of a rule, with any modifiers, at the end of a stretch
+# of source leading up to the rule's opening brace
+RULE_HEAD = re.compile(r'((?:\b(?:private|global)\s+)*)\brule\s+(\w+)[^{]*$')
+
+# Matches identifiers that could name another rule
+IDENTIFIER = re.compile(r'(?<![$#@!\w])([A-Za-z_]\w*)')
+
+# A rule that never matches, to time what scanning costs with no rules
+BASELINE = 'rule bulk_profile_baseline { condition: false }'
+
+# How much scanning time rules took
+RuleCost = collections.namedtuple('RuleCost',
+                                  'namespace rules seconds matches')
+
+
+def _mask(source):
+    """
+    Blank out the comments, and the insides of strings and regular
+    expressions, in rule source.
+
+    Keyword arguments:
+    source -- yara rule source
+
+    Returns a string as long as source, so offsets into one are
+    offsets into the other, with only the rule structure left.
+
+    """
+    out = list(source)
+    i = 0
+    n = len(source)
+
+    def blank(start, end):
+        for k in xrange(start, end):
+            if out[k] != '\n':
+                out[k] = ' '
+
+    while i < n:
+        c = source[i]
+        if source.startswith('//', i):
+            end = source.find('\n', i)
+            end = n if end < 0 else end
+            blank(i, end)
+            i = end
+            continue
+
+        if source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            end = n if end < 0 else end + 2
+            blank(i, end)
+            i = end
+            continue
+
+        # yara divides with a backslash, so a slash starts a regex
+        if c in '"/':
+            end = i + 1
+            while end < n and source[end] != c:
+                if source[end] == '\\':
+                    end += 1
+
+                end += 1
+
+            blank(i + 1, min(end, n))
+            i = end + 1
+            continue
+
+        i += 1
+
+    return ''.join(out)
+
+
+def split_rules(source):
+    """
+    Split yara rule source into its rules.
+
+    Keyword arguments:
+    source -- yara rule source
+
+    Returns a (header, rules) tuple, where header holds the source's
+    import and include statements and rules is a list of (name, text,
+    is_global, dependencies) tuples in source order, dependencies being
+    the names of the other rules the rule refers to. Included files are
+    not split, their rules come along with the header.
+
+    """
+    masked = _mask(source)
+    header = []
+    found = []
+    start = 0
+    depth = 0
+    head = None
+    for i, c in enumerate(masked):
+        if c == '{':
+            if depth == 0:
+                head = RULE_HEAD.search(masked, start, i)
+                if head is None:
+                    raise ValueError('Cannot find the rule opened at '
+                                     'offset %s' % i)
+
+                header.append(source[start:head.start()])
+
+            depth += 1
+
+        elif c == '}' and depth:
+            depth -= 1
+            if depth == 0:
+                found.append((head.group(2), head.start(), i + 1,
+                              'global' in head.group(1)))
+                start = i + 1
+
+    names = set(name for name, _, _, _ in found)
+
+    rules = []
+    for name, begin, end, is_global in found:
+        body = masked[masked.index('{', begin):end]
+        dependencies = set(IDENTIFIER.findall(body)) & names - set([name])
+        rules.append((name, source[begin:end], is_global, dependencies))
+
+    # Only the import and include statements are needed in front of
+    # every subset
+    statements = [line.strip() for line in ''.join(header).splitlines()
+                  if line.strip().startswith(('import ', 'include '))]
+
+    return '\n'.join(statements), rules
+
+
+class RuleProfiler(object):
+    """
+    Attributes yara scanning time to rules.
+
+    A compiled rule set is scanned as a whole, so the time a single rule
+    takes cannot be measured directly. Instead each namespace is compiled
+    and timed on its own over a set of sample files, and the namespaces
+    that take a noticeable share of the time are split in half, compiled
+    and timed again, until the slow rules are timed on their own. A rule
+    that refers to other rules is always compiled with them, so their
+    time is counted in with its own. Subsets of a file that includes
+    others are compiled from a temporary file next to it, so the
+    includes resolve, and the time the included rules take on their
+    own is not counted against the subsets.
+    """
+
+    def __init__(self, rule_files, options=None, resolution=0.05,
+                 repeat=1, timeout=60):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        rule_files -- dictionary of namespaces:/path/to/file
+        options -- dictionary of keyword arguments to yara.compile
+        resolution -- share of the total time below which a set of
+        rules is not split any further
+        repeat -- times to scan each sample, keeping the fastest
+        timeout -- seconds before yara gives up on a scan
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._rule_files = rule_files
+        self._options = options or {}
+        self._resolution = resolution
+        self._repeat = repeat
+        self._timeout = timeout
+
+    def profile(self, paths):
+        """
+        Time the rules over a set of sample files.
+
+        Keyword arguments:
+        paths -- list of sample files to scan
+
+        Returns a list of RuleCosts, slowest first. Each one holds the
+        scanning time, less what scanning costs with no rules at all,
+        and the number of matches of a rule or of a set of rules that
+        were not worth splitting.
+
+        """
+        baseline, _ = self._time(yara.compile(source=BASELINE), paths)
+
+        costs = []
+        measured = []
+        for namespace in sorted(self._rule_files):
+            path = self._rule_files[namespace]
+            rules = yara.compile(filepaths={namespace: path},
+                                 **self._options)
+            seconds, matches = self._time(rules, paths)
+            measured.append((namespace, max(0.0, seconds - baseline),
+                             matches))
+
+        total = sum(seconds for _, seconds, _ in measured)
+        for namespace, seconds, matches in measured:
+            costs.extend(self._bisect(namespace, seconds, matches,
+                                      baseline, total, paths))
+
+        costs.sort(key=lambda cost: cost.seconds, reverse=True)
+        return costs
+
+    def _bisect(self, namespace, seconds, matches, baseline, total, paths):
+        """
+        Split a namespace's rules until the slow ones are timed alone.
+
+        Returns a list of RuleCosts for the namespace.
+
+        """
+        try:
+            with open(self._rule_files[namespace], 'rb') as f:
+                split = split_rules(f.read())
+
+        except ValueError as e:
+            self.logger.warning('Cannot split rules in %s: %s'
+                                % (namespace, e))
+            split = None
+
+        if split is None or len(split[1]) < 2 or \
+                seconds < self._resolution * total:
+            return [RuleCost(namespace, None, seconds,
+                             sum(matches.values()))]
+
+        header, rules = split
+        path = self._rule_files[namespace]
+        if INCLUDE.search(_mask(header)):
+            # Every subset carries the included rules along
+            try:
+                elapsed, _ = self._time(self._compile(namespace, path,
+                                                      header), paths)
+                baseline = max(baseline, elapsed)
+
+            except (yara.Error, IOError, OSError) as e:
+                self.logger.warning('Cannot split rules in %s: %s'
+                                    % (namespace, e))
+                return [RuleCost(namespace, None, seconds,
+                                 sum(matches.values()))]
+
+        costs = []
+        pending = [([rule[0] for rule in rules], seconds)]
+        while pending:
+            names, seconds = pending.pop()
+            if len(names) < 2 or seconds < self._resolution * total:
+                costs.append(RuleCost(namespace, tuple(names), seconds,
+                                      sum(matches.get(name, 0)
+                                          for name in names)))
+                continue
+
+            try:
+                halves = []
+                for half in (names[:len(names) // 2],
+                             names[len(names) // 2:]):
+                    compiled = self._compile(namespace, path,
+                                             self._subset(header, rules,
+                                                          half))
+                    elapsed, _ = self._time(compiled, paths)
+                    halves.append((half, max(0.0, elapsed - baseline)))
+
+            except (yara.Error, IOError, OSError) as e:
+                # Whatever the splitter missed, time these rules together
+                self.logger.warning('Cannot split rules in %s: %s'
+                                    % (namespace, e))
+                costs.append(RuleCost(namespace, tuple(names), seconds,
+                                      sum(matches.get(name, 0)
+                                          for name in names)))
+                continue
+
+            pending.extend(halves)
+
+        return costs
+
+    def _compile(self, namespace, path, source):
+        """
+        Compile source taken from a namespace's rule file, with the same
+        options as the file itself.
+
+        Keyword arguments:
+        namespace -- the namespace to compile the source into
+        path -- the rule file the source came from
+        source -- yara rule source
+
+        Source that includes other files is written to a temporary file
+        next to the rule file, which yara resolves the includes against.
+
+        Returns the compiled rules.
+
+        """
+        if not INCLUDE.search(_mask(source)):
+            return yara.compile(sources={namespace: source}, **self._options)
+
+        fd, tmp = tempfile.mkstemp(prefix='.bulk-profile-', suffix='.yar',
+                                   dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(source)
+
+            return yara.compile(filepaths={namespace: tmp}, **self._options)
+
+        finally:
+            os.remove(tmp)
+
+    def _subset(self, header, rules, names):
+        """
+        Returns source for some of a namespace's rules, along with the
+        rules they refer to and the namespace's global rules.
+        """
+        dependencies = dict((rule[0], rule[3]) for rule in rules)
+
+        wanted = set(names)
+        wanted.update(rule[0] for rule in rules if rule[2])
+        pending = list(wanted)
+        while pending:
+            for name in dependencies[pending.pop()] - wanted:
+                wanted.add(name)
+                pending.append(name)
+
+        return '\n\n'.join([header] + [rule[1] for rule in rules
+                                       if rule[0] in wanted])
+
+    def _time(self, rules, paths):
+        """
+        Scan the samples with compiled rules.
+
+        Returns the seconds it took and a dictionary of rule:matches.
+
+        """
+        seconds = 0.0
+        matches = collections.defaultdict(int)
+        for path in paths:
+            fastest = None
+            for i in xrange(self._repeat):
+                start = time.time()
+                try:
+                    hits = rules.match(filepath=path, timeout=self._timeout)
+
+                except yara.Error as e:
+                    self.logger.warning('Cannot scan %s: %s' % (path, e))
+                    hits = []
+
+                elapsed = time.time() - start
+                if fastest is None or elapsed < fastest:
+                    fastest = elapsed
+
+            seconds += fastest
+            for hit in hits:
+                matches[hit.rule] += 1
+
+        return seconds, matches
+
+
+def profile(rule_files, options, paths, **settings):
+    """
+    Profile rule files over sample files.
+
+    Keyword arguments:
+    rule_files -- dictionary of namespaces:/path/to/file
+    options -- dictionary of keyword arguments to yara.compile
+    paths -- list of sample files to scan
+    settings -- other RuleProfiler keyword arguments
+
+    Returns a list of RuleCosts, slowest first.
+
+    """
+    return RuleProfiler(rule_files, options, **settings).profile(paths)
+
+
+def sample_paths(directory):
+    """
+    List the sample files in a directory and the directories below it.
+
+    Keyword arguments:
+    directory -- the directory path
+
+    Returns a sorted list of paths.
+
+    """
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        paths.extend(os.path.join(root, fn) for fn in files
+                     if not fn.endswith('.tmp'))
+
+    return sorted(paths)
+
+
+def format_report(costs, samples):
+    """
+    Rank rules by the scanning time they took.
+
+    Keyword arguments:
+    costs -- list of RuleCosts, slowest first
+    samples -- number of samples the costs were measured over
+
+    Returns the report as a string.
+
+    """
+    total = sum(cost.seconds for cost in costs)
+    lines = ['Rule profile over %s samples; %.3f s of scanning'
+             % (samples, total),
+             '%10s %7s %8s  %s' % ('Seconds', 'Share', 'Matches', 'Rules')]
+
+    for cost in costs:
+        if cost.rules is None:
+            rules = '%s (whole namespace)' % cost.namespace
+
+        else:
+            rules = ', '.join('%s:%s' % (cost.namespace, rule)
+                              for rule in cost.rules)
+
+        share = cost.seconds / total * 100 if total else 0.0
+        lines.append('%10.4f %6.1f%% %8s  %s'
+                     % (cost.seconds, share, cost.matches, rules))
+
+    return '\n'.join(lines) + '\n'
+
+
+class Sampler(object):
+    """
+    Keeps copies of a random sample of the attachments scanned, for
+    rules to be profiled over.
+    """
+
+    def __init__(self, directory, rate=0.01, limit=1000):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        directory -- directory to keep the samples in
+        rate -- share of the attachments to sample
+        limit -- most samples to keep; once there are that many, each
+        new sample replaces one at random
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._directory = directory
+        self._rate = rate
+        self._limit = limit
+
+        make_directory(directory)
+
+    def __str__(self):
+        """
+        Pretty way to print the sampler.
+        """
+        return 'Sampler keeping %.2f%% of attachments, up to %s, in %s' % (
+            self._rate * 100, self._limit, self._directory)
+
+    def offer(self, attachment):
+        """
+        Keep a copy of an attachment, if it is picked.
+
+        Keyword arguments:
+        attachment -- message.Attachment that was scanned
+
+        """
+        if random.random() >= self._rate:
+            return
+
+        path = os.path.join(self._directory, attachment.sha256)
+        if os.path.exists(path):
+            return
+
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        try:
+            samples = sample_paths(self._directory)
+            if len(samples) >= self._limit:
+                os.remove(random.choice(samples))
+
+            source = attachment.open()
+            try:
+                with open(tmp, 'wb') as f:
+                    shutil.copyfileobj(source, f)
+
+            finally:
+                source.close()
+
+            os.rename(tmp, path)
+
+        except (IOError, OSError) as e:
+            self.logger.warning('Cannot keep a sample in %s: %s'
+                                % (self._directory, e))
+
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+
+class ProfileRunner(object):
+    """
+    Profiles the rules of the processors in use over the sampled
+    attachments from time to time, on a background thread.
+    """
+
+    def __init__(self, processors, directory, interval=3600):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        processors -- processors to profile; those without a
+        profile method are left out
+        directory -- directory the samples are kept in, under samples/,
+        and the report is written to, as report.txt
+        interval -- seconds between profiles
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._processors = [p for p in processors if hasattr(p, 'profile')]
+        self._directory = directory
+        self._interval = interval
+        self._stop = threading.Event()
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='bulk-profiler')
+        self._thread.daemon = True
+
+    def __str__(self):
+        """
+        Pretty way to print the runner.
+        """
+        return 'ProfileRunner reporting every %s seconds to %s' % (
+            self._interval, os.path.join(self._directory, 'report.txt'))
+
+    def start(self):
+        """
+        Start profiling.
+        """
+        self._thread.start()
+
+    def close(self):
+        """
+        Stop profiling.
+        """
+        self._stop.set()
+
+    def run(self):
+        """
+        Profile the rules now and write the report.
+        """
+        paths = sample_paths(os.path.join(self._directory, 'samples'))
+        if not paths or not self._processors:
+            return
+
+        costs = []
+        start = time.time()
+        for p in self._processors:
+            costs.extend(p.profile(paths, isolated=True))
+
+        costs.sort(key=lambda cost: cost.seconds, reverse=True)
+        report = format_report(costs, len(paths))
+
+        path = os.path.join(self._directory, 'report.txt')
+        tmp = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+        with open(tmp, 'w') as f:
+            f.write(report)
+
+        os.rename(tmp, path)
+
+        self.logger.info('Profiled rules over %s samples in %0.3f s; '
+                         'Slowest: %s' % (len(paths), time.time() - start,
+                                          report.splitlines()[2].strip()
+                                          if costs else 'none'))
+
+    def _run(self):
+        """
+        Profiler thread main loop.
+        """
+        while not self._stop.wait(self._interval):
+            try:
+                self.run()
+
+            except Exception as e:
+                self.logger.error('Cannot profile rules: %s' % e)
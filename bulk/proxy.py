@@ -22,12 +22,22 @@
 # SUCH DAMAGE.
 
 # Standard Imports
+import os
+import time
 import smtpd
 import logging
-import hashlib
+import asyncore
+import tempfile
 
 # Bulk Imports
 from bulk import message
+from bulk import metrics
+from bulk.channel import BulkChannel
+from bulk.scanner import Pending, gather
+from bulk.stream import MessageStream
+from bulk.store import AttachmentStore
+from bulk.pipeline import Pipeline
+from bulk.processors import Result
 
 
 class BulkProxy(smtpd.PureProxy):
@@ -50,6 +60,10 @@ class BulkProxy(smtpd.PureProxy):
         # Processors is a handle to the active analysis engine
         # Currently only one is supported
         self._processors = processors
+        # Runs the processors cheapest and likeliest to match first,
+        # stopping at a message's first match if short_circuit is set
+        self._short_circuit = kwargs.get('short_circuit', False)
+        self._pipeline = Pipeline(processors, self._short_circuit)
 
         # Optional keyword arguments
         self._basedir = kwargs.get('base_directory', '/tmp/')
@@ -65,11 +79,165 @@ class BulkProxy(smtpd.PureProxy):
         self._quarantine_directory = self._basedir + 'quarantine/'
         self._message_directory = self._basedir + 'messages/'
         self._attachment_directory = self._basedir + 'attachments/'
+        # Optional pool of scanning processes, otherwise
+        # processors run inline on the asyncore loop
+        self._engine = kwargs.get('scan_engine', None)
+        # Optional callable running blocking calls, such as delivery,
+        # off the event loop, returning a scanner.Pending result for
+        # what they return. Otherwise they are made right away
+        self._defer_call = kwargs.get('defer', None)
+        # Optional cache of verdicts for attachments we have seen before
+        self._cache = kwargs.get('verdict_cache', None)
+        # Optional pool of persistent connections to the upstream MTA
+        self._upstream = kwargs.get('upstream_pool', None)
+        # Optional on-disk spool that delivers in the background
+        self._spool = kwargs.get('spool', None)
+        # Optional background writer for messages and attachments
+        self._writer = kwargs.get('writer', None)
+        self._store = AttachmentStore(self._attachment_directory,
+                                      self._writer)
+        # Optional indexed record of verdicts and sightings
+        self._events = kwargs.get('event_store', None)
+        # Optional unpacker, so archive members are scanned too
+        self._unpacker = kwargs.get('unpacker', None)
+        # Larger attachments are decoded into temporary files
+        self._memory_limit = kwargs.get('memory_scan_limit', 0)
+        # Attachments larger than this are handled by the oversize policy,
+        # one of 'skip', 'headtail' or 'quarantine'
+        self._max_scan_size = kwargs.get('max_scan_size', 0)
+        self._oversize_policy = kwargs.get('oversize_policy', 'headtail')
+        # What a scan that timed out or crashed counts as, one of
+        # 'quarantine', 'tempfail' or 'pass'
+        self._failure_verdict = kwargs.get('scan_failure_verdict',
+                                           'quarantine')
+        # What an archive that could not be fully unpacked counts as,
+        # one of 'quarantine', 'tempfail' or 'pass'
+        self._unpack_failure_verdict = kwargs.get('unpack_failure_verdict',
+                                                  'pass')
+        # Largest message accepted, advertised to clients with SIZE
+        self.max_message_size = kwargs.get('max_message_size', 0)
+        # Optional limits on connections and work in progress
+        self.admission = kwargs.get('admission_control', None)
 
-        # Call the base class
-        smtpd.PureProxy.__init__(self, localaddress, remoteaddress)
+        self._register_metrics()
+
+        # Optional listening socket made elsewhere, such as one
+        # shared by several worker processes
+        listen_socket = kwargs.get('listen_socket', None)
+        # Another front end, such as aio.SMTPServer, can accept the
+        # connections instead of the asyncore loop
+        if not kwargs.get('listen', True):
+            self._localaddr = localaddress
+            self._remoteaddr = remoteaddress
+            asyncore.dispatcher.__init__(self)
+
+        elif listen_socket is None:
+            # Call the base class
+            smtpd.PureProxy.__init__(self, localaddress, remoteaddress)
+
+        else:
+            self._localaddr = localaddress
+            self._remoteaddr = remoteaddress
+            asyncore.dispatcher.__init__(self, listen_socket)
+            self.accepting = True
+
+    def _register_metrics(self):
+        """
+        Expose the queue depths and counters of the components
+        in use as metrics.
+        """
+        registry = metrics.registry
+
+        if self._engine:
+            registry.callback('bulk_scan_queue_depth',
+                              'Attachment scans waiting for a verdict',
+                              lambda: self._engine.pending)
+
+        if self._writer:
+            registry.callback('bulk_writer_queue_depth',
+                              'Writes waiting for the background writer',
+                              lambda: self._writer.depth)
+            registry.callback('bulk_writer_stalls_total',
+                              'Times mail processing waited on the disk',
+                              lambda: self._writer.stalls, 'counter')
+            registry.callback('bulk_writer_lost_total',
+                              'Writes lost to errors in the background '
+                              'writer',
+                              lambda: self._writer.lost, 'counter')
+
+        if self._spool:
+            registry.callback('bulk_spool_queue_depth',
+                              'Messages waiting in the delivery spool',
+                              lambda: self._spool.stats()[0])
+            registry.callback('bulk_spool_oldest_seconds',
+                              'Age of the oldest message in the spool',
+                              lambda: self._spool.stats()[1])
+
+        if self._events is not None:
+            registry.callback('bulk_event_queue_depth',
+                              'Events waiting to be recorded',
+                              lambda: self._events.depth)
+
+        if self._cache is not None:
+            registry.callback('bulk_verdict_cache_entries',
+                              'Verdicts in the verdict cache',
+                              lambda: len(self._cache))
+            registry.callback('bulk_verdict_cache_hits_total',
+                              'Verdicts found in the verdict cache',
+                              lambda: self._cache.hits, 'counter')
+            registry.callback('bulk_verdict_cache_misses_total',
+                              'Verdicts not found in the verdict cache',
+                              lambda: self._cache.misses, 'counter')
+
+    def handle_accept(self):
+        """
+        Accept a client connection on a BulkChannel.
+        """
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            BulkChannel(self, conn, addr)
+
+    def begin_message(self, peer, mailfrom, rcpttos):
+        """
+        Called by the channel when a client starts sending message data.
+
+        Keyword arguments:
+        peer -- tuple containing (ipaddr, port) of the client
+        mailfrom -- raw address the client claims the message is coming from
+        rcpttos -- list of raw addresses the client wishes to deliver to
+
+        Returns a stream.MessageStream to feed the raw data into. Each
+        attachment starts scanning as soon as its part has arrived. With
+        short_circuit on, attachments arriving after one has matched are
+        not scanned at all.
 
-    def process_message(self, peer, mailfrom, rcpttos, data):
+        """
+        # Set once an attachment of this message has matched
+        decided = [False]
+
+        def decide(verdicts):
+            if any(any(results) for results in verdicts):
+                decided[0] = True
+
+        def found(attachment):
+            if decided[0]:
+                self.logger.info('Not scanning attachment, the message '
+                                 'already matched; Name: %s'
+                                 % attachment.name)
+                done = Pending()
+                done.fire([[self._not_scanned()]])
+                return done
+
+            scan = self.scan_attachments(mailfrom, rcpttos, [attachment])
+            if self._short_circuit:
+                scan.add_callback(decide)
+
+            return scan
+
+        return MessageStream(found, self._memory_limit)
+
+    def process_message(self, peer, mailfrom, rcpttos, data, stream=None):
         """
         process_message is called once per incoming message/email.
 
@@ -89,66 +257,488 @@ class BulkProxy(smtpd.PureProxy):
         containing a `.' followed by other text has had the leading dot
         removed.
 
+        stream -- the closed stream.MessageStream from begin_message the
+        message was received through, if any.
+
         Messages are handed over to a 'processor(s)' which uses yara or
         another engine to analyze the email attachments.
+
+        Returns the result of finish_message, or a scanner.Pending result
+        for it when attachments are being scanned by a ScanEngine or
+        delivery is deferred.
         """
         # Do some logging
         self.logger.info('Messaged received; From: %s; To: %s'
                          % (str(mailfrom), str(rcpttos)))
 
-        msg = message.Message(peer, mailfrom, rcpttos, data)
+        metrics.MESSAGES.inc()
+        metrics.MESSAGE_BYTES.inc(len(data))
+
+        if stream is None:
+            start = time.time()
+            msg = message.Message(peer, mailfrom, rcpttos, data,
+                                  memory_limit=self._memory_limit)
+            # Pull the attachments out of the message
+            attachments = msg.get_attachments()
+            metrics.STAGE_SECONDS.labels('parse').observe(time.time() - start)
+
+            scans = [self.scan_attachments(mailfrom, rcpttos, attachments)]
+
+        else:
+            # The attachments were pulled out and sent for
+            # scanning while the message was arriving
+            msg = message.Message(peer, mailfrom, rcpttos, data,
+                                  stream.parsed_message,
+                                  stream.attachments)
+            scans = stream.results
 
         # Do we want to log all? Usually no
         if self._log:
-            msg.save(self._message_directory)
+            msg.save(self._message_directory, self._writer)
 
         # If we don't want to block emails EVER, then
         # we send them along first, then analyze later
         if not self._block:
-            self.deliver_message(peer, mailfrom, rcpttos, data)
+            delivered = self._defer(self.deliver_message, peer, mailfrom,
+                                    rcpttos, data)
+
+        else:
+            delivered = Pending()
+            delivered.fire(None)
 
-        # Pull the attachments out of the message
-        attachment_names, attachment_contents = msg.get_attachments()
+        def finish(status):
+            if status:
+                return status
 
-        # Now that we have all the attachments, time to check them
-        clean = True
-        for i, filename in enumerate(attachment_names):
-            md5 = hashlib.md5(attachment_contents[i]).hexdigest()
+            # If the attachments went to the scanning workers the
+            # verdict comes back later and the channel waits for it
+            return gather(scans).then(
+                lambda results: self._defer(self.finish_message, msg,
+                                            sum(results, [])))
+
+        pending = delivered.then(finish)
+        if pending.done:
+            return pending.result
+
+        return pending
+
+    def scan_attachments(self, mailfrom, rcpttos, attachments):
+        """
+        Check attachments against the processors.
+
+        Keyword arguments:
+        mailfrom -- raw address the message is coming from
+        rcpttos -- list of raw addresses the message is addressed to
+        attachments -- list of message.Attachments
+
+        Returns a scanner.Pending result that fires with a verdict for
+        each attachment, the list of processor Results for it and for
+        every member unpacked from it. It has already fired unless the
+        attachments went to a ScanEngine. With short_circuit on, a
+        cached match leaves the rest unscanned.
+
+        """
+        for attachment in attachments:
             self.logger.info('Analyzing attachment; From: %s; To: %s; ' \
                              'Name: %s; MD5:%s' % (str(mailfrom),
                                                   str(rcpttos),
-                                                  filename, md5))
+                                                  attachment.name,
+                                                  attachment.md5))
+
+        # Archives are scanned along with everything unpacked from them
+        groups = []
+        problems = []
+        for attachment in attachments:
+            scanned, size_problems = self._size_policy(attachment)
+            if scanned is None:
+                groups.append([])
+                problems.append(size_problems)
+                continue
+
+            start = time.time()
+            members, unpack_problems = self._unpack(scanned)
+            if members or unpack_problems:
+                metrics.STAGE_SECONDS.labels('unpack').observe(
+                    time.time() - start)
+
+            groups.append([scanned] + members)
+            problems.append(size_problems + unpack_problems)
+
+        scanning = sum(groups, [])
+
+        # Only attachments we have not seen recently need scanning
+        verdicts = self._cached_verdicts(scanning)
+        misses = [i for i, verdict in enumerate(verdicts) if verdict is None]
+        if self._short_circuit and misses and \
+                any(any(verdict) for verdict in verdicts
+                    if verdict is not None):
+            # A verdict from the cache already decides the message
+            for i in misses:
+                verdicts[i] = [self._not_scanned()]
+
+            misses = []
+
+        start = time.time()
+        # Verdicts are only cached if the rules did not change meanwhile
+        fingerprint = None
+        if self._cache is not None:
+            fingerprint = self._cache.fingerprint
+
+        def scanned(results):
+            if misses:
+                # From handing the attachments over to the verdicts
+                metrics.STAGE_SECONDS.labels('scan').observe(
+                    time.time() - start)
+
+            self._fill_verdicts(verdicts, scanning, misses, results,
+                                fingerprint)
+
+            # Each attachment's verdict holds the results for it
+            # and for all of its members
+            combined = []
+            first = 0
+            for attachment, group, unpack_problems in zip(attachments,
+                                                          groups, problems):
+                last = first + len(group)
+                # File each result under what it scanned, the attachment
+                # itself or one of its members
+                for scanned, verdict in zip([attachment] + group[1:],
+                                            verdicts[first:last]):
+                    for result in verdict:
+                        result.sha256 = scanned.sha256
+
+                attachment.members = group[1:]
+                combined.append(sum(verdicts[first:last], []) +
+                                unpack_problems)
+                first = last
+
+            return combined
+
+        if self._engine and misses:
+            return self._engine.submit([scanning[i]
+                                        for i in misses]).then(scanned)
+
+        done = Pending()
+        done.fire(scanned(self.match_batch([scanning[i] for i in misses])))
+        return done
+
+    def _defer(self, func, *args):
+        """
+        Make a blocking call, off the event loop if there is a way to.
+
+        Keyword arguments:
+        func -- the callable
+        args -- its arguments
+
+        Returns a scanner.Pending result for what func returns.
+
+        """
+        if self._defer_call is not None:
+            return self._defer_call(func, *args)
+
+        done = Pending()
+        done.fire(func(*args))
+        return done
+
+    def match(self, attachment):
+        """
+        Run the processors against an attachment.
+
+        Keyword arguments:
+        attachment -- the message.Attachment to analyze
+
+        Returns the list of processor Results, which contains
+        a True Result if any processor matched.
+
+        """
+        return self._pipeline.match(attachment)
+
+    def match_batch(self, attachments):
+        """
+        Run the processors against several attachments at once.
+
+        Keyword arguments:
+        attachments -- list of message.Attachments to analyze
 
-            for processor in self._processors:
-                malicious = processor.match(attachment_contents[i])
+        Returns a list holding the list of processor Results for
+        each attachment.
 
-                if malicious:
-                    clean = False
+        """
+        return self._pipeline.match_batch(attachments)
+
+    def _size_policy(self, attachment):
+        """
+        Apply the oversize policy to an attachment that is too large
+        to scan.
+
+        Keyword arguments:
+        attachment -- the message.Attachment to scan
+
+        Returns a tuple holding the attachment to scan, which is None
+        when nothing is to be scanned, and a list of Results for the
+        attachment that say why it was not scanned in full.
+
+        """
+        if not self._max_scan_size or attachment.size <= self._max_scan_size:
+            return attachment, []
+
+        self.logger.warning('Attachment too large to scan; Policy: %s; %s'
+                            % (self._oversize_policy, attachment))
+
+        if self._oversize_policy == 'skip':
+            return None, [Result(__name__, False,
+                                 error='Not scanned, over %s bytes'
+                                       % self._max_scan_size)]
+
+        if self._oversize_policy == 'quarantine':
+            return None, [Result(__name__, True,
+                                 error='Quarantined, over %s bytes'
+                                       % self._max_scan_size)]
+
+        # Scan the start and end of it, where payloads usually sit
+        half = self._max_scan_size / 2
+        f = attachment.open()
+        try:
+            if self._memory_limit and 2 * half > self._memory_limit:
+                # As large as they are, keep them in a temporary file
+                fd, path = tempfile.mkstemp(prefix='bulk-', suffix='.tmp')
+                with os.fdopen(fd, 'wb') as out:
+                    self._copy(f, out, half)
+                    f.seek(-half, os.SEEK_END)
+                    self._copy(f, out, half)
+
+                partial = message.Attachment(attachment.name, path=path)
+
+            else:
+                head = f.read(half)
+                f.seek(-half, os.SEEK_END)
+                partial = message.Attachment(attachment.name,
+                                             head + f.read())
+
+        finally:
+            f.close()
+
+        return partial, [Result(__name__, False,
+                                error='Only the first and last %s bytes '
+                                      'scanned' % half)]
+
+    def _copy(self, source, destination, size):
+        """
+        Copy size bytes from one file object to another, a chunk at a
+        time.
+        """
+        while size > 0:
+            chunk = source.read(min(size, message.Attachment.CHUNK_SIZE))
+            if not chunk:
+                break
+
+            destination.write(chunk)
+            size -= len(chunk)
+
+    def _unpack(self, attachment):
+        """
+        Unpack an attachment if it is an archive.
+
+        Keyword arguments:
+        attachment -- the message.Attachment to unpack
+
+        Returns a tuple holding the list of message.Attachments unpacked
+        from it and a list of Results for anything that could not be.
+
+        """
+        if self._unpacker is None:
+            return [], []
+
+        return self._unpacker.expand(attachment)
+
+    def _not_scanned(self):
+        """
+        The Result for an attachment left unscanned because another
+        attachment of the message already matched.
+        """
+        return Result(__name__, False,
+                      error='Not scanned, the message already matched')
+
+    def _cached_verdicts(self, attachments):
+        """
+        Look up attachment verdicts in the verdict cache.
+
+        Keyword arguments:
+        attachments -- list of message.Attachments
+
+        Returns a list of verdicts, None where nothing was cached.
+
+        """
+        if self._cache is None:
+            return [None] * len(attachments)
+
+        return [self._cache.get(attachment.sha256)
+                for attachment in attachments]
+
+    def _fill_verdicts(self, verdicts, attachments, misses, results,
+                       fingerprint=None):
+        """
+        Fill in and cache freshly scanned verdicts.
+
+        Keyword arguments:
+        verdicts -- list of verdicts to fill in
+        attachments -- list of message.Attachments
+        misses -- indexes of the verdicts that were scanned
+        results -- the scanned verdicts, in the same order as misses
+        fingerprint -- fingerprint of the rules in use when the scan
+        started
+
+        """
+        # Scanning stopped at the first match, so the verdicts that did
+        # not match may be missing some of their Results
+        partial = self._short_circuit and any(any(verdict)
+                                              for verdict in results)
+
+        for i, verdict in zip(misses, results):
+            verdicts[i] = verdict
+            for result in verdict:
+                metrics.SCAN_SECONDS.labels(result.processor).observe(
+                    result.elapsed)
+
+            # Scanning again may well succeed
+            if any(result.failed for result in verdict):
+                continue
+
+            if partial and not any(verdict):
+                continue
+
+            if self._cache is not None:
+                self._cache.put(attachments[i].sha256, verdict,
+                                fingerprint)
+
+    def finish_message(self, msg, verdicts):
+        """
+        Act on the verdicts for a message's attachments.
+
+        Keyword arguments:
+        msg -- the message.Message being processed
+        verdicts -- list holding the processor Results for each of
+        the message's attachments
+
+        Returns None, for a normal '250 Ok' response to the client,
+        or the error reply when the message could not be delivered.
+
+        """
+        status = None
+        mailfrom = msg.mailfrom
+        rcpttos = msg.rcpttos
+
+        malicious = False
+        failed = False
+        incomplete = False
+        attachments = msg.get_attachments()
+        for attachment, results in zip(attachments, verdicts):
+            for result in results:
+                self.logger.debug('Attachment result; %s; %s'
+                                  % (attachment, result))
+
+                if result:
+                    malicious = True
+
+                elif result.failed:
+                    failed = True
+
+                elif result.incomplete:
+                    incomplete = True
+
+        metrics.ATTACHMENTS.inc(len(attachments))
+
+        # What was not scanned is decided by the policy for why not
+        unscanned = [('Scan failed', failed, self._failure_verdict),
+                     ('Attachment not fully unpacked', incomplete,
+                      self._unpack_failure_verdict)]
+        for reason, happened, verdict in unscanned:
+            if not happened or malicious:
+                continue
+
+            self.logger.warning('%s, treating the message as: %s; '
+                                'From: %s; To: %s'
+                                % (reason, verdict, str(mailfrom),
+                                   str(rcpttos)))
+
+            if verdict == 'tempfail' and self._block:
+                # Have the client try again later, nothing is delivered
+                metrics.VERDICTS.labels('tempfail').inc()
+                return '451 4.3.0 Error: %s, try again later' \
+                       % reason.lower()
+
+            # Already delivered when not blocking, so keep a copy
+            malicious = verdict != 'pass'
+
+        metrics.VERDICTS.labels('malicious' if malicious else 'clean').inc()
 
         # Once looking at all attachments, we can decide to deliver or not
-        if clean:
+        if not malicious:
             self.logger.info('Message clean; From: %s; To: %s'
                          % (str(mailfrom), str(rcpttos)))
 
             if self._block:
-                self.deliver_message(peer, mailfrom, rcpttos, data)
+                status = self.deliver_message(msg.peer, mailfrom, rcpttos,
+                                              msg.data)
 
         else:
             if self._block:
                 self.logger.info('Message blocked; From: %s; To: %s'
                          % (str(mailfrom), str(rcpttos)))
 
-            msg.save(self._quarantine_directory)
+            msg.save(self._quarantine_directory, self._writer)
 
         # Do we want to save attachments?
         if self._save_attachments:
-            msg.save_attachments(self._attachment_directory)
+            msg.save_attachments(self._store)
+
+        if self._events is not None:
+            self._events.record(msg, verdicts, malicious)
+
+        if self._cache is not None:
+            self.logger.debug(str(self._cache))
+
+        metrics.STAGE_SECONDS.labels('total').observe(
+            time.time() - msg.received)
+        return status
 
     def deliver_message(self, peer, mailfrom, rcpttos, data):
         """
         Delivers a message to final destination if allowed
+
+        Returns None, or an SMTP error reply for the client when the
+        message could not be accepted for delivery.
         """
         if not self._always_block:
             self.logger.info('Sending message; From: %s; To: %s'
                          % (str(mailfrom), str(rcpttos)))
-            self._deliver(mailfrom, rcpttos, data)
+
+            start = time.time()
+            if self._spool:
+                try:
+                    self._spool.enqueue(mailfrom, rcpttos, data)
+
+                except (IOError, OSError) as e:
+                    self.logger.error('Cannot queue message for delivery; '
+                                      'From: %s; Error: %s'
+                                      % (str(mailfrom), e))
+                    return '451 Requested action aborted: ' \
+                           'local error in processing'
+
+                metrics.STAGE_SECONDS.labels('delivery').observe(
+                    time.time() - start)
+                return None
+
+            if self._upstream:
+                refused = self._upstream.deliver(mailfrom, rcpttos, data)
+
+            else:
+                refused = self._deliver(mailfrom, rcpttos, data)
+
+            metrics.STAGE_SECONDS.labels('delivery').observe(
+                time.time() - start)
+
+            if refused:
+                self.logger.error('Recipients refused upstream; From: %s; '
+                                  'Refused: %s' % (str(mailfrom),
+                                                   str(refused)))
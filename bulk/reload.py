@@ -0,0 +1,169 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import time
+import logging
+import threading
+
+# Bulk Imports
+from bulk.helpers import rules_fingerprint
+
+
+class RuleReloader(object):
+    """
+    Reloads the rules of running processors in the background.
+
+    Every processor with rules to reload first compiles its new rules
+    without touching the ones in use. Only when all of them have
+    compiled are the new rules swapped in, so a broken rule file leaves
+    the old rules running everywhere. Scans already running finish with
+    the rules they started with.
+
+    Processors take part by defining load_rules(), which returns newly
+    compiled rules, and use_rules(rules), which starts using them.
+    """
+
+    def __init__(self, processors, specs, engine=None, cache=None):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        processors -- list of processors the proxy is using
+        specs -- list of (module_name, rules) tuples the processors
+        were built from
+        engine -- the scanner.ScanEngine, or aio.ExecutorEngine, if
+        scanning in one
+        cache -- the cache.VerdictCache, if caching verdicts
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._processors = processors
+        self._specs = specs
+        self._engine = engine
+        self._cache = cache
+
+        # Reentrant, as a signal can arrive while it is held
+        self._lock = threading.RLock()
+        self._thread = None
+        self._again = False
+
+        self.reloads = 0
+        self.failures = 0
+
+    def __str__(self):
+        """
+        Pretty way to print the reloader.
+        """
+        return 'RuleReloader; Reloads: %s; Failures: %s' % (self.reloads,
+                                                           self.failures)
+
+    def reload(self):
+        """
+        Start reloading the rules, unless a reload is already running,
+        in which case another one follows it.
+
+        Safe to call from a signal handler.
+
+        """
+        with self._lock:
+            if self._thread is not None:
+                # The rules may have changed since it started
+                self._again = True
+                return
+
+            self._thread = threading.Thread(target=self._run,
+                                            name='bulk-reload')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def reload_now(self):
+        """
+        Reload the rules on the calling thread, waiting until done.
+        """
+        self._reload()
+
+    def _run(self):
+        """
+        Reloader thread main loop.
+        """
+        while True:
+            self._reload()
+
+            with self._lock:
+                if not self._again:
+                    self._thread = None
+                    return
+
+                self._again = False
+
+    def _reload(self):
+        """
+        Compile the new rules and swap them in.
+        """
+        self.logger.info('Reloading rules')
+        start = time.time()
+
+        reloadable = [processor for processor in self._processors
+                      if hasattr(processor, 'load_rules')]
+
+        try:
+            rules = [processor.load_rules() for processor in reloadable]
+
+        except Exception as e:
+            self.failures += 1
+            self.logger.error('Cannot reload rules, still using the old '
+                              'ones: %s' % e)
+            return
+
+        fingerprint = rules_fingerprint(self._specs)
+
+        def use_rules():
+            for processor, new_rules in zip(reloadable, rules):
+                processor.use_rules(new_rules)
+
+        def swap():
+            # Verdicts from the old rules no longer hold, and none
+            # may be cached or looked up while the rules change
+            if self._cache is not None:
+                self._cache.set_fingerprint(fingerprint, use_rules)
+
+            else:
+                use_rules()
+
+        if self._engine:
+            try:
+                self._engine.reload(swap)
+
+            except Exception as e:
+                self.failures += 1
+                self.logger.error('Cannot restart scanning workers, still '
+                                  'using the old rules in them: %s' % e)
+                return
+
+        else:
+            swap()
+
+        self.reloads += 1
+        self.logger.info('Reloaded rules in %0.3f s' % (time.time() - start))
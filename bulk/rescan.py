@@ -0,0 +1,504 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import ast
+import time
+import signal
+import sqlite3
+import logging
+import multiprocessing
+
+# Bulk Imports
+from bulk import scanner
+from bulk.message import Message, Attachment
+from bulk.store import AttachmentStore
+from bulk.helpers import imap_windowed
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scanned (
+    fingerprint TEXT,
+    sha256 TEXT,
+    name TEXT,
+    size INTEGER,
+    md5 TEXT,
+    path TEXT,
+    matched INTEGER,
+    failed INTEGER,
+    error TEXT,
+    time REAL,
+    PRIMARY KEY (fingerprint, sha256)
+);
+CREATE TABLE IF NOT EXISTS hits (
+    fingerprint TEXT,
+    sha256 TEXT,
+    processor TEXT,
+    rule TEXT,
+    namespace TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    fingerprint TEXT,
+    path TEXT,
+    PRIMARY KEY (fingerprint, path)
+);
+CREATE INDEX IF NOT EXISTS hits_digest ON hits (fingerprint, sha256);
+"""
+
+# Trees under the base log directory that hold scannable files
+TREES = ('messages', 'quarantine', 'attachments')
+
+# Ends the header Message.save writes ahead of the original message
+HEADER_END = 'BULKMSG: Original message seen below\n'
+
+# What the rest of a rescan worker process works with, set by _init_worker
+_worker = {}
+
+
+def connect(path):
+    """
+    Open a rescan database, creating its tables if needed.
+
+    Keyword arguments:
+    path -- path to the SQLite database file
+
+    Returns a sqlite3 connection.
+
+    """
+    conn = sqlite3.connect(path, timeout=60)
+    # Attachment names are byte strings, in whatever encoding
+    conn.text_factory = str
+    # Workers read what has been scanned while the parent writes
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def load_message(path, memory_limit=0):
+    """
+    Read back a message saved by Message.save.
+
+    Keyword arguments:
+    path -- path to the saved message
+    memory_limit -- largest attachment, encoded, to decode in memory
+    rather than into a temporary file, 0 for no limit
+
+    Files without the header Message.save writes are read as a bare
+    message.
+
+    Returns a message.Message.
+
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    fields = {}
+    end = data.find(HEADER_END)
+    if end >= 0:
+        for line in data[:end].splitlines():
+            label, _, value = line[len('BULKMSG:'):].partition(':')
+            fields[label.strip()] = value.strip()
+
+        data = data[end + len(HEADER_END):]
+
+    rcpttos = fields.get('Message addressed to')
+    try:
+        rcpttos = ast.literal_eval(rcpttos)
+
+    except (ValueError, SyntaxError):
+        pass
+
+    return Message(fields.get('Received message from'),
+                   fields.get('Message addressed from'), rcpttos, data,
+                   memory_limit=memory_limit)
+
+
+def walk(basedir, trees=TREES):
+    """
+    Find the files stored under a base log directory.
+
+    Keyword arguments:
+    basedir -- the base log directory, ending with a separator
+    trees -- sub directories to look in
+
+    Yields (tree, path) tuples. Sightings and half written files in
+    the attachment store are left out.
+
+    """
+    for tree in trees:
+        for dn, dirnames, filenames in os.walk(basedir + tree):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.endswith('.tmp'):
+                    continue
+
+                if tree == 'attachments' and len(fn) != 64:
+                    continue
+
+                yield tree, os.path.join(dn, fn)
+
+
+def _init_worker(specs, options, database, fingerprint, basedir,
+                 unpacker, memory_limit):
+    """
+    Build the processors for a rescan worker process.
+
+    Keyword arguments:
+    specs -- list of (module_name, rules) tuples
+    options -- processor options passed to build_processor
+    database -- path to the rescan database
+    fingerprint -- fingerprint of the rules being scanned with
+    basedir -- the base log directory, ending with a separator
+    unpacker -- unpack.Unpacker for archives, if any
+    memory_limit -- largest attachment, encoded, to decode in memory
+
+    """
+    # Interrupting the parent stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    scanner._init_worker(specs, options)
+
+    _worker['conn'] = connect(database)
+    _worker['fingerprint'] = fingerprint
+    _worker['store'] = AttachmentStore(basedir + 'attachments')
+    _worker['unpacker'] = unpacker
+    _worker['memory_limit'] = memory_limit
+    # Digests this worker scanned, whether or not they are committed yet
+    _worker['seen'] = set()
+
+
+def _scanned(sha256):
+    """
+    Whether an attachment was already scanned with the same rules.
+
+    Keyword arguments:
+    sha256 -- hex SHA256 digest of the attachment
+
+    Failed scans do not count, so they are tried again.
+
+    """
+    if sha256 in _worker['seen']:
+        return True
+
+    row = _worker['conn'].execute(
+        'SELECT 1 FROM scanned WHERE fingerprint = ? AND sha256 = ? '
+        'AND failed = 0', (_worker['fingerprint'], sha256)).fetchone()
+    return row is not None
+
+
+def _read(tree, path):
+    """
+    Pull the attachments out of a stored file.
+
+    Keyword arguments:
+    tree -- the tree the file is in
+    path -- path to the file
+
+    Returns a tuple holding the list of message.Attachments left to
+    scan, the number already scanned and the incomplete Results for
+    any archives that could not be fully unpacked, by their digest.
+
+    """
+    if tree == 'attachments':
+        sha256 = os.path.basename(path)
+        if _scanned(sha256):
+            return [], 1, {}
+
+        # Named as it was first seen, when that was recorded
+        name = sha256
+        for sighting in _worker['store'].sightings(sha256):
+            name = sighting.get('name') or name
+            break
+
+        attachments = [Attachment(name, path=path, keep=True)]
+
+    else:
+        row = _worker['conn'].execute(
+            'SELECT 1 FROM files WHERE fingerprint = ? AND path = ?',
+            (_worker['fingerprint'], path)).fetchone()
+        if row is not None:
+            return [], 0, {}
+
+        msg = load_message(path, _worker['memory_limit'])
+        attachments = list(msg.get_attachments())
+
+    problems = {}
+    if _worker['unpacker']:
+        for attachment in list(attachments):
+            members, failures = _worker['unpacker'].expand(attachment)
+            attachments.extend(members)
+            if failures:
+                problems[attachment.sha256] = failures
+
+    todo = []
+    for attachment in attachments:
+        if not _scanned(attachment.sha256):
+            _worker['seen'].add(attachment.sha256)
+            todo.append(attachment)
+
+    return todo, len(attachments) - len(todo), problems
+
+
+def _rescan(task):
+    """
+    Scan the attachments in one stored file.
+
+    Keyword arguments:
+    task -- (tree, path) tuple from walk()
+
+    Returns a (tree, path, records, skipped, error) tuple. Records are
+    dictionaries describing each attachment scanned, skipped is the
+    number of attachments already scanned with the same rules and
+    error says why the file could not be read, if it could not be.
+
+    """
+    tree, path = task
+    try:
+        attachments, skipped, problems = _read(tree, path)
+
+    except Exception as e:
+        logging.getLogger('bulk').exception('Cannot read %s' % path)
+        return tree, path, [], 0, str(e) or e.__class__.__name__
+
+    verdicts = scanner._scan(attachments) if attachments else []
+    if verdicts is None:
+        # Leave them to be tried again
+        verdicts = [[] for attachment in attachments]
+        for attachment in attachments:
+            _worker['seen'].discard(attachment.sha256)
+
+    records = []
+    for attachment, scanned in zip(attachments, verdicts):
+        # What could not be unpacked was not scanned either
+        results = scanned + problems.get(attachment.sha256, [])
+        matched = any(results)
+        errors = [result.error for result in results if result.error]
+        if not scanned:
+            errors.insert(0, 'Scan failed')
+
+        records.append({
+            'sha256': attachment.sha256,
+            'md5': attachment.md5,
+            'size': attachment.size,
+            'name': attachment.name,
+            'matched': matched,
+            'failed': not scanned or (not matched and
+                                      any(result.failed
+                                          for result in results)),
+            'error': '; '.join(errors) or None,
+            'hits': [(result.processor, rule, namespace)
+                     for result in results
+                     for rule, namespace in result.hits]})
+
+    return tree, path, records, skipped, None
+
+
+def _record(conn, fingerprint, tree, path, records):
+    """
+    Write what a worker scanned in one file to the rescan database.
+
+    Keyword arguments:
+    conn -- connection from connect()
+    fingerprint -- fingerprint of the rules scanned with
+    tree -- the tree the file is in
+    path -- path to the file
+    records -- records returned by _rescan
+
+    """
+    now = time.time()
+    for record in records:
+        conn.execute('INSERT OR REPLACE INTO scanned VALUES '
+                     '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (fingerprint, record['sha256'], record['name'],
+                      record['size'], record['md5'], path,
+                      int(record['matched']), int(record['failed']),
+                      record['error'], now))
+        conn.execute('DELETE FROM hits WHERE fingerprint = ? AND sha256 = ?',
+                     (fingerprint, record['sha256']))
+        conn.executemany('INSERT INTO hits VALUES (?, ?, ?, ?, ?)',
+                         [(fingerprint, record['sha256'], processor, rule,
+                           namespace)
+                          for processor, rule, namespace in record['hits']])
+
+    # Messages are only skipped next time once all of them was scanned
+    if tree != 'attachments' and \
+            not any(record['failed'] for record in records):
+        conn.execute('INSERT OR IGNORE INTO files VALUES (?, ?)',
+                     (fingerprint, path))
+
+
+def rescan(basedir, specs, options, fingerprint, database, trees=TREES,
+           workers=None, unpacker=None, memory_limit=0, force=False,
+           chunk_size=16, commit_every=1000, progress_interval=60):
+    """
+    Scan the stored messages and attachments again, with a process pool.
+
+    Keyword arguments:
+    basedir -- the base log directory, ending with a separator
+    specs -- list of (module_name, rules) tuples to build processors from
+    options -- processor options passed to build_processor
+    fingerprint -- fingerprint of the rules, from helpers.rules_fingerprint
+    database -- path to the rescan database
+    trees -- sub directories of basedir to rescan
+    workers -- number of worker processes, the number of CPUs by default
+    unpacker -- unpack.Unpacker for archives, if any
+    memory_limit -- largest attachment, encoded, to decode in memory
+    force -- scan everything again, forgetting what was scanned with
+    the same rules before
+    chunk_size -- files handed to a worker at a time
+    commit_every -- files recorded per database transaction
+    progress_interval -- seconds between progress log lines
+
+    Every worker parses, unpacks and scans whole files. What was scanned
+    is recorded in the database by rule fingerprint, so attachments seen
+    again, in this run or an earlier one with the same rules, are not
+    scanned twice, and an interrupted rescan picks up where it stopped.
+
+    Returns a dictionary of counts describing the run.
+
+    """
+    # Progress has a logger of its own, so it can be shown on its own
+    logger = logging.getLogger('bulk.rescan')
+    workers = workers or multiprocessing.cpu_count()
+
+    conn = connect(database)
+    if force:
+        for table in ('scanned', 'hits', 'files'):
+            conn.execute('DELETE FROM %s WHERE fingerprint = ?' % table,
+                         (fingerprint,))
+
+    conn.commit()
+
+    summary = {'files': 0, 'scanned': 0, 'skipped': 0, 'matched': 0,
+               'failed': 0, 'unreadable': 0}
+    start = reported = time.time()
+
+    pool = multiprocessing.Pool(workers, _init_worker,
+                                (specs, options, database, fingerprint,
+                                 basedir, unpacker, memory_limit))
+    try:
+        for tree, path, records, skipped, error in \
+                imap_windowed(pool, _rescan, walk(basedir, trees),
+                              workers * chunk_size * 64, chunk_size):
+            summary['files'] += 1
+            summary['skipped'] += skipped
+            if error:
+                summary['unreadable'] += 1
+                continue
+
+            for record in records:
+                summary['scanned'] += 1
+                summary['matched'] += record['matched']
+                summary['failed'] += record['failed']
+
+            try:
+                _record(conn, fingerprint, tree, path, records)
+
+            except sqlite3.Error as e:
+                # One file should not stop a rescan of millions
+                summary['unreadable'] += 1
+                logger.error('Cannot record %s: %s' % (path, e))
+                continue
+
+            if summary['files'] % commit_every == 0:
+                conn.commit()
+
+            now = time.time()
+            if now - reported >= progress_interval:
+                reported = now
+                logger.info('Rescanned %s files in %.1f s, %.1f files/s; '
+                            'Attachments scanned: %s; Skipped: %s; '
+                            'Matched: %s'
+                            % (summary['files'], now - start,
+                               summary['files'] / max(now - start, 1e-6),
+                               summary['scanned'], summary['skipped'],
+                               summary['matched']))
+
+        pool.close()
+
+    except BaseException:
+        pool.terminate()
+        raise
+
+    finally:
+        pool.join()
+        conn.commit()
+        conn.close()
+
+    summary['seconds'] = time.time() - start
+    return summary
+
+
+def format_report(conn, fingerprint, summary=None):
+    """
+    Describe what rescanning with a set of rules found.
+
+    Keyword arguments:
+    conn -- connection from connect()
+    fingerprint -- fingerprint of the rules scanned with
+    summary -- counts returned by rescan(), if any
+
+    Findings cover every rescan with the same rules, so an interrupted
+    rescan that was picked up again reports all of them.
+
+    Returns the report as a string.
+
+    """
+    lines = ['Rescan with rules %s' % fingerprint]
+    if summary:
+        lines.append('Files: %s; Attachments scanned: %s; Skipped: %s; '
+                     'Matched: %s; Failed: %s; Unreadable: %s; '
+                     'Seconds: %.1f'
+                     % (summary['files'], summary['scanned'],
+                        summary['skipped'], summary['matched'],
+                        summary['failed'], summary['unreadable'],
+                        summary['seconds']))
+
+    rows = conn.execute('SELECT sha256, name, size, path, matched, error '
+                        'FROM scanned WHERE fingerprint = ? '
+                        'AND (matched = 1 OR failed = 1) '
+                        'ORDER BY matched DESC, path, name',
+                        (fingerprint,)).fetchall()
+
+    lines.append('%s findings' % len(rows))
+    lines.append('%-7s %-64s %10s  %s' % ('Verdict', 'SHA256', 'Size',
+                                          'Path; Name; Rules'))
+    for sha256, name, size, path, matched, error in rows:
+        hits = conn.execute('SELECT processor, rule, namespace FROM hits '
+                            'WHERE fingerprint = ? AND sha256 = ?',
+                            (fingerprint, sha256)).fetchall()
+        detail = '%s; %s' % (path, name)
+        if matched:
+            detail += '; %s' % ', '.join('%s:%s' % (namespace, rule)
+                                         for processor, rule, namespace
+                                         in hits)
+
+        else:
+            detail += '; %s' % error
+
+        lines.append('%-7s %-64s %10s  %s'
+                     % ('matched' if matched else 'failed', sha256, size,
+                        detail))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,607 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import time
+import Queue
+import signal
+import asyncore
+import logging
+import threading
+import collections
+import multiprocessing
+
+# Bulk Imports
+from bulk import metrics
+from bulk.helpers import build_processor
+from bulk.processors import Result
+from bulk.pipeline import Pipeline
+
+
+# Processors owned by a worker process, built once by _init_worker
+_worker_pipeline = None
+
+SCAN_FAILURES = metrics.registry.counter(
+    'bulk_scan_failures_total',
+    'Scans of a batch of attachments that did not finish', ['reason'])
+
+
+def _init_worker(specs, options, short_circuit=False):
+    """
+    Build the processors for a scanning worker process.
+
+    Keyword arguments:
+    specs -- list of (module_name, rules) tuples
+    options -- processor options passed to build_processor
+    short_circuit -- whether to stop scanning a batch of
+    attachments at its first match
+
+    """
+    # Rule reloads are the parent's business
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    global _worker_pipeline
+    _worker_pipeline = Pipeline([build_processor(module_name, rules,
+                                                 **options)
+                                 for module_name, rules in specs],
+                                short_circuit)
+
+
+def _worker_main(conn, specs, options, short_circuit):
+    """
+    Scanning worker process main loop.
+
+    Builds the processors and says so, then scans each list of
+    attachments received over the connection and sends back the
+    verdicts, until it receives None.
+
+    Keyword arguments:
+    conn -- the worker's end of a multiprocessing.Pipe
+    specs -- list of (module_name, rules) tuples
+    options -- processor options passed to build_processor
+    short_circuit -- whether to stop scanning a batch of
+    attachments at its first match
+
+    """
+    # Interrupting the parent should not kill scans midway
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(specs, options, short_circuit)
+    conn.send(True)
+
+    while True:
+        try:
+            attachments = conn.recv()
+
+        except (EOFError, IOError):
+            return
+
+        if attachments is None:
+            return
+
+        conn.send(_scan(attachments))
+
+
+def _scan(attachments):
+    """
+    Run the worker's processors against a list of attachments.
+
+    Keyword arguments:
+    attachments -- list of message.Attachments
+
+    Returns a list holding the list of processor Results for each
+    attachment, or None if scanning failed.
+
+    """
+    try:
+        verdicts = _worker_pipeline.match_batch(attachments)
+
+    except Exception:
+        logging.getLogger('bulk').exception('Scanning worker failed')
+        return None
+
+    return verdicts
+
+
+class Pending(object):
+    """
+    A result that is not available yet.
+
+    Callbacks added to a pending result are run, in order,
+    once the result is fired.
+    """
+
+    def __init__(self):
+        """
+        Default initializer.
+        """
+        self.done = False
+        self.result = None
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        """
+        Run a callback with the result once it is available.
+
+        Keyword arguments:
+        callback -- callable taking the result as its only argument
+
+        """
+        if self.done:
+            callback(self.result)
+
+        else:
+            self._callbacks.append(callback)
+
+    def fire(self, result):
+        """
+        Make the result available and run all waiting callbacks.
+
+        Keyword arguments:
+        result -- the result
+
+        """
+        self.done = True
+        self.result = result
+
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(result)
+
+    def then(self, func):
+        """
+        Chain a function onto this result.
+
+        Keyword arguments:
+        func -- callable taking this result and returning a new one
+
+        Returns a pending result for the value returned by func, or,
+        when func returns a pending result itself, for its value once
+        it fires. If func raises, the error is logged and the pending
+        result fires with an SMTP error reply instead, so whoever waits
+        on it is not left waiting forever.
+
+        """
+        chained = Pending()
+
+        def call(result):
+            try:
+                value = func(result)
+
+            except Exception:
+                logging.getLogger('bulk').exception('Processing failed')
+                value = '451 4.3.0 Error: processing failed'
+
+            if isinstance(value, Pending):
+                value.add_callback(chained.fire)
+
+            else:
+                chained.fire(value)
+
+        self.add_callback(call)
+        return chained
+
+
+def gather(pendings):
+    """
+    Wait on several pending results at once.
+
+    Keyword arguments:
+    pendings -- list of pending results
+
+    Returns a pending result that fires with the list of their
+    results once all of them have fired.
+
+    """
+    gathered = Pending()
+    results = [None] * len(pendings)
+    remaining = [len(pendings)]
+
+    def done(i, result):
+        results[i] = result
+        remaining[0] -= 1
+        if not remaining[0]:
+            gathered.fire(results)
+
+    if not pendings:
+        gathered.fire(results)
+
+    for i, pending in enumerate(pendings):
+        pending.add_callback(lambda result, i=i: done(i, result))
+
+    return gathered
+
+
+class _Waker(asyncore.file_dispatcher):
+    """
+    Runs callables handed over from other threads on the asyncore loop.
+
+    Other threads queue a callable and write a byte to a pipe,
+    which wakes the loop up to run it.
+    """
+
+    def __init__(self):
+        """
+        Default initializer.
+        """
+        self._calls = collections.deque()
+        read_fd, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd)
+        # file_dispatcher dups the descriptor
+        os.close(read_fd)
+
+    def writable(self):
+        """
+        Nothing is ever written through the dispatcher.
+        """
+        return False
+
+    def call(self, func, *args):
+        """
+        Queue a call to be made on the asyncore loop. Thread safe.
+        """
+        self._calls.append((func, args))
+        os.write(self._write_fd, 'x')
+
+    def handle_read(self):
+        """
+        Run every queued call.
+        """
+        self.recv(4096)
+        while self._calls:
+            func, args = self._calls.popleft()
+            try:
+                func(*args)
+
+            except Exception:
+                # Letting it through would close the waker, and no
+                # verdict would ever come back to the loop again
+                logging.getLogger('bulk').exception('Callback failed on '
+                                                    'the event loop')
+
+    def close(self):
+        """
+        Close both ends of the pipe.
+        """
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+
+class ScanEngine(object):
+    """
+    Scans attachments in supervised worker processes.
+
+    Each worker builds and holds its own processors, so a slow
+    scan only ties up one worker instead of the event loop.
+    Results are handed back to the loop as pending results.
+
+    Every worker is fed by a thread of its own in this process. A
+    worker that crashes, or takes too long over a scan, is killed and
+    replaced, and the scan fails rather than holding up the message.
+    """
+
+    # With a timeout, a worker is killed when a scan runs over this
+    # many times the timeout for every attachment in it
+    KILL_FACTOR = 2
+    # but never lets a scan run over this many times the timeout, however
+    # many attachments are in it
+    KILL_CAP = 20
+    # Seconds between checks that a scanning worker is still alive
+    POLL_INTERVAL = 1.0
+
+    def __init__(self, specs, workers=None, options=None,
+                 call_soon_threadsafe=None, short_circuit=False,
+                 timeout=0):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        specs -- list of (module_name, rules) tuples used to build
+        the processors in each worker
+        workers -- number of worker processes, defaults to the CPU count
+        options -- dictionary of processor options, such as
+        cache_directory, passed to build_processor
+        call_soon_threadsafe -- callable, such as the asyncio loop method
+        of the same name, that runs func(*args) on the event loop when
+        handed func and args from another thread. Defaults to waking
+        the asyncore loop
+        short_circuit -- whether to stop scanning a batch of
+        attachments at its first match
+        timeout -- seconds a scan may take for each attachment in it,
+        past which the worker is killed, 0 for no limit
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._specs = specs
+        self._options = options or {}
+        self._short_circuit = short_circuit
+        self._timeout = timeout
+        self._workers = workers or multiprocessing.cpu_count()
+        self._pending = 0
+        # Guards swapping the workers during a reload
+        self._lock = threading.Lock()
+
+        self.logger.info('Starting %s scanning workers' % self._workers)
+        self._queue, self._threads = self._start_workers()
+        self._waker = None
+        self._call = call_soon_threadsafe
+        if self._call is None:
+            self._waker = _Waker()
+            self._call = self._waker.call
+
+    def __str__(self):
+        """
+        Pretty way to print the engine.
+        """
+        return 'ScanEngine with %s workers; Timeout: %s' % (self._workers,
+                                                           self._timeout)
+
+    @property
+    def pending(self):
+        """
+        Number of submitted scans without a verdict yet.
+        """
+        return self._pending
+
+    def submit(self, attachments):
+        """
+        Queue attachments for scanning.
+
+        Keyword arguments:
+        attachments -- list of message.Attachments
+
+        Returns a pending result that fires, on the event loop,
+        with the list of processor Results for each attachment.
+
+        """
+        result = Pending()
+        self._pending += 1
+
+        def done(verdicts, error):
+            self._pending -= 1
+            if verdicts is None:
+                # Let the scan failure verdict decide what happens
+                verdicts = [[Result(__name__, False, error=error,
+                                    failed=True)]
+                            for attachment in attachments]
+
+            result.fire(verdicts)
+
+        with self._lock:
+            self._queue.put((attachments, done))
+
+        return result
+
+    def reload(self, swap=None):
+        """
+        Replace the workers with new ones built from the rule files as
+        they are now.
+
+        Keyword arguments:
+        swap -- callable to call as the new workers take over, before
+        anything more is submitted, such as one changing the verdict
+        cache's fingerprint
+
+        Blocks until the new workers are ready, so call it from a
+        background thread. Scans already handed to the old workers
+        finish with the old rules before the old workers exit.
+
+        """
+        self.logger.info('Starting %s new scanning workers' % self._workers)
+        queue, threads = self._start_workers(wait=True)
+
+        with self._lock:
+            old, self._queue = self._queue, queue
+            old_threads, self._threads = self._threads, threads
+            if swap is not None:
+                swap()
+
+        self._stop(old, old_threads)
+        self.logger.info('Old scanning workers finished')
+
+    def close(self):
+        """
+        Stop the workers once all queued scans are done.
+        """
+        with self._lock:
+            self._stop(self._queue, self._threads)
+
+        if self._waker:
+            self._waker.close()
+
+    def _spawn(self):
+        """
+        Start a worker process.
+
+        Returns the process and the connection to it.
+
+        """
+        conn, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_worker_main,
+                                          name='bulk-scanner',
+                                          args=(child, self._specs,
+                                                self._options,
+                                                self._short_circuit))
+        process.daemon = True
+        process.start()
+        child.close()
+        return process, conn
+
+    def _start_workers(self, wait=False):
+        """
+        Start a set of workers, each with a thread feeding it scans
+        from a queue of their own.
+
+        Keyword arguments:
+        wait -- whether to wait for every worker to build its processors
+
+        Returns the queue and the threads.
+
+        """
+        workers = [self._spawn() for i in range(self._workers)]
+        if wait:
+            for process, conn in workers:
+                try:
+                    conn.recv()
+
+                except (EOFError, IOError):
+                    for process, conn in workers:
+                        self._kill(process, conn)
+
+                    raise RuntimeError('A scanning worker died '
+                                       'building its processors')
+
+        queue = Queue.Queue()
+        threads = []
+        for i, (process, conn) in enumerate(workers):
+            thread = threading.Thread(target=self._feed,
+                                      args=(queue, process, conn, wait),
+                                      name='bulk-scan-%s' % i)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        return queue, threads
+
+    def _stop(self, queue, threads):
+        """
+        Stop a set of workers once the scans in their queue are done.
+        """
+        for thread in threads:
+            queue.put(None)
+
+        for thread in threads:
+            thread.join()
+
+    def _feed(self, queue, process, conn, ready):
+        """
+        Feeding thread main loop: hands scans to a worker and their
+        verdicts back to the event loop, replacing the worker
+        whenever it fails.
+        """
+        while True:
+            item = queue.get()
+            if item is None:
+                try:
+                    conn.send(None)
+
+                except (IOError, OSError):
+                    pass
+
+                process.join()
+                return
+
+            attachments, done = item
+            if not process.is_alive():
+                # Replace a worker lost since the last scan
+                self._kill(process, conn)
+                process, conn = self._spawn()
+                ready = False
+
+            try:
+                if not ready:
+                    # Building the processors is not part of the scan
+                    conn.recv()
+                    ready = True
+
+                verdicts, reason, error = self._scan(process, conn,
+                                                     attachments)
+
+            except (EOFError, IOError, OSError):
+                verdicts, reason = None, 'crash'
+                error = 'Scanning worker crashed'
+
+            if reason:
+                SCAN_FAILURES.labels(reason).inc()
+                self.logger.error('%s; Attachments: %s'
+                                  % (error, ', '.join(str(attachment.name)
+                                                      for attachment
+                                                      in attachments)))
+
+            if reason in ('timeout', 'crash'):
+                self._kill(process, conn)
+                process, conn = self._spawn()
+                ready = False
+
+            self._call(done, verdicts, error)
+
+    def _deadline(self, count):
+        """
+        Seconds a worker may take to scan count attachments before it is
+        killed, None for no limit.
+        """
+        if not self._timeout:
+            return None
+
+        return self._timeout * min(self.KILL_FACTOR * max(count, 1),
+                                   self.KILL_CAP)
+
+    def _scan(self, process, conn, attachments):
+        """
+        Have a worker scan attachments, waiting no longer than the
+        timeout allows.
+
+        Returns the verdicts, or None, along with the reason for and
+        a description of any failure.
+
+        """
+        conn.send(attachments)
+
+        limit = self._deadline(len(attachments))
+        start = time.time()
+        while True:
+            wait = self.POLL_INTERVAL
+            if limit is not None:
+                wait = min(wait, start + limit - time.time())
+
+            if conn.poll(max(wait, 0)):
+                break
+
+            # A worker that died does not always close its end of the
+            # pipe, another worker forked meanwhile can hold it open
+            if not process.is_alive():
+                return None, 'crash', 'Scanning worker crashed'
+
+            if limit is not None and time.time() - start >= limit:
+                return None, 'timeout', 'Scan timed out after %s s' % limit
+
+        verdicts = conn.recv()
+        if verdicts is None:
+            return None, 'error', 'Scan failed'
+
+        return verdicts, None, None
+
+    def _kill(self, process, conn):
+        """
+        Get rid of a worker, whatever state it is in.
+        """
+        conn.close()
+        if process.is_alive():
+            try:
+                os.kill(process.pid, signal.SIGKILL)
+
+            except OSError:
+                pass
+
+        process.join()
@@ -0,0 +1,722 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import smtpd
+import socket
+import logging
+
+# Bulk Imports
+from bulk.scanner import Pending
+
+
+# Looked up once, as it can mean a DNS query
+_fqdn = []
+
+
+def fqdn():
+    """
+    Returns this host's fully qualified domain name.
+    """
+    if not _fqdn:
+        _fqdn.append(socket.getfqdn())
+
+    return _fqdn[0]
+
+
+class SMTPSession(object):
+    """
+    The SMTP conversation with one client, without any networking.
+
+    A front end feeds in whatever the client sends and the session
+    answers through the write callback it was given, so the same
+    conversation runs on asyncore or on an asyncio event loop.
+
+    Speaks ESMTP with the SIZE, 8BITMIME, PIPELINING and CHUNKING
+    extensions. Message data is fed into the server's message stream as
+    it arrives, and the server's process_message may return a
+    scanner.Pending result. The reply to the end of the message is then
+    held back, along with any pipelined input, until the result fires.
+    Replies to pipelined commands go out together.
+
+    With an admission.AdmissionControl, connections and messages over
+    its limits get a temporary failure.
+    """
+
+    COMMAND = 0
+    DATA = 1
+    BDAT = 2
+
+    # Longest command line accepted, well over RFC 5321's 512 octets
+    MAX_LINE = 4096
+
+    # BODY types accepted on MAIL FROM
+    BODY_TYPES = ('7BIT', '8BITMIME')
+
+    def __init__(self, server, peer, write, close,
+                 pause_reading=None, resume_reading=None, max_size=0,
+                 admission=None):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        server -- the BulkProxy, or anything with its begin_message
+        and process_message methods
+        peer -- address of the client
+        write -- callable sending a string to the client
+        close -- callable closing the connection once everything
+        written has been sent
+        pause_reading -- callable to stop reading from the client while
+        a verdict is pending, if the front end can
+        resume_reading -- callable to start reading again
+        max_size -- largest message accepted in bytes, advertised with
+        SIZE, 0 for no limit
+        admission -- admission.AdmissionControl to ask before taking
+        on work, if any
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._server = server
+        self._peer = peer
+        self._write = write
+        self._close = close
+        self._pause_reading = pause_reading
+        self._resume_reading = resume_reading
+        self._max_size = max_size
+        self._admission = admission
+        self._admitted = False
+
+        self._buffer = ''
+        self._replies = []
+        self._state = self.COMMAND
+        self._greeting = 0
+        self._extended = False
+        self._mailfrom = None
+        self._rcpttos = []
+        self._stream = None
+        self._size = 0
+        # Set when the message went over max_size and is being discarded
+        self._oversize = False
+        # Bytes of the message held in memory, and whether it is being
+        # discarded for want of room for more
+        self._held = 0
+        self._deferred = False
+        self._data_started = False
+        # Bytes left in the BDAT chunk being read, whether it is the
+        # last one, the reply it gets if it is refused, and any line
+        # ending held back from the end of the last chunk
+        self._chunk_size = 0
+        self._chunk_left = 0
+        self._chunk_last = False
+        self._chunk_error = None
+        self._chunk_tail = ''
+        # Set while waiting on a verdict for the last message
+        self._pending = None
+        self._processing = False
+        self.closed = False
+
+    @property
+    def peer(self):
+        return self._peer
+
+    @property
+    def waiting(self):
+        """
+        Whether the session is waiting on a verdict before
+        it reads any further.
+        """
+        return self._pending is not None
+
+    def start(self):
+        """
+        Greet the client, or turn it away if there are too many.
+        """
+        if self._admission:
+            if not self._admission.connect():
+                self.push('421 4.3.2 Error: too many connections, '
+                          'try again later')
+                self.quit()
+                return
+
+            self._admitted = True
+
+        self.push('220 %s %s' % (fqdn(), smtpd.__version__))
+
+    def push(self, msg):
+        """
+        Send a reply line to the client.
+
+        While input is being handled, replies are collected and
+        sent together once it has all been handled.
+
+        """
+        if self.closed:
+            return
+
+        if self._processing:
+            self._replies.append(msg + '\r\n')
+
+        else:
+            self._write(msg + '\r\n')
+
+    def feed(self, data):
+        """
+        Handle data received from the client.
+
+        Keyword arguments:
+        data -- whatever was read from the connection
+
+        """
+        self._buffer += data
+        self._process()
+
+    def close(self):
+        """
+        Note that the connection is closed.
+        """
+        self.closed = True
+        self._buffer = ''
+        self._replies = []
+        self._stream = None
+        self._release()
+
+        if self._admitted:
+            self._admitted = False
+            self._admission.disconnect()
+
+    def quit(self):
+        """
+        Close the connection once the replies so far are sent.
+        """
+        self._flush()
+        self._close()
+        self.close()
+
+    def _flush(self):
+        """
+        Send the replies collected so far.
+        """
+        if self._replies and not self.closed:
+            replies, self._replies = ''.join(self._replies), []
+            self._write(replies)
+
+    def _process(self):
+        """
+        Handle as much of the buffered input as possible.
+        """
+        # A verdict that is already in fires from within the loop below
+        if self._processing:
+            return
+
+        self._processing = True
+        try:
+            while not self._pending and not self.closed:
+                if self._state == self.COMMAND:
+                    if not self._command():
+                        break
+
+                elif self._state == self.DATA:
+                    if not self._data():
+                        break
+
+                elif not self._chunk():
+                    break
+
+        finally:
+            self._processing = False
+
+        self._flush()
+
+    def _command(self):
+        """
+        Handle a command line, if a whole one is buffered.
+
+        Returns whether it was.
+
+        """
+        i = self._buffer.find('\r\n')
+        if i < 0:
+            if len(self._buffer) > self.MAX_LINE:
+                self._buffer = ''
+                self.push('500 Error: line too long')
+
+            return False
+
+        line, self._buffer = self._buffer[:i], self._buffer[i + 2:]
+        if not line:
+            self.push('500 Error: bad syntax')
+            return True
+
+        i = line.find(' ')
+        if i < 0:
+            command = line.upper()
+            arg = None
+
+        else:
+            command = line[:i].upper()
+            arg = line[i + 1:].strip()
+
+        method = getattr(self, 'smtp_' + command, None)
+        if not method:
+            self.push('502 Error: command "%s" not implemented' % command)
+            return True
+
+        method(arg)
+        return True
+
+    def _feed(self, data):
+        """
+        Feed message data into the message stream, unless the message
+        has grown too large, in which case it is discarded.
+        """
+        self._size += len(data)
+        if self._max_size and self._size > self._max_size:
+            # Let go of whatever was parsed, the message is refused
+            self._oversize = True
+            self._stream = None
+
+        if self._stream is not None and self._admission:
+            if self._admission.buffer(len(data)):
+                self._held += len(data)
+
+            else:
+                # Out of room, let go of the message and defer it
+                self._deferred = True
+                self._stream = None
+                self._release()
+
+        if self._stream is not None:
+            self._stream.feed(data)
+
+    def _data(self):
+        """
+        Feed message data into the message stream, up to the end of
+        the message if it is buffered.
+
+        Returns whether the end of the message was found.
+
+        """
+        # The data can end right away, with an empty message
+        if not self._data_started:
+            if len(self._buffer) < 3 and '.\r\n'.startswith(self._buffer):
+                return False
+
+            self._data_started = True
+            if self._buffer.startswith('.\r\n'):
+                self._buffer = self._buffer[3:]
+                self._end_data()
+                return True
+
+        i = self._buffer.find('\r\n.\r\n')
+        if i < 0:
+            # Hold back what could be the start of the end
+            keep = min(len(self._buffer), 4)
+            if len(self._buffer) > keep:
+                self._feed(self._buffer[:-keep])
+                self._buffer = self._buffer[-keep:]
+
+            return False
+
+        self._feed(self._buffer[:i])
+        self._buffer = self._buffer[i + 5:]
+        self._end_data()
+        return True
+
+    def _chunk(self):
+        """
+        Feed the BDAT chunk being read into the message stream, and
+        answer it once it has all been read.
+
+        Returns whether the whole chunk was read.
+
+        """
+        data = self._buffer[:self._chunk_left]
+        self._buffer = self._buffer[len(data):]
+        self._chunk_left -= len(data)
+
+        if self._chunk_error is None and data:
+            # The message ends with the line ending of the last chunk,
+            # which is no part of it, as with DATA
+            data = self._chunk_tail + data
+            self._chunk_tail = ''
+            if data.endswith('\r\n'):
+                data, self._chunk_tail = data[:-2], '\r\n'
+
+            elif data.endswith('\r'):
+                data, self._chunk_tail = data[:-1], '\r'
+
+            self._feed(data)
+
+        if self._chunk_left:
+            return False
+
+        self._state = self.COMMAND
+        if self._chunk_error is not None:
+            self.push(self._chunk_error)
+
+        elif self._oversize:
+            self._reset()
+            self.push('552 5.3.4 Error: message size exceeds fixed '
+                      'maximum message size')
+
+        elif self._deferred:
+            self._reset()
+            self.push('451 4.3.2 Error: too busy, try again later')
+
+        elif self._chunk_last:
+            if self._chunk_tail != '\r\n':
+                self._feed(self._chunk_tail)
+
+            self._chunk_tail = ''
+            self._end_data()
+
+        else:
+            self.push('250 2.0.0 Ok: %s octets' % self._chunk_size)
+
+        return True
+
+    def _reset(self):
+        """
+        Forget the message being sent, if any.
+        """
+        self._mailfrom = None
+        self._rcpttos = []
+        self._stream = None
+        self._size = 0
+        self._oversize = False
+        self._deferred = False
+        self._chunk_tail = ''
+        self._state = self.COMMAND
+        self._release()
+
+    def _release(self):
+        """
+        Give back the room taken for the message being received.
+        """
+        if self._held:
+            self._admission.release(self._held)
+            self._held = 0
+
+    def _end_data(self):
+        """
+        Hand the message over and answer it, or wait for its verdict.
+        """
+        # The stream has de-transparencied the data for us
+        stream = self._stream
+        mailfrom = self._mailfrom
+        rcpttos = self._rcpttos
+        oversize = self._oversize
+        deferred = self._deferred
+        # The message stays in memory until its verdict is in
+        held, self._held = self._held, 0
+        self._reset()
+
+        if oversize:
+            self.push('552 5.3.4 Error: message size exceeds fixed '
+                      'maximum message size')
+            return
+
+        if deferred:
+            self.push('451 4.3.2 Error: too busy, try again later')
+            return
+
+        try:
+            status = self._server.process_message(self._peer, mailfrom,
+                                                  rcpttos, stream.close(),
+                                                  stream=stream)
+
+        except Exception:
+            self.logger.exception('Processing failed; From: %s; To: %s'
+                                  % (mailfrom, rcpttos))
+            status = '451 4.3.0 Error: processing failed'
+
+        if isinstance(status, Pending):
+            # Hold on to anything the client already pipelined
+            # until we can answer this message
+            self._pending = status
+            if self._pause_reading:
+                self._pause_reading()
+
+            if held:
+                status.add_callback(
+                    lambda status: self._admission.release(held))
+
+            status.add_callback(self._resume)
+
+        else:
+            if held:
+                self._admission.release(held)
+
+            self._reply(status)
+
+    def _reply(self, status):
+        """
+        Answer the end of the message data.
+        """
+        if not status:
+            self.push('250 Ok')
+
+        else:
+            self.push(status)
+
+    def _resume(self, status):
+        """
+        Answer a message whose verdict was pending and pick up
+        any held input.
+        """
+        self._pending = None
+        if self.closed:
+            return
+
+        try:
+            self._reply(status)
+
+            if self._resume_reading:
+                self._resume_reading()
+
+            self._process()
+
+        except Exception:
+            # Only this session is lost, not the loop delivering verdicts
+            self.logger.exception('Session failed; Peer: %s'
+                                  % str(self._peer))
+            self.push('451 4.3.0 Error: processing failed')
+            self.quit()
+
+    def _begin(self):
+        """
+        Start handing the message to the server.
+        """
+        self._size = 0
+        self._oversize = False
+        self._stream = self._server.begin_message(self._peer,
+                                                  self._mailfrom,
+                                                  self._rcpttos)
+
+    # SMTP commands
+    def smtp_HELO(self, arg):
+        if not arg:
+            self.push('501 Syntax: HELO hostname')
+            return
+
+        if self._greeting:
+            self.push('503 Duplicate HELO/EHLO')
+
+        else:
+            self._greeting = arg
+            self.push('250 %s' % fqdn())
+
+    def smtp_EHLO(self, arg):
+        if not arg:
+            self.push('501 Syntax: EHLO hostname')
+            return
+
+        if self._greeting:
+            self.push('503 Duplicate HELO/EHLO')
+            return
+
+        self._greeting = arg
+        self._extended = True
+        self.push('250-%s' % fqdn())
+        if self._max_size:
+            self.push('250-SIZE %s' % self._max_size)
+
+        else:
+            self.push('250-SIZE')
+
+        self.push('250-8BITMIME')
+        self.push('250-PIPELINING')
+        self.push('250 CHUNKING')
+
+    def smtp_NOOP(self, arg):
+        if arg:
+            self.push('501 Syntax: NOOP')
+
+        else:
+            self.push('250 Ok')
+
+    def smtp_QUIT(self, arg):
+        self.push('221 Bye')
+        self.quit()
+
+    def _getaddr(self, keyword, arg):
+        """
+        Pull an address, and any ESMTP parameters after it, out of
+        a MAIL or RCPT argument.
+
+        Returns an (address, parameters) tuple, parameters being a list
+        of the strings after the address.
+
+        """
+        address = None
+        params = []
+        keylen = len(keyword)
+        if arg[:keylen].upper() == keyword:
+            address = arg[keylen:].strip()
+            if address.startswith('<'):
+                i = address.find('>')
+                if i >= 0:
+                    params = address[i + 1:].split()
+                    address = address[:i + 1]
+
+            else:
+                params = address.split()
+                address = params.pop(0) if params else ''
+
+            if not address:
+                pass
+
+            elif address[0] == '<' and address[-1] == '>' and address != '<>':
+                # Addresses can be in the form <person@dom.com> but watch out
+                # for null address, e.g. <>
+                address = address[1:-1]
+
+        return address, params
+
+    def smtp_MAIL(self, arg):
+        syntax = '501 Syntax: MAIL FROM:<address>'
+        if self._extended:
+            syntax += ' [SIZE=<size>] [BODY=7BIT|8BITMIME]'
+
+        address, params = self._getaddr('FROM:', arg) if arg else (None, [])
+        if not address:
+            self.push(syntax)
+            return
+
+        if params and not self._extended:
+            # Parameters need EHLO
+            self.push(syntax)
+            return
+
+        if self._mailfrom:
+            self.push('503 Error: nested MAIL command')
+            return
+
+        if self._admission and self._admission.busy():
+            self.push('451 4.3.2 Error: too busy, try again later')
+            return
+
+        for param in params:
+            key, _, value = param.partition('=')
+            key = key.upper()
+            if key == 'SIZE':
+                if not value.isdigit():
+                    self.push(syntax)
+                    return
+
+                # Refuse it now rather than after it has all been sent
+                if self._max_size and int(value) > self._max_size:
+                    self.push('552 5.3.4 Error: message size exceeds fixed '
+                              'maximum message size')
+                    return
+
+            elif key == 'BODY':
+                if value.upper() not in self.BODY_TYPES:
+                    self.push('501 Error: BODY can only be one of %s'
+                              % ', '.join(self.BODY_TYPES))
+                    return
+
+            else:
+                self.push('555 MAIL FROM parameters not recognized '
+                          'or not implemented')
+                return
+
+        self._mailfrom = address
+        self.push('250 Ok')
+
+    def smtp_RCPT(self, arg):
+        if not self._mailfrom:
+            self.push('503 Error: need MAIL command')
+            return
+
+        address, params = self._getaddr('TO:', arg) if arg else (None, [])
+        if not address:
+            self.push('501 Syntax: RCPT TO: <address>')
+            return
+
+        if params:
+            self.push('555 RCPT TO parameters not recognized '
+                      'or not implemented')
+            return
+
+        self._rcpttos.append(address)
+        self.push('250 Ok')
+
+    def smtp_RSET(self, arg):
+        if arg:
+            self.push('501 Syntax: RSET')
+            return
+
+        # Resets the sender, recipients, and data, but not the greeting
+        self._reset()
+        self.push('250 Ok')
+
+    def smtp_DATA(self, arg):
+        if not self._rcpttos:
+            self.push('503 Error: need RCPT command')
+            return
+
+        if arg:
+            self.push('501 Syntax: DATA')
+            return
+
+        if self._stream is not None:
+            self.push('503 Error: BDAT already started the message')
+            return
+
+        self._state = self.DATA
+        self._data_started = False
+        self._begin()
+        self.push('354 End data with <CR><LF>.<CR><LF>')
+
+    def smtp_BDAT(self, arg):
+        words = arg.split() if arg else []
+        last = len(words) == 2 and words[1].upper() == 'LAST'
+        if not words or not words[0].isdigit() or len(words) > 2 or \
+                (len(words) == 2 and not last):
+            # Without a size there is no telling where the chunk ends
+            self.push('501 Syntax: BDAT <size> [LAST]')
+            return
+
+        size = int(words[0])
+        error = None
+        if not self._rcpttos:
+            error = '503 Error: need RCPT command'
+
+        elif self._max_size and self._size + size > self._max_size:
+            # Refuse it without keeping any of it
+            error = ('552 5.3.4 Error: message size exceeds '
+                     'fixed maximum message size')
+            self._reset()
+
+        elif self._stream is None and not self._oversize:
+            self._begin()
+            self._stream.stuffed = False
+
+        # The chunk is read even when it is refused
+        self._state = self.BDAT
+        self._chunk_size = size
+        self._chunk_left = size
+        self._chunk_last = last
+        self._chunk_error = error
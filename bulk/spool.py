@@ -0,0 +1,367 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import time
+import uuid
+import heapq
+import pickle
+import socket
+import logging
+import smtplib
+import threading
+
+# Bulk Imports
+from bulk import metrics
+from bulk.helpers import make_directory, fsync_directory
+
+
+class Spool(object):
+    """
+    A durable on-disk queue of messages waiting to go upstream.
+
+    Accepted messages are written to the spool and fsynced before the
+    client gets its answer, and a set of delivery threads drains it in
+    the background, retrying temporary failures with exponential backoff.
+    Messages that fail permanently, or for too long, and envelopes that
+    cannot be read are moved aside to the failed directory.
+
+    Layout inside the spool directory:
+    tmp/ -- envelopes being written
+    queue/ -- envelopes waiting for delivery
+    failed/ -- envelopes that could not be delivered
+    """
+
+    def __init__(self, location, upstream, workers=2, max_age=432000,
+                 min_backoff=60, max_backoff=3600):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        location -- spool directory
+        upstream -- upstream.UpstreamPool to deliver through
+        workers -- number of delivery threads
+        max_age -- seconds to keep retrying a message before giving up
+        min_backoff -- seconds to wait before the first retry
+        max_backoff -- most seconds to wait between retries
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._location = location
+        self._tmp = os.path.join(location, 'tmp')
+        self._queue = os.path.join(location, 'queue')
+        self._failed = os.path.join(location, 'failed')
+        for dn in [self._tmp, self._queue, self._failed]:
+            make_directory(dn)
+
+        self._upstream = upstream
+        self._workers = workers
+        self._max_age = max_age
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+
+        # Heap of (next attempt, envelope id) and the queued time
+        # and attempt count of every envelope in the queue
+        self._schedule = []
+        self._queued = {}
+        self._attempts = {}
+        self._lock = threading.Condition()
+        self._threads = []
+        self._last_report = 0
+
+        self._recover()
+
+    def __str__(self):
+        """
+        Pretty way to print the spool.
+        """
+        depth, age = self.stats()
+        return 'Spool at %s with %s delivery workers; Depth: %s; ' \
+               'Oldest: %0.0f seconds' % (self._location, self._workers,
+                                          depth, age)
+
+    def stats(self):
+        """
+        Returns a tuple of the number of queued messages and the
+        age in seconds of the oldest one.
+        """
+        with self._lock:
+            if not self._queued:
+                return (0, 0.0)
+
+            return (len(self._queued),
+                    time.time() - min(self._queued.values()))
+
+    def enqueue(self, mailfrom, rcpttos, data):
+        """
+        Durably queue a message for delivery.
+
+        Keyword arguments:
+        mailfrom -- envelope sender
+        rcpttos -- list of envelope recipients
+        data -- the message text
+
+        Raises IOError or OSError if the message could not be queued.
+
+        """
+        queued = time.time()
+        envelope_id = '%017.6f.%s' % (queued, uuid.uuid4().hex)
+        self._write(envelope_id, {'mailfrom': mailfrom,
+                                  'rcpttos': list(rcpttos),
+                                  'data': data,
+                                  'queued': queued})
+        fsync_directory(self._queue)
+
+        self._schedule_envelope(envelope_id, queued, queued, 0)
+
+    def start(self):
+        """
+        Start the delivery threads.
+        """
+        for i in range(self._workers):
+            thread = threading.Thread(target=self._run,
+                                      name='bulk-spool-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _write(self, envelope_id, envelope):
+        """
+        Write an envelope to tmp, fsync it, and move it into the queue.
+        """
+        tmp = os.path.join(self._tmp, envelope_id)
+        with open(tmp, 'wb') as f:
+            pickle.dump(envelope, f, pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(tmp, os.path.join(self._queue, envelope_id))
+
+    def _recover(self):
+        """
+        Pick up envelopes left in the queue by a previous run.
+        """
+        # Anything still in tmp was never acknowledged to a client
+        for fn in os.listdir(self._tmp):
+            os.unlink(os.path.join(self._tmp, fn))
+
+        now = time.time()
+        for envelope_id in sorted(os.listdir(self._queue)):
+            try:
+                queued = float(envelope_id.rsplit('.', 1)[0])
+
+            except (IndexError, ValueError):
+                self.logger.error('Ignoring unknown file in spool: %s'
+                                  % envelope_id)
+                continue
+
+            self._schedule_envelope(envelope_id, queued, now, 0)
+
+        if self._queued:
+            self.logger.info('Recovered %s queued messages from %s'
+                             % (len(self._queued), self._queue))
+
+    def _schedule_envelope(self, envelope_id, queued, when, attempts):
+        """
+        Schedule a delivery attempt for an envelope.
+        """
+        with self._lock:
+            self._queued[envelope_id] = queued
+            self._attempts[envelope_id] = attempts
+            heapq.heappush(self._schedule, (when, envelope_id))
+            self._lock.notify()
+
+    def _next(self):
+        """
+        Wait for the next envelope that is due for delivery.
+        """
+        with self._lock:
+            while True:
+                now = time.time()
+                self._report(now)
+
+                if self._schedule and self._schedule[0][0] <= now:
+                    return heapq.heappop(self._schedule)[1]
+
+                if self._schedule:
+                    self._lock.wait(min(self._schedule[0][0] - now, 60))
+
+                else:
+                    self._lock.wait(60)
+
+    def _report(self, now):
+        """
+        Log the queue depth and age now and then. Called with the lock held.
+        """
+        if self._queued and now - self._last_report >= 60:
+            self._last_report = now
+            self.logger.info('Spool depth: %s; Oldest: %0.0f seconds'
+                             % (len(self._queued),
+                                now - min(self._queued.values())))
+
+    def _run(self):
+        """
+        Delivery thread main loop.
+        """
+        while True:
+            envelope_id = self._next()
+            try:
+                self._attempt(envelope_id)
+
+            except Exception:
+                self.logger.exception('Unexpected error delivering %s'
+                                      % envelope_id)
+                try:
+                    self._retry(envelope_id, None)
+
+                except Exception:
+                    # Still in the queue, for the next run to pick up
+                    self.logger.exception('Cannot schedule another attempt '
+                                          'at %s' % envelope_id)
+                    with self._lock:
+                        self._forget(envelope_id)
+
+    def _attempt(self, envelope_id):
+        """
+        Try to deliver one envelope.
+        """
+        fn = os.path.join(self._queue, envelope_id)
+        try:
+            with open(fn, 'rb') as f:
+                envelope = pickle.load(f)
+
+            mailfrom = envelope['mailfrom']
+            rcpttos = envelope['rcpttos']
+            data = envelope['data']
+
+        except Exception as e:
+            # Trying again would not make it any more readable
+            self.logger.error('Cannot read queued message %s: %s'
+                              % (envelope_id, e))
+            self._fail(envelope_id)
+            return
+
+        start = time.time()
+        try:
+            refused = self._upstream.send(mailfrom, rcpttos, data)
+            metrics.STAGE_SECONDS.labels('spool_delivery').observe(
+                time.time() - start)
+
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+
+        except (socket.error, smtplib.SMTPException) as e:
+            code = getattr(e, 'smtp_code', -1)
+            if 500 <= code < 600:
+                self.logger.error('Upstream rejected queued message %s; '
+                                  'From: %s; Error: %s %s'
+                                  % (envelope_id, mailfrom, code,
+                                     getattr(e, 'smtp_error', '')))
+                self._fail(envelope_id)
+
+            else:
+                self.logger.info('Upstream delivery of %s deferred: %s'
+                                 % (envelope_id, e))
+                self._retry(envelope_id, None)
+
+            return
+
+        # Recipients refused with a temporary error are retried
+        retry = [r for r, (code, msg) in refused.items()
+                 if not 500 <= code < 600]
+        for r, (code, msg) in refused.items():
+            if 500 <= code < 600:
+                self.logger.error('Upstream refused recipient; From: %s; '
+                                  'To: %s; Error: %s %s'
+                                  % (mailfrom, r, code, msg))
+
+        if retry:
+            envelope['rcpttos'] = retry
+            self._retry(envelope_id, envelope)
+            return
+
+        self.logger.info('Delivered queued message; From: %s; To: %s'
+                         % (str(mailfrom), str(rcpttos)))
+        try:
+            os.unlink(fn)
+
+        except OSError as e:
+            # Delivered all the same, so do not send it again
+            self.logger.error('Cannot remove delivered message %s: %s'
+                              % (envelope_id, e))
+
+        with self._lock:
+            self._forget(envelope_id)
+
+    def _retry(self, envelope_id, envelope):
+        """
+        Schedule another attempt, or give up on a message that has
+        been queued for too long.
+
+        Keyword arguments:
+        envelope_id -- the envelope to retry
+        envelope -- updated envelope to write back, if it changed
+
+        """
+        with self._lock:
+            queued = self._queued[envelope_id]
+            attempts = self._attempts[envelope_id] + 1
+
+        now = time.time()
+        if now - queued > self._max_age:
+            self.logger.error('Giving up on queued message %s after %s '
+                              'attempts' % (envelope_id, attempts))
+            self._fail(envelope_id)
+            return
+
+        if envelope is not None:
+            self._write(envelope_id, envelope)
+
+        backoff = min(self._min_backoff * 2 ** (attempts - 1),
+                      self._max_backoff)
+        self._schedule_envelope(envelope_id, queued, now + backoff, attempts)
+
+    def _fail(self, envelope_id):
+        """
+        Move an undeliverable envelope out of the queue.
+        """
+        try:
+            os.rename(os.path.join(self._queue, envelope_id),
+                      os.path.join(self._failed, envelope_id))
+
+        except OSError as e:
+            # Still in the queue, for the next run to pick up
+            self.logger.error('Cannot move %s to %s: %s'
+                              % (envelope_id, self._failed, e))
+
+        with self._lock:
+            self._forget(envelope_id)
+
+    def _forget(self, envelope_id):
+        """
+        Stop tracking an envelope. Called with the lock held.
+        """
+        self._queued.pop(envelope_id, None)
+        self._attempts.pop(envelope_id, None)
@@ -0,0 +1,146 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import time
+import pickle
+import logging
+
+# Bulk Imports
+from bulk.helpers import make_directory
+from bulk.writer import SyncWriter
+
+
+class AttachmentStore(object):
+    """
+    A content addressed, deduplicated store of attachments.
+
+    Each attachment is stored once, named by its SHA256 digest, in
+    fan-out sub directories:
+
+    <location>/ab/cd/abcd...<sha256>
+    <location>/ab/cd/abcd...<sha256>.sightings
+
+    Every time an attachment is seen, a small record of the sighting
+    is appended to its sightings file. Sightings refer to the saved
+    message they came from rather than carrying a copy of it.
+    """
+
+    def __init__(self, location, writer=None, levels=2, width=2):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        location -- directory to store attachments in
+        writer -- writer.StorageWriter to hand the writes to, if any
+        levels -- number of fan-out directory levels
+        width -- digest characters used to name each fan-out level
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._location = location
+        self._writer = writer or SyncWriter()
+        self._levels = levels
+        self._width = width
+        # Fan-out directories known to exist
+        self._directories = set()
+
+    def __str__(self):
+        """
+        Pretty way to print the store.
+        """
+        return 'AttachmentStore at %s' % self._location
+
+    def path(self, sha256):
+        """
+        Where an attachment is, or would be, stored.
+
+        Keyword arguments:
+        sha256 -- hex SHA256 digest of the attachment
+
+        """
+        parts = [sha256[i * self._width:(i + 1) * self._width]
+                 for i in range(self._levels)]
+        return os.path.join(self._location, *(parts + [sha256]))
+
+    def add(self, attachment, sighting):
+        """
+        Store an attachment, unless it already is, and record a sighting.
+
+        Keyword arguments:
+        attachment -- message.Attachment to store
+        sighting -- dictionary describing where the attachment was seen
+
+        Returns the path the attachment is stored at.
+
+        """
+        fn = self.path(attachment.sha256)
+        dn = os.path.dirname(fn)
+        if dn not in self._directories:
+            make_directory(dn)
+            self._directories.add(dn)
+
+        record = {'name': attachment.name,
+                  'size': attachment.size,
+                  'md5': attachment.md5,
+                  'sha1': attachment.sha1,
+                  'sha256': attachment.sha256,
+                  'attachment': fn,
+                  'time': time.time()}
+        record.update(sighting)
+
+        if attachment.path:
+            # Kept in a file, so copy it rather than read it into memory
+            self._writer.copy_once(fn, attachment)
+
+        else:
+            self._writer.write_once(fn, attachment.content)
+
+        self._writer.append(fn + '.sightings', record)
+        return fn
+
+    def sightings(self, sha256):
+        """
+        Read back every recorded sighting of an attachment.
+
+        Keyword arguments:
+        sha256 -- hex SHA256 digest of the attachment
+
+        Yields sighting dictionaries, oldest first.
+
+        """
+        try:
+            f = open(self.path(sha256) + '.sightings', 'rb')
+
+        except IOError:
+            return
+
+        with f:
+            while True:
+                try:
+                    yield pickle.load(f)
+
+                except EOFError:
+                    return
@@ -0,0 +1,186 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import time
+import logging
+from email.feedparser import FeedParser
+
+# Bulk Imports
+from bulk import metrics
+from bulk.message import attachment_from_part
+
+
+class _PartParser(FeedParser):
+    """
+    A FeedParser that reports each message part as soon as it is complete.
+    """
+
+    def __init__(self, on_part):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        on_part -- callable taking each completed email.message.Message part
+
+        """
+        FeedParser.__init__(self)
+        self._on_part = on_part
+
+    def _pop_message(self):
+        """
+        FeedParser pops a part off its stack once it has been fully parsed.
+        """
+        part = FeedParser._pop_message(self)
+        self._on_part(part)
+        return part
+
+
+class MessageStream(object):
+    """
+    Parses a message while its DATA is still arriving.
+
+    Raw SMTP DATA is fed in as it is received. Lines are de-transparencied
+    and handed to an incremental MIME parser, and each attachment is
+    passed to a callback as soon as its part closes, so attachments can be
+    scanned before the rest of the message has arrived.
+
+    Set stuffed to False before feeding anything for data that was not
+    dot-stuffed, such as BDAT chunks.
+    """
+
+    def __init__(self, on_attachment=None, memory_limit=0):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        on_attachment -- callable taking each message.Attachment
+        as it is found
+        memory_limit -- largest attachment, encoded, to decode in memory
+        rather than into a temporary file, 0 for no limit
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._on_attachment = on_attachment
+        self._memory_limit = memory_limit
+        self._parser = _PartParser(self._part_done)
+        self._lines = []
+        # Pieces of the line not yet ended, joined once it is
+        self._pending = []
+        self.stuffed = True
+        # Seconds spent parsing, decoding and hashing
+        self._elapsed = 0.0
+
+        # Attachments in the order their parts closed, along with
+        # whatever on_attachment returned for each of them
+        self.attachments = []
+        self.results = []
+        self.parsed_message = None
+
+    def feed(self, data):
+        """
+        Feed raw DATA as received from the client.
+
+        Keyword arguments:
+        data -- a chunk of raw message data, lines ending with CRLF
+
+        """
+        lines = []
+        if data[:1] == '\n' and self._pending and \
+                self._pending[-1].endswith('\r'):
+            # A CRLF split between reads
+            self._pending[-1] = self._pending[-1][:-1]
+            lines.append(''.join(self._pending))
+            self._pending = []
+            data = data[1:]
+
+        # Only the new data is searched for line endings, so a long
+        # line arriving in many reads is not copied over and over
+        pieces = data.split('\r\n')
+        if len(pieces) > 1:
+            self._pending.append(pieces[0])
+            lines.append(''.join(self._pending))
+            lines.extend(pieces[1:-1])
+            self._pending = []
+
+        if pieces[-1]:
+            self._pending.append(pieces[-1])
+
+        if lines:
+            start = time.time()
+            chunk = '\n'.join(self._unstuff(line) for line in lines) + '\n'
+            self._lines.append(chunk)
+            self._parser.feed(chunk)
+            self._elapsed += time.time() - start
+
+    def close(self):
+        """
+        Finish parsing.
+
+        The parsed email.message.Message is left in parsed_message.
+
+        Returns the message text, as smtpd would have passed
+        it to process_message.
+
+        """
+        # The last line has no line ending, just like smtpd
+        start = time.time()
+        last = self._unstuff(''.join(self._pending))
+        self._pending = []
+        self._lines.append(last)
+        self._parser.feed(last)
+
+        self.parsed_message = self._parser.close()
+        # The parser refers back to the stream, drop it so the stream
+        # and its attachments are freed as soon as they are unused
+        self._parser = None
+        data = ''.join(self._lines)
+
+        self._elapsed += time.time() - start
+        metrics.STAGE_SECONDS.labels('parse').observe(self._elapsed)
+        return data
+
+    def _unstuff(self, line):
+        """
+        De-transparency a line according to RFC 821, Section 4.5.2.
+        """
+        if self.stuffed and line and line[0] == '.':
+            return line[1:]
+
+        return line
+
+    def _part_done(self, part):
+        """
+        Collect a completed part if it is an attachment.
+        """
+        attachment_name = part.get_filename()
+
+        if attachment_name:
+            self.logger.info('Found attachment; Name: %s' % attachment_name)
+            attachment = attachment_from_part(attachment_name, part,
+                                              self._memory_limit)
+            self.attachments.append(attachment)
+
+            if self._on_attachment:
+                self.results.append(self._on_attachment(attachment))
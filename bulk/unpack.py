@@ -0,0 +1,430 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import bz2
+import zlib
+import logging
+import tarfile
+import zipfile
+import tempfile
+from contextlib import closing
+
+# Optional Imports
+try:
+    import py7zlib
+
+except ImportError:
+    py7zlib = None
+
+# Bulk Imports
+from bulk.message import Attachment
+from bulk.processors import Result
+
+
+class LimitReached(Exception):
+    """
+    Raised when unpacking an attachment goes over one of its budgets.
+    """
+    pass
+
+
+def archive_type(content):
+    """
+    Recognize an archive by its magic bytes.
+
+    Keyword arguments:
+    content -- the contents to look at, the first 512 bytes will do
+
+    Returns 'zip', 'gzip', 'bz2', 'tar' or '7z', or None when the
+    contents are not an archive that can be unpacked.
+
+    """
+    if content.startswith('PK\x03\x04'):
+        return 'zip'
+
+    if content.startswith('\x1f\x8b'):
+        return 'gzip'
+
+    if content.startswith('BZh'):
+        return 'bz2'
+
+    if content[257:262] == 'ustar':
+        return 'tar'
+
+    if content.startswith('7z\xbc\xaf\x27\x1c') and py7zlib is not None:
+        return '7z'
+
+    return None
+
+
+class _Budget(object):
+    """
+    What is left to spend unpacking one attachment.
+    """
+
+    def __init__(self, members, size):
+        self.members = members
+        self.size = size
+
+
+class Unpacker(object):
+    """
+    Recursively unpacks archives found in attachments.
+
+    Zip, tar, gzip and bzip2 archives are unpacked, as are 7z archives
+    when py7zlib is installed. Members are read out a chunk at a time
+    and each attachment has budgets for nesting depth, member count,
+    compression ratio and total unpacked bytes, so an archive bomb is
+    cut off long before it can exhaust memory or CPU. Large members
+    are kept in temporary files rather than in memory.
+    """
+
+    # Bytes read out of a member at a time
+    CHUNK_SIZE = 64 * 1024
+    # Members smaller than this are never too compressed
+    RATIO_FLOOR = 1024 * 1024
+    # Compressed bytes fed to the bzip2 decompressor at a time
+    BZ2_PIECE_SIZE = 64
+
+    def __init__(self, max_depth=3, max_members=1000, max_ratio=100,
+                 max_size=100 * 1024 * 1024, memory_limit=10 * 1024 * 1024):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        max_depth -- most levels of archives within archives to unpack
+        max_members -- most members to unpack from one attachment
+        max_ratio -- highest compression ratio allowed for a member
+        max_size -- most bytes to unpack from one attachment
+        memory_limit -- largest member to hold in memory, larger ones
+        go to a temporary file. 0 for no limit
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._max_depth = max_depth
+        self._max_members = max_members
+        self._max_ratio = max_ratio
+        self._max_size = max_size
+        self._memory_limit = memory_limit
+
+    def __str__(self):
+        """
+        Pretty way to print the unpacker.
+        """
+        return 'Unpacker; Depth: %s; Members: %s; Ratio: %s; Bytes: %s' % (
+            self._max_depth, self._max_members, self._max_ratio,
+            self._max_size)
+
+    def expand(self, attachment):
+        """
+        Unpack an attachment, if it is an archive.
+
+        Keyword arguments:
+        attachment -- the message.Attachment to unpack
+
+        Members are named after the archive they came out of, as in
+        'outer.zip/inner.tar/payload.exe'.
+
+        Returns a tuple holding the list of message.Attachments unpacked,
+        at every depth, and a list of incomplete Results describing any
+        members that could not be unpacked or budgets that ran out. What
+        could not be unpacked was not scanned, so the unpack failure
+        policy decides these.
+
+        """
+        members = []
+        problems = []
+        budget = _Budget(self._max_members, self._max_size)
+
+        try:
+            self._expand(attachment, 1, budget, members, problems)
+
+        except LimitReached as e:
+            problems.append('%s: %s' % (attachment.name, e))
+
+        for problem in problems:
+            self.logger.warning('Cannot fully unpack attachment; %s'
+                                % problem)
+
+        return members, [Result(__name__, False, error=problem,
+                                incomplete=True)
+                         for problem in problems]
+
+    def _expand(self, attachment, depth, budget, members, problems):
+        """
+        Unpack an attachment and every archive inside it.
+        """
+        f = attachment.open()
+        try:
+            kind = archive_type(f.read(512))
+
+        finally:
+            f.close()
+
+        if kind is None:
+            return
+
+        if depth > self._max_depth:
+            problems.append('%s: archives nested deeper than %s'
+                            % (attachment.name, self._max_depth))
+            return
+
+        unpack = getattr(self, '_unpack_' + kind)
+        try:
+            for name, (content, path) in unpack(attachment, budget,
+                                                 problems):
+                member = Attachment('%s/%s' % (attachment.name, name),
+                                    content, path)
+                self.logger.debug('Unpacked member; %s' % member)
+                members.append(member)
+
+                self._expand(member, depth + 1, budget, members, problems)
+
+        except LimitReached:
+            raise
+
+        except Exception as e:
+            # Malformed or truncated archives are to be expected
+            problems.append('%s: cannot unpack %s: %s'
+                            % (attachment.name, kind, e))
+
+    def _take_member(self, budget):
+        """
+        Count one more member against the budget.
+        """
+        budget.members -= 1
+        if budget.members < 0:
+            raise LimitReached('more than %s members' % self._max_members)
+
+    def _collect(self, chunks, packed_size, budget):
+        """
+        Gather a member's contents, checking each chunk against the budget.
+
+        Keyword arguments:
+        chunks -- iterable of unpacked chunks of the member
+        packed_size -- size of the member in the archive, if known
+        budget -- what is left to spend
+
+        Returns a (content, path) tuple. Members larger than the memory
+        limit are written to a temporary file, whose path is given in
+        place of the content.
+
+        """
+        collected = []
+        size = 0
+        f = None
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                if size > budget.size:
+                    raise LimitReached('more than %s bytes unpacked'
+                                       % self._max_size)
+
+                if packed_size and size > self.RATIO_FLOOR and \
+                        size > packed_size * self._max_ratio:
+                    raise LimitReached('member compressed more than %s to 1'
+                                       % self._max_ratio)
+
+                if f is None and self._memory_limit and \
+                        size > self._memory_limit:
+                    fd, path = tempfile.mkstemp(prefix='bulk-',
+                                                suffix='.tmp')
+                    f = os.fdopen(fd, 'wb')
+                    f.writelines(collected)
+                    collected = []
+
+                if f is None:
+                    collected.append(chunk)
+
+                else:
+                    f.write(chunk)
+
+        except BaseException:
+            if f is not None:
+                f.close()
+                os.remove(f.name)
+
+            raise
+
+        budget.size -= size
+        if f is None:
+            return ''.join(collected), None
+
+        f.close()
+        return None, path
+
+    def _read(self, f):
+        """
+        Read a file object a chunk at a time.
+        """
+        return iter(lambda: f.read(self.CHUNK_SIZE), '')
+
+    def _unpack_zip(self, attachment, budget, problems):
+        """
+        Yields (name, (content, path)) for each file in a zip archive.
+        """
+        source = attachment.open()
+        try:
+            archive = zipfile.ZipFile(source)
+            try:
+                for info in archive.infolist():
+                    if info.filename.endswith('/'):
+                        continue
+
+                    self._take_member(budget)
+                    if info.flag_bits & 0x1:
+                        problems.append('%s/%s: encrypted'
+                                        % (attachment.name, info.filename))
+                        continue
+
+                    f = archive.open(info)
+                    try:
+                        unpacked = self._collect(self._read(f),
+                                                 info.compress_size, budget)
+
+                    finally:
+                        f.close()
+
+                    yield info.filename, unpacked
+
+            finally:
+                archive.close()
+
+        finally:
+            source.close()
+
+    def _unpack_tar(self, attachment, budget, problems):
+        """
+        Yields (name, (content, path)) for each file in a tar archive.
+        """
+        source = attachment.open()
+        try:
+            archive = tarfile.open(fileobj=source, mode='r:')
+            try:
+                for info in archive:
+                    if not info.isfile():
+                        continue
+
+                    self._take_member(budget)
+                    with closing(archive.extractfile(info)) as f:
+                        unpacked = self._collect(self._read(f), None,
+                                                 budget)
+
+                    yield info.name, unpacked
+
+            finally:
+                archive.close()
+
+        finally:
+            source.close()
+
+    def _unpack_gzip(self, attachment, budget, problems):
+        """
+        Yields (name, (content, path)) for the file in a gzip stream.
+        """
+        def chunks(source):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            for data in self._read(source):
+                while data:
+                    yield decompressor.decompress(data, self.CHUNK_SIZE)
+                    data = decompressor.unconsumed_tail
+
+                if decompressor.unused_data:
+                    # Anything after the end of the stream is ignored
+                    return
+
+            yield decompressor.flush()
+
+        self._take_member(budget)
+        source = attachment.open()
+        try:
+            unpacked = self._collect(chunks(source), attachment.size, budget)
+
+        finally:
+            source.close()
+
+        yield self._unpacked_name(attachment.name, '.gz'), unpacked
+
+    def _unpack_bz2(self, attachment, budget, problems):
+        """
+        Yields (name, (content, path)) for the file in a bzip2 stream.
+        """
+        def chunks(source):
+            # The decompressor cannot limit its output, so feed it tiny
+            # pieces and check the output as it grows. A piece can still
+            # finish a block or two, tens of megabytes at worst
+            decompressor = bz2.BZ2Decompressor()
+            for data in self._read(source):
+                for offset in xrange(0, len(data), self.BZ2_PIECE_SIZE):
+                    try:
+                        yield decompressor.decompress(
+                            data[offset:offset + self.BZ2_PIECE_SIZE])
+
+                    except EOFError:
+                        # Anything after the end of the stream is ignored
+                        return
+
+        self._take_member(budget)
+        source = attachment.open()
+        try:
+            unpacked = self._collect(chunks(source), attachment.size, budget)
+
+        finally:
+            source.close()
+
+        yield self._unpacked_name(attachment.name, '.bz2'), unpacked
+
+    def _unpack_7z(self, attachment, budget, problems):
+        """
+        Yields (name, (content, path)) for each file in a 7z archive.
+        """
+        source = attachment.open()
+        try:
+            archive = py7zlib.Archive7z(source)
+            for member in archive.getmembers():
+                self._take_member(budget)
+
+                # py7zlib unpacks a member in one go, so go by its
+                # stated size
+                if member.size > budget.size:
+                    raise LimitReached('more than %s bytes unpacked'
+                                       % self._max_size)
+
+                yield member.filename, self._collect([member.read()], None,
+                                                     budget)
+
+        finally:
+            source.close()
+
+    def _unpacked_name(self, name, extension):
+        """
+        Name the file inside a compressed stream after the stream.
+        """
+        name = name.rsplit('/', 1)[-1]
+        if name.lower().endswith(extension):
+            return name[:-len(extension)]
+
+        return name + '.out'
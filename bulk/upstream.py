@@ -0,0 +1,320 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import time
+import socket
+import logging
+import smtplib
+import threading
+
+
+class _Connection(object):
+    """
+    An open upstream SMTP connection and its bookkeeping.
+    """
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.messages = 0
+        self.last_used = time.time()
+
+
+class UpstreamPool(object):
+    """
+    A pool of persistent SMTP connections to the upstream MTA.
+
+    Connections are kept open between messages and reset with RSET
+    before being reused, instead of being set up and torn down for
+    every message. Connections are retired once they have been idle
+    too long or have carried enough messages.
+    """
+
+    def __init__(self, address, max_connections=4, idle_timeout=60,
+                 max_messages=100, timeout=30):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        address -- tuple of (host, port) of the upstream MTA
+        max_connections -- most connections open at once
+        idle_timeout -- seconds an unused connection is kept open
+        max_messages -- messages sent over a connection before it is closed
+        timeout -- socket timeout in seconds
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._address = address
+        self._max_connections = max_connections
+        self._idle_timeout = idle_timeout
+        self._max_messages = max_messages
+        self._timeout = timeout
+        # Looked up once rather than on every connect
+        self._local_hostname = socket.getfqdn()
+
+        self._idle = []
+        self._open = 0
+        self._lock = threading.Condition()
+
+        # Close idle connections even when no messages come along
+        self._stopping = threading.Event()
+        self._reaper = None
+        if idle_timeout:
+            self._reaper = threading.Thread(target=self._reap_idle,
+                                            name='bulk-upstream-reaper')
+            self._reaper.daemon = True
+            self._reaper.start()
+
+    def __str__(self):
+        """
+        Pretty way to print the pool.
+        """
+        return 'UpstreamPool to %s:%s with %s of %s connections open' % (
+            self._address[0], self._address[1], self._open,
+            self._max_connections)
+
+    def send(self, mailfrom, rcpttos, data):
+        """
+        Send a message upstream.
+
+        Keyword arguments:
+        mailfrom -- envelope sender
+        rcpttos -- list of envelope recipients
+        data -- the message text
+
+        Returns a dictionary of refused recipients, as smtplib.sendmail.
+        Raises smtplib.SMTPException or socket.error if the message
+        could not be sent to any recipient.
+
+        """
+        conn = self._acquire()
+        try:
+            try:
+                refused = conn.smtp.sendmail(mailfrom, rcpttos, data)
+
+            except smtplib.SMTPServerDisconnected:
+                # The upstream dropped a connection we thought was
+                # still good, try once more on a fresh one
+                self._discard(conn)
+                # Not ours to discard again if the reconnect fails
+                conn = None
+                conn = self._acquire(reuse=False)
+                refused = conn.smtp.sendmail(mailfrom, rcpttos, data)
+
+        except smtplib.SMTPRecipientsRefused:
+            # The connection is still in a good state
+            self._release(conn)
+            raise
+
+        except (socket.error, smtplib.SMTPException):
+            if conn is not None:
+                self._discard(conn)
+
+            raise
+
+        conn.messages += 1
+        self._release(conn)
+        return refused
+
+    def deliver(self, mailfrom, rcpttos, data):
+        """
+        Send a message upstream, the way smtpd.PureProxy._deliver does.
+
+        Keyword arguments:
+        mailfrom -- envelope sender
+        rcpttos -- list of envelope recipients
+        data -- the message text
+
+        Returns a dictionary of refused recipients. Failures are
+        reported as every recipient being refused.
+
+        """
+        refused = {}
+        try:
+            refused = self.send(mailfrom, rcpttos, data)
+
+        except smtplib.SMTPRecipientsRefused as e:
+            refused = e.recipients
+
+        except (socket.error, smtplib.SMTPException) as e:
+            # All recipients were refused. If the exception had an
+            # associated error code, use it.
+            errcode = getattr(e, 'smtp_code', -1)
+            errmsg = getattr(e, 'smtp_error', str(e))
+            for r in rcpttos:
+                refused[r] = (errcode, errmsg)
+
+        return refused
+
+    def reap(self):
+        """
+        Close the connections that have been idle too long.
+
+        Returns the number of connections closed.
+
+        """
+        now = time.time()
+        with self._lock:
+            retired = [conn for conn in self._idle
+                       if now - conn.last_used > self._idle_timeout]
+            self._idle = [conn for conn in self._idle
+                          if conn not in retired]
+
+        for conn in retired:
+            self._discard(conn, quit=True)
+
+        if retired:
+            self.logger.debug('Closed %s idle upstream connections'
+                              % len(retired))
+
+        return len(retired)
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+        self._stopping.set()
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn in idle:
+            self._discard(conn, quit=True)
+
+    def _acquire(self, reuse=True):
+        """
+        Get a connection that is ready for a new transaction.
+
+        Keyword arguments:
+        reuse -- whether an idle connection may be handed out
+
+        """
+        while True:
+            conn = None
+            retired = []
+
+            with self._lock:
+                while True:
+                    if reuse and self._idle:
+                        # Most recently used first, so spare
+                        # connections get a chance to expire
+                        conn = self._idle.pop()
+                        if time.time() - conn.last_used <= self._idle_timeout:
+                            break
+
+                        retired.append(conn)
+                        self._open -= 1
+                        conn = None
+
+                    elif self._open < self._max_connections:
+                        self._open += 1
+                        break
+
+                    elif self._idle:
+                        # Make room for a fresh connection
+                        retired.append(self._idle.pop(0))
+                        self._open -= 1
+
+                    else:
+                        self._lock.wait()
+
+            for old in retired:
+                self._close(old, quit=True)
+
+            if conn is None:
+                return self._connect()
+
+            try:
+                # Make sure the connection is still alive and
+                # starts from a clean transaction
+                conn.smtp.rset()
+                return conn
+
+            except (socket.error, smtplib.SMTPException):
+                self.logger.debug('Upstream connection went stale')
+                self._discard(conn)
+
+    def _reap_idle(self):
+        """
+        Reaper thread main loop.
+        """
+        # Checking twice per timeout keeps connections from
+        # outliving it by more than half
+        while not self._stopping.wait(self._idle_timeout / 2.0):
+            self.reap()
+
+    def _connect(self):
+        """
+        Open a new upstream connection, counted as open by the caller.
+        """
+        try:
+            smtp = smtplib.SMTP(self._address[0], self._address[1],
+                                self._local_hostname, self._timeout)
+
+        except:
+            with self._lock:
+                self._open -= 1
+                self._lock.notify()
+
+            raise
+
+        self.logger.debug('Opened upstream connection to %s:%s'
+                          % self._address)
+        return _Connection(smtp)
+
+    def _release(self, conn):
+        """
+        Return a connection to the pool, or retire it.
+        """
+        if conn.messages >= self._max_messages:
+            self._discard(conn, quit=True)
+            return
+
+        conn.last_used = time.time()
+        with self._lock:
+            self._idle.append(conn)
+            self._lock.notify()
+
+    def _discard(self, conn, quit=False):
+        """
+        Retire a connection.
+        """
+        with self._lock:
+            self._open -= 1
+            self._lock.notify()
+
+        self._close(conn, quit)
+
+    def _close(self, conn, quit):
+        """
+        Close a connection, politely if asked to.
+        """
+        try:
+            if quit:
+                conn.smtp.quit()
+
+            else:
+                conn.smtp.close()
+
+        except (socket.error, smtplib.SMTPException):
+            conn.smtp.close()
@@ -0,0 +1,384 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import time
+import uuid
+import Queue
+import pickle
+import shutil
+import logging
+import threading
+
+# Bulk Imports
+from bulk import metrics
+from bulk.helpers import fsync_directory
+
+
+def write_batch(batch, fsync=False):
+    """
+    Carry out a batch of writes, then sync them if asked to.
+
+    Keyword arguments:
+    batch -- list of (operation, path, data) tuples
+    fsync -- whether to sync the batch to disk
+
+    Operations are:
+    write -- write the string data to path
+    dump -- pickle data to path
+    write_once -- write the string data to path unless path exists
+    copy_once -- copy data, anything with an open() method returning a
+    file object, to path unless path exists
+    append -- append data, pickled, to path
+
+    With fsync, the batch is group committed: everything is written
+    first and then all of it is synced together.
+
+    Returns the number of writes carried out.
+
+    """
+    logger = logging.getLogger('bulk')
+    start = time.time()
+
+    written = []
+    for op, path, data in batch:
+        once = op in ('write_once', 'copy_once')
+        if once and os.path.exists(path):
+            continue
+
+        # Write-once files only appear under their name when complete
+        target = path
+        if once:
+            target = '%s.%s.tmp' % (path, uuid.uuid4().hex)
+
+        try:
+            f = open(target, 'ab' if op == 'append' else 'wb')
+
+        except IOError:
+            logger.error('Cannot write to %s' % path)
+            logger.error('Ensure the directory exists \
+                         and permissions are correct')
+            continue
+
+        try:
+            if op in ('dump', 'append'):
+                # One write call, so appended records stay whole
+                f.write(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+            elif op == 'copy_once':
+                source = data.open()
+                try:
+                    shutil.copyfileobj(source, f)
+
+                finally:
+                    source.close()
+
+            else:
+                f.write(data)
+
+            f.flush()
+
+        except IOError:
+            logger.error('Cannot write to %s' % path)
+            f.close()
+            continue
+
+        written.append((f, op, path))
+
+    for f, op, path in written:
+        if fsync:
+            try:
+                os.fsync(f.fileno())
+
+            except OSError:
+                logger.error('Cannot sync %s' % path)
+
+        f.close()
+
+        if op in ('write_once', 'copy_once'):
+            # Content addressed, so losing a race to
+            # an identical copy does no harm
+            try:
+                os.rename(f.name, path)
+
+            except OSError:
+                logger.error('Cannot write to %s' % path)
+
+    if fsync:
+        for dn in set(os.path.dirname(path) for f, op, path in written):
+            try:
+                fsync_directory(dn)
+
+            except OSError:
+                logger.error('Cannot sync %s' % dn)
+
+    metrics.STAGE_SECONDS.labels('storage').observe(time.time() - start)
+    return len(written)
+
+
+class SyncWriter(object):
+    """
+    Writes files right away, on the calling thread.
+
+    Offers the same calls as StorageWriter for code that
+    can work with either.
+    """
+
+    def __init__(self, fsync=False):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        fsync -- whether to sync every write to disk
+
+        """
+        self._fsync = fsync
+
+    def write(self, path, data):
+        write_batch([('write', path, data)], self._fsync)
+
+    def dump(self, path, obj):
+        write_batch([('dump', path, obj)], self._fsync)
+
+    def write_once(self, path, data):
+        write_batch([('write_once', path, data)], self._fsync)
+
+    def copy_once(self, path, source):
+        write_batch([('copy_once', path, source)], self._fsync)
+
+    def append(self, path, obj):
+        write_batch([('append', path, obj)], self._fsync)
+
+
+class StorageWriter(object):
+    """
+    Writes files on a background thread.
+
+    Writes are queued and the writer thread handles them in batches.
+    With fsync turned on, a batch is group committed: every file in it
+    is written first and then all of them are synced together. When
+    the queue is full, callers wait for room and the stall is counted
+    and logged so back-pressure from the disk is visible. A batch that
+    fails is logged and counted in lost, and should the writer thread
+    die anyway, writes are carried out on the calling thread instead.
+    """
+
+    # Seconds between checks that the writer thread is alive while
+    # waiting for room in the queue
+    PUT_TIMEOUT = 1.0
+
+    def __init__(self, max_queue=1000, batch_size=64, fsync=False):
+        """
+        Default initializer.
+
+        Keyword arguments:
+        max_queue -- most writes waiting before callers have to wait
+        batch_size -- most writes handled per batch
+        fsync -- whether to sync every batch to disk
+
+        """
+        self.logger = logging.getLogger('bulk')
+
+        self._queue = Queue.Queue(max_queue)
+        self._batch_size = batch_size
+        self._fsync = fsync
+
+        self.stalls = 0
+        self.batches = 0
+        self.writes = 0
+        self.lost = 0
+        self._last_warning = 0
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='bulk-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __str__(self):
+        """
+        Pretty way to print the writer.
+        """
+        return 'StorageWriter with %s of %s writes queued; Stalls: %s; ' \
+               'Lost: %s' % (self.depth, self._queue.maxsize, self.stalls,
+                             self.lost)
+
+    @property
+    def depth(self):
+        """
+        Number of writes waiting to be handled.
+        """
+        return self._queue.qsize()
+
+    def write(self, path, data):
+        """
+        Queue a string to be written to a file.
+
+        Keyword arguments:
+        path -- file to write
+        data -- string to write to it
+
+        """
+        self._put(('write', path, data))
+
+    def dump(self, path, obj):
+        """
+        Queue an object to be pickled to a file.
+
+        Keyword arguments:
+        path -- file to write
+        obj -- object to pickle into it
+
+        """
+        self._put(('dump', path, obj))
+
+    def write_once(self, path, data):
+        """
+        Queue a string to be written to a file that does not exist yet.
+
+        Keyword arguments:
+        path -- file to write, left alone if it already exists
+        data -- string to write to it
+
+        """
+        self._put(('write_once', path, data))
+
+    def copy_once(self, path, source):
+        """
+        Queue a copy to a file that does not exist yet.
+
+        Keyword arguments:
+        path -- file to write, left alone if it already exists
+        source -- object with an open() method returning a file object
+        to copy from, such as a message.Attachment. It is held until
+        the copy is done
+
+        """
+        self._put(('copy_once', path, source))
+
+    def append(self, path, obj):
+        """
+        Queue an object to be pickled onto the end of a file.
+
+        Keyword arguments:
+        path -- file to append to
+        obj -- object to pickle onto it
+
+        """
+        self._put(('append', path, obj))
+
+    def close(self):
+        """
+        Wait for every queued write to be handled and stop the writer.
+        """
+        self._put(None)
+        self._thread.join()
+
+    def _put(self, item):
+        """
+        Queue an item, waiting for room if the queue is full, or carry
+        it out right away if the writer thread is gone.
+        """
+        if not self._thread.is_alive():
+            self._write_now(item)
+            return
+
+        try:
+            self._queue.put_nowait(item)
+            return
+
+        except Queue.Full:
+            self.stalls += 1
+            now = time.time()
+            if now - self._last_warning >= 10:
+                self._last_warning = now
+                self.logger.warning('Storage writer is falling behind, '
+                                    '%s writes queued; Stalls: %s'
+                                    % (self.depth, self.stalls))
+
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=self.PUT_TIMEOUT)
+                return
+
+            except Queue.Full:
+                pass
+
+        self._write_now(item)
+
+    def _write_now(self, item):
+        """
+        Carry out an item, and whatever is still queued, on the calling
+        thread once the writer thread is gone.
+        """
+        self.logger.error('Storage writer thread is not running, '
+                          'writing on the calling thread')
+
+        batch = [item]
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+
+            except Queue.Empty:
+                break
+
+        batch = filter(None, batch)
+        try:
+            self.writes += write_batch(batch, self._fsync)
+
+        except Exception:
+            self.logger.exception('Cannot carry out %s writes' % len(batch))
+            self.lost += len(batch)
+
+    def _run(self):
+        """
+        Writer thread main loop.
+        """
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+
+                except Queue.Empty:
+                    break
+
+            done = None in batch
+            batch = filter(None, batch)
+            try:
+                self.writes += write_batch(batch, self._fsync)
+
+            except Exception:
+                # Keep writing whatever comes next
+                self.logger.exception('Storage writer failed on a batch '
+                                      'of %s writes' % len(batch))
+                self.lost += len(batch)
+
+            self.batches += 1
+
+            # Let go of the batch, which can hold attachments and their
+            # temporary files, before waiting for the next one
+            del batch
+
+            if done:
+                return
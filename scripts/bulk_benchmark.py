@@ -0,0 +1,179 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+from bulk import benchmark
+from bulk.helpers import *
+
+
+def show(results):
+    """
+    Print a table of benchmark results.
+
+    Keyword arguments:
+    results -- list of results returned by benchmark.run_benchmarks
+
+    """
+    print >>sys.stderr, '%-36s %8s %10s %10s %9s %9s %9s' % (
+        'Benchmark', 'Count', 'Per sec', 'MB/s', 'p50 ms', 'p90 ms',
+        'p99 ms')
+
+    for result in results:
+        latency = result.get('latency_ms', {})
+        print >>sys.stderr, '%-36s %8s %10.1f %10.2f %9.3f %9.3f %9.3f' % (
+            result['name'], result['count'], result['per_second'],
+            result['mb_per_second'], latency.get('p50', 0),
+            latency.get('p90', 0), latency.get('p99', 0))
+
+if __name__ == '__main__':
+    """
+    Main
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the parts of \
+                                     Bulk over a synthetic mail corpus')
+
+    parser.add_argument(
+        '--messages',
+        default=200,
+        type=int,
+        help='Number of messages in the corpus. Default is 200'
+    )
+
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='Random seed the corpus is generated from. The same seed \
+             always gives the same corpus. Default is 0'
+    )
+
+    parser.add_argument(
+        '--max_size',
+        default=1024 * 1024,
+        type=int,
+        help='Largest attachment in the corpus, in bytes. Default is \
+             1048576 (1 MB)'
+    )
+
+    parser.add_argument(
+        '--repeat',
+        default=3,
+        type=int,
+        help='Times to go over the corpus in each benchmark. Default is 3'
+    )
+
+    parser.add_argument(
+        '--benchmark',
+        default=[],
+        action='append',
+        choices=benchmark.BENCHMARKS,
+        dest='benchmarks',
+        help='Benchmark to run, can be given more than once. Default is \
+             to run every benchmark'
+    )
+
+    parser.add_argument(
+        '--processor',
+        default=[],
+        nargs='+',
+        action='append',
+        dest='processor_specs',
+        help='Processor to benchmark, as an import string followed by its \
+             rules files, as for bulk_proxy.py. Can be given more than once'
+    )
+
+    parser.add_argument(
+        '--fsync',
+        action='store_true',
+        help='Sync what the storage benchmarks write. Default is false'
+    )
+
+    parser.add_argument(
+        '--corpus_directory',
+        default=None,
+        type=str,
+        help='Also write the corpus to this directory, a message per file'
+    )
+
+    parser.add_argument(
+        '--label',
+        default=None,
+        type=str,
+        help='Label for the run in the results, such as a release number'
+    )
+
+    parser.add_argument(
+        '--output',
+        default=None,
+        type=str,
+        help='File to write the results to, as JSON. Default is stdout'
+    )
+
+    args = parser.parse_args()
+
+    # Logging every attachment would swamp the timings
+    logging.basicConfig(level=logging.WARNING)
+
+    processors = [build_processor(spec[0], convert_rules(spec[1:]))
+                  for spec in args.processor_specs]
+
+    print >>sys.stderr, 'Generating %s messages from seed %s' % (
+        args.messages, args.seed)
+    corpus = benchmark.generate_corpus(args.messages, args.seed,
+                                       args.max_size)
+
+    if args.corpus_directory:
+        make_directory(args.corpus_directory)
+        for i, data in enumerate(corpus):
+            with open(os.path.join(args.corpus_directory,
+                                   'message%05d.eml' % i), 'wb') as f:
+                f.write(data)
+
+    results = benchmark.run_benchmarks(
+        corpus, processors, args.benchmarks or benchmark.BENCHMARKS,
+        args.repeat, args.fsync)
+    show(results)
+
+    report = {'label': args.label,
+              'time': time.time(),
+              'environment': benchmark.environment(),
+              'corpus': {'messages': args.messages,
+                         'seed': args.seed,
+                         'max_size': args.max_size,
+                         'bytes': sum(len(data) for data in corpus)},
+              'repeat': args.repeat,
+              'results': results}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
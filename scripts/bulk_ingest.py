@@ -0,0 +1,198 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+import os
+import sys
+import logging
+import argparse
+import multiprocessing
+
+from bulk import ingest
+from bulk.unpack import Unpacker
+from bulk.helpers import *
+
+
+if __name__ == '__main__':
+    """
+    Main
+    """
+    parser = argparse.ArgumentParser(description='Run mbox files and \
+                                     Maildirs through the Bulk processors, \
+                                     writing a JSON line for each message')
+
+    parser.add_argument(
+        'sources',
+        nargs='+',
+        help='mbox files and Maildirs to read messages from'
+    )
+
+    parser.add_argument(
+        '--output',
+        default='-',
+        type=str,
+        help='File to write the JSON lines to. Default is -, standard \
+             output'
+    )
+
+    parser.add_argument(
+        '--workers',
+        default=multiprocessing.cpu_count(),
+        type=int,
+        help='Number of worker processes to parse and scan in. Default \
+             is the number of CPUs'
+    )
+
+    parser.add_argument(
+        '--rule_cache_directory',
+        default=None,
+        type=directory_name,
+        help='Directory to keep compiled rules in, shared with \
+             bulk_proxy.py. Default is none, compile the rules'
+    )
+
+    parser.add_argument(
+        '--scan_timeout',
+        default=0,
+        type=float,
+        help='Seconds yara may spend scanning an attachment. Default is \
+             0, no limit'
+    )
+
+    parser.add_argument(
+        '--verdict_cache_size',
+        default=10000,
+        type=int,
+        help='Number of attachment verdicts each worker caches, so \
+             attachments seen again are not scanned again. 0 disables \
+             the cache. Default is 10000'
+    )
+
+    parser.add_argument(
+        '--memory_scan_limit',
+        default=10 * 1024 * 1024,
+        type=int,
+        help='Largest attachment, encoded, to decode and scan in memory. \
+             Larger ones are decoded into a temporary file. Default is \
+             10485760 (10 MB)'
+    )
+
+    parser.add_argument(
+        '--unpack_depth',
+        default=3,
+        type=int,
+        help='Most levels of archives within archives to unpack, so \
+             their members are scanned too. 0 disables unpacking. \
+             Default is 3'
+    )
+
+    parser.add_argument(
+        '--unpack_max_members',
+        default=1000,
+        type=int,
+        help='Most archive members to unpack from one attachment. \
+             Default is 1000'
+    )
+
+    parser.add_argument(
+        '--unpack_max_ratio',
+        default=100,
+        type=int,
+        help='Highest compression ratio allowed for an archive member. \
+             Default is 100'
+    )
+
+    parser.add_argument(
+        '--unpack_max_bytes',
+        default=100 * 1024 * 1024,
+        type=int,
+        help='Most bytes to unpack from one attachment. \
+             Default is 104857600 (100 MB)'
+    )
+
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='Log every attachment and match rather than just progress \
+             and problems. Default is false'
+    )
+
+    req = parser.add_argument_group('required')
+
+    req.add_argument(
+        '--processor',
+        default=[],
+        required=True,
+        nargs='+',
+        action=CreateProcessor,
+        dest='processor_specs',
+        help='Choose a processing engine by supplying an import string as \
+             the first positional argument and multiple rules files as \
+             optional following arguments, as for bulk_proxy.py. May be \
+             given more than once'
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(message)s',
+                        level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    logger = logging.getLogger('bulk.ingest')
+    logger.setLevel(logging.INFO)
+
+    for source in args.sources:
+        if not os.path.exists(source):
+            print 'Cannot find %s, exiting!' % source
+            sys.exit(1)
+
+    options = {'cache_directory': args.rule_cache_directory,
+               'scan_timeout': args.scan_timeout}
+
+    # Catch broken rules before starting the workers, and with a rule
+    # cache, compile them once for all of the workers
+    for p in build_processors(args.processor_specs, **options):
+        logger.info('Ingesting with %s' % p)
+
+    unpacker = None
+    if args.unpack_depth:
+        unpacker = Unpacker(args.unpack_depth, args.unpack_max_members,
+                            args.unpack_max_ratio, args.unpack_max_bytes,
+                            args.memory_scan_limit)
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    try:
+        summary = ingest.ingest(args.sources, args.processor_specs, options,
+                                output, args.workers, unpacker,
+                                args.memory_scan_limit,
+                                args.verdict_cache_size)
+
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    logger.info('Ingested %s messages, %s attachments, in %.1f s; '
+                'Malicious: %s; Failed: %s; Not fully unpacked: %s; '
+                'Unreadable: %s'
+                % (summary['messages'], summary['attachments'],
+                   summary['seconds'], summary['malicious'],
+                   summary['failed'], summary['incomplete'],
+                   summary['errors']))
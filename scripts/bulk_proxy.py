@@ -27,6 +27,8 @@
 import re
 import os
 import errno
+import atexit
+import signal
 import argparse
 import asyncore
 import logging
@@ -34,46 +36,22 @@ import logging.config
 
 # Bulk Imports
 from bulk.proxy import BulkProxy
+from bulk.scanner import ScanEngine
+from bulk.cache import VerdictCache
+from bulk.upstream import UpstreamPool
+from bulk.spool import Spool
+from bulk.writer import StorageWriter
+from bulk.events import EventStore
+from bulk.reload import RuleReloader
+from bulk.unpack import Unpacker
+from bulk.metrics import MetricsServer
+from bulk.profiler import ProfileRunner
+from bulk.prefork import Supervisor, listen
+from bulk.aio import SMTPServer, Executor, ExecutorEngine, asyncio
+from bulk.admission import AdmissionControl
 from bulk.helpers import *
 
 
-class CreateProcessor(argparse.Action):
-    """
-    A custom argparse action.
-
-    Instantiates a processing engine to be used in Bulk
-    and appends it to the list of actively used processing
-    engines.
-
-    """
-
-    def __call__(self, parser, namespace, values, option_string=None):
-        """
-        Instantiate a processing engine and append it to the active set.
-        """
-        module_name = values[0]
-        rule_files = values[1:]
-
-        # check the rules files
-        for fn in rule_files:
-            if os.path.isfile(fn):
-                try:
-                    with open(fn):
-                        pass
-
-                except IOError:
-                    raise IOError((errno.EACCES,
-                                  'Cannot open and read rules file.', fn))
-
-            else:
-                raise IOError((errno.ENOENT, 'Cannot find rules file.', fn))
-
-        current_processors = getattr(namespace, self.dest)
-        current_processors.append(build_processor(module_name,
-                                                  convert_rules(rule_files)))
-        setattr(namespace, self.dest, current_processors)
-
-
 def setup_logging(config):
     """
     Configure logging for Bulk.
@@ -177,10 +155,50 @@ def validate_arguments(args):
         else:
             create_sub_directories(directory)
 
+    if args.reuse_port and not args.workers:
+        return 'reuse_port parameter needs worker processes (--workers)'
+
+    if args.frontend == 'asyncio' and asyncio is None:
+        return 'asyncio front end needs trollius on Python 2'
+
     # Don't return an error string if we made it here
     return None
 
 
+def processor_options(args):
+    """
+    Options to build processors with.
+
+    Keyword arguments:
+    args -- a populated argument namespace from argparse
+
+    Returns a dictionary of keyword arguments for build_processor.
+
+    """
+    options = {'cache_directory': args.rule_cache_directory,
+               'scan_timeout': args.scan_timeout}
+    if args.rule_profile_directory:
+        options['profile_directory'] = (args.rule_profile_directory +
+                                        'samples')
+        options['profile_rate'] = args.rule_profile_rate
+
+    return options
+
+
+def short_circuit(args):
+    """
+    Whether scanning a message can stop at its first match.
+
+    Keyword arguments:
+    args -- a populated argument namespace from argparse
+
+    Only asked for with --first_match, and only blocked messages are
+    decided by the first match alone.
+
+    """
+    return args.first_match and (args.block or args.always_block)
+
+
 def run():
     """
     Start Bulk.
@@ -248,6 +266,15 @@ def run():
         help='Turn the proxy into a server (block all). Default is false'
     )
 
+    parser.add_argument(
+        '--first_match',
+        action='store_true',
+        help='With --block or --always_block, stop scanning a message at \
+             its first match, as it decides the verdict, rather than \
+             running every processor on every attachment for the full \
+             list of hits. Default is false'
+    )
+
     parser.add_argument(
         '--save_attachments',
         action='store_true',
@@ -261,6 +288,320 @@ def run():
         help='Logging config file. Default is /etc/bulk/logging.conf'
     )
 
+    parser.add_argument(
+        '--scan_workers',
+        default=0,
+        type=int,
+        help='Number of worker processes to scan attachments in. \
+             Default is 0, scan on the main process'
+    )
+
+    parser.add_argument(
+        '--scan_timeout',
+        default=0,
+        type=float,
+        help='Seconds yara may spend scanning an attachment. With \
+             --scan_workers, a worker taking twice that long for each \
+             attachment, or twenty times that long in all, is also killed \
+             and replaced. Default is 0, no limit'
+    )
+
+    parser.add_argument(
+        '--scan_failure_verdict',
+        default='quarantine',
+        choices=['quarantine', 'tempfail', 'pass'],
+        help='What a message is treated as when scanning it timed out or \
+             crashed: quarantine it as if it matched, tempfail it so the \
+             client tries again later (only with --block, otherwise it \
+             is quarantined), or pass it as clean. Default is quarantine'
+    )
+
+    parser.add_argument(
+        '--unpack_failure_verdict',
+        default='pass',
+        choices=['quarantine', 'tempfail', 'pass'],
+        help='What a message is treated as when an archive in it could \
+             not be fully unpacked, being encrypted, broken or over an \
+             unpacking budget, as for --scan_failure_verdict. The archive \
+             itself and whatever was unpacked are scanned either way. \
+             Default is pass'
+    )
+
+    parser.add_argument(
+        '--verdict_cache_size',
+        default=0,
+        type=int,
+        help='Number of attachment verdicts to cache, such as 10000. \
+             Default is 0, no cache'
+    )
+
+    parser.add_argument(
+        '--verdict_cache_ttl',
+        default=3600,
+        type=int,
+        help='Seconds a cached attachment verdict is kept. 0 keeps \
+             verdicts until evicted. Default is 3600'
+    )
+
+    parser.add_argument(
+        '--upstream_connections',
+        default=0,
+        type=int,
+        help='Most connections kept open to the remote server, such as \
+             4. Default is 0, open a new connection for every message'
+    )
+
+    parser.add_argument(
+        '--upstream_idle_timeout',
+        default=60,
+        type=int,
+        help='Seconds an unused connection to the remote server is kept \
+             open. Default is 60'
+    )
+
+    parser.add_argument(
+        '--upstream_max_messages',
+        default=100,
+        type=int,
+        help='Messages sent over one connection to the remote server \
+             before it is replaced. Default is 100'
+    )
+
+    parser.add_argument(
+        '--spool',
+        action='store_true',
+        help='Queue accepted mail in /base_log_directory/spool/ and deliver \
+             it in the background, retrying when the remote server is \
+             unavailable. Default is false'
+    )
+
+    parser.add_argument(
+        '--spool_workers',
+        default=2,
+        type=int,
+        help='Number of threads delivering mail from the spool. \
+             Default is 2'
+    )
+
+    parser.add_argument(
+        '--spool_max_age',
+        default=432000,
+        type=int,
+        help='Seconds to keep retrying a spooled message before giving up \
+             on it. Default is 432000 (5 days)'
+    )
+
+    parser.add_argument(
+        '--background_writes',
+        action='store_true',
+        help='Write messages and attachments to disk on a background \
+             thread. Default is false'
+    )
+
+    parser.add_argument(
+        '--writer_queue_size',
+        default=1000,
+        type=int,
+        help='Most background writes queued before mail processing waits \
+             on the disk. Default is 1000'
+    )
+
+    parser.add_argument(
+        '--writer_fsync',
+        action='store_true',
+        help='Sync background writes to disk, in batches. Default is false'
+    )
+
+    parser.add_argument(
+        '--record_events',
+        action='store_true',
+        help='Record verdicts, sightings and rule hits to an indexed \
+             database at /base_log_directory/events.db, for use with \
+             query_events.py. Default is false'
+    )
+
+    parser.add_argument(
+        '--unpack_depth',
+        default=0,
+        type=int,
+        help='Most levels of archives within archives to unpack, so \
+             their members are scanned too, such as 3. Default is 0, \
+             do not unpack archives'
+    )
+
+    parser.add_argument(
+        '--unpack_max_members',
+        default=1000,
+        type=int,
+        help='Most archive members to unpack from one attachment. \
+             Default is 1000'
+    )
+
+    parser.add_argument(
+        '--unpack_max_ratio',
+        default=100,
+        type=int,
+        help='Highest compression ratio allowed for an archive member. \
+             Default is 100'
+    )
+
+    parser.add_argument(
+        '--unpack_max_bytes',
+        default=100 * 1024 * 1024,
+        type=int,
+        help='Most bytes to unpack from one attachment. \
+             Default is 104857600 (100 MB)'
+    )
+
+    parser.add_argument(
+        '--memory_scan_limit',
+        default=0,
+        type=int,
+        help='Largest attachment, encoded, to decode and scan in memory, \
+             such as 10485760 (10 MB). Larger ones are decoded into a \
+             temporary file and scanned from there. Default is 0, keep \
+             everything in memory'
+    )
+
+    parser.add_argument(
+        '--max_scan_size',
+        default=0,
+        type=int,
+        help='Largest attachment to scan in full. Larger ones are handled \
+             according to --oversize_policy. Default is 0, no limit'
+    )
+
+    parser.add_argument(
+        '--oversize_policy',
+        default='headtail',
+        choices=['skip', 'headtail', 'quarantine'],
+        help='What to do with attachments over --max_scan_size: skip \
+             scanning them, scan only their first and last \
+             --max_scan_size / 2 bytes (headtail), or quarantine the \
+             message. Default is headtail'
+    )
+
+    parser.add_argument(
+        '--max_message_size',
+        default=0,
+        type=int,
+        help='Largest message to accept in bytes, advertised with the \
+             ESMTP SIZE extension so larger ones are refused before they \
+             are sent. Default is 0, no limit'
+    )
+
+    parser.add_argument(
+        '--max_connections',
+        default=0,
+        type=int,
+        help='Most client connections to have open at once, more are \
+             told to try again later with a 421. Default is 0, no limit'
+    )
+
+    parser.add_argument(
+        '--max_pending_scans',
+        default=0,
+        type=int,
+        help='Most attachment scans to have waiting for a verdict, with \
+             --scan_workers, before new messages are told to try again \
+             later with a 451. Default is 0, no limit'
+    )
+
+    parser.add_argument(
+        '--max_buffered_bytes',
+        default=0,
+        type=int,
+        help='Most bytes of message data to hold in memory before \
+             messages are told to try again later with a 451. Default \
+             is 0, no limit'
+    )
+
+    parser.add_argument(
+        '--metrics_port',
+        default=0,
+        type=int,
+        help='Port to serve metrics on, in the Prometheus text format, \
+             at /metrics. Default is 0, do not serve metrics'
+    )
+
+    parser.add_argument(
+        '--metrics_address',
+        default='127.0.0.1',
+        type=str,
+        help='Address to serve metrics on. Default is 127.0.0.1'
+    )
+
+    parser.add_argument(
+        '--rule_cache_directory',
+        default=None,
+        type=directory_name,
+        help='Directory to keep compiled rules in, so they are only \
+             compiled again when the rule files change. Default is none, \
+             compile the rules on every start'
+    )
+
+    parser.add_argument(
+        '--rule_profile_directory',
+        default=None,
+        type=directory_name,
+        help='Directory to keep a sample of the scanned attachments in, \
+             under samples/, and to write a ranked report of the slowest \
+             yara rules to, as report.txt. Default is none, do not \
+             profile the rules'
+    )
+
+    parser.add_argument(
+        '--rule_profile_rate',
+        default=0.01,
+        type=float,
+        help='Share of the scanned attachments to sample for profiling. \
+             Default is 0.01'
+    )
+
+    parser.add_argument(
+        '--rule_profile_interval',
+        default=3600,
+        type=int,
+        help='Seconds between profiles of the rules over the samples. \
+             Default is 3600'
+    )
+
+    parser.add_argument(
+        '--workers',
+        default=0,
+        type=int,
+        help='Number of worker processes to handle mail in, all listening \
+             on the same port, each with its own scanning workers, \
+             caches and spool. Workers that die are restarted. Default \
+             is 0, handle mail in the main process'
+    )
+
+    parser.add_argument(
+        '--reuse_port',
+        action='store_true',
+        help='Have each worker process listen with SO_REUSEPORT, so the \
+             kernel spreads connections evenly between them, rather than \
+             share one listening socket. Default is false'
+    )
+
+    parser.add_argument(
+        '--frontend',
+        default='asyncore',
+        choices=['asyncore', 'asyncio'],
+        help='Event loop to accept SMTP connections on. asyncio scales to \
+             many more concurrent connections, and scans and delivers on \
+             threads beside the loop. It needs trollius on Python 2. \
+             Default is asyncore'
+    )
+
+    parser.add_argument(
+        '--session_timeout',
+        default=300,
+        type=int,
+        help='Seconds a client may sit idle before it is disconnected, \
+             with the asyncio front end. 0 for no limit. Default is 300'
+    )
+
     # add a group to mark certain arguments as required
     req = parser.add_argument_group('required')
     # the processor arg is the only required argument
@@ -270,7 +611,7 @@ def run():
         required=True,
         nargs='+',
         action=CreateProcessor,
-        dest='processors',
+        dest='processor_specs',
         help='Choose a processing engine by supplying an import string as the \
              first positional argument and multiple rules files as optional \
              following arguments. For example: \
@@ -305,6 +646,9 @@ def run():
     if args.always_block:
         logger.info('Bulk set to BLOCK ALL mail')
 
+    if short_circuit(args):
+        logger.info('Scanning each message until its first match')
+
     if args.log_all_messages:
         logger.info('Logging ALL messages to %smessages/'
                     % args.base_log_directory)
@@ -313,21 +657,230 @@ def run():
         logger.info('Saving attachments to %sattachments/'
                     % args.base_log_directory)
 
-    if args.processors:
-        for p in args.processors:
-            logger.info('Bulk using %s' % p)
+    # Build the processors now, several rule sets load in parallel
+    options = processor_options(args)
+    processors = build_processors(args.processor_specs, **options)
+
+    for p in processors:
+        logger.info('Bulk using %s' % p)
+
+    if args.workers:
+        supervise(args, processors)
+
+    else:
+        serve(args, processors)
+
+
+def serve(args, processors, listen_socket=None, worker=None):
+    """
+    Set up the proxy and handle mail until stopped.
+
+    Keyword arguments:
+    args -- a populated argument namespace from argparse
+    processors -- list of processors built from the arguments
+    listen_socket -- listening socket to accept mail on. By default
+    one is opened on the bind address
+    worker -- index of the worker process serving, if any
+
+    """
+    logger = logging.getLogger('bulk')
+
+    loop = None
+    executor = None
+    if args.frontend == 'asyncio':
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # Blocking calls run on threads beside the loop
+        executor = Executor(loop)
+
+    engine = None
+    if args.scan_workers:
+        # Workers load compiled rules the processors built by run() left
+        # in the rule cache, if there is one
+        engine = ScanEngine(args.processor_specs, args.scan_workers,
+                            processor_options(args),
+                            loop.call_soon_threadsafe if loop else None,
+                            short_circuit(args), args.scan_timeout)
+        logger.info('Bulk using %s' % engine)
+
+    elif executor:
+        engine = ExecutorEngine(processors, executor, short_circuit(args))
+        logger.info('Bulk using %s' % engine)
+
+    cache = None
+    if args.verdict_cache_size:
+        cache = VerdictCache(args.verdict_cache_size,
+                             args.verdict_cache_ttl,
+                             rules_fingerprint(args.processor_specs))
+        logger.info('Bulk caching up to %s verdicts for %s seconds'
+                    % (args.verdict_cache_size, args.verdict_cache_ttl))
+
+    upstream = None
+    if args.upstream_connections and not args.always_block:
+        upstream = UpstreamPool((args.remote_address, args.remote_port),
+                                args.upstream_connections,
+                                args.upstream_idle_timeout,
+                                args.upstream_max_messages)
+        logger.info('Bulk using %s' % upstream)
+
+    spool = None
+    if args.spool and not args.always_block:
+        if not upstream:
+            # A connection per message
+            upstream = UpstreamPool((args.remote_address, args.remote_port),
+                                    args.spool_workers, max_messages=1)
+
+        # Each worker process keeps a spool of its own
+        spool_directory = args.base_log_directory + 'spool/'
+        if worker is not None:
+            spool_directory += 'worker%s/' % worker
+
+        spool = Spool(spool_directory, upstream,
+                      args.spool_workers, args.spool_max_age)
+        spool.start()
+        logger.info('Bulk using %s' % spool)
+
+    writer = None
+    if args.background_writes:
+        writer = StorageWriter(args.writer_queue_size,
+                               fsync=args.writer_fsync)
+        # Flush whatever is still queued on the way out
+        atexit.register(writer.close)
+        logger.info('Bulk using %s' % writer)
+
+    events = None
+    if args.record_events:
+        events = EventStore(args.base_log_directory + 'events.db')
+        # Insert whatever is still queued on the way out
+        atexit.register(events.close)
+        logger.info('Bulk using %s' % events)
+
+    admission = None
+    if args.max_connections or args.max_pending_scans or \
+            args.max_buffered_bytes:
+        admission = AdmissionControl(args.max_connections,
+                                     args.max_pending_scans,
+                                     args.max_buffered_bytes,
+                                     lambda: engine.pending if engine else 0)
+        logger.info('Bulk using %s' % admission)
+
+    unpacker = None
+    if args.unpack_depth:
+        unpacker = Unpacker(args.unpack_depth, args.unpack_max_members,
+                            args.unpack_max_ratio, args.unpack_max_bytes,
+                            args.memory_scan_limit)
+        logger.info('Bulk using %s' % unpacker)
 
     server = BulkProxy((args.bind_address, args.bind_port),
                        (args.remote_address, args.remote_port),
-                       args.processors,
+                       processors,
                        base_directory=args.base_log_directory,
                        block=args.block,
                        always_block=args.always_block,
                        log=args.log_all_messages,
-                       save_attachments=args.save_attachments)
+                       save_attachments=args.save_attachments,
+                       scan_engine=engine,
+                       verdict_cache=cache,
+                       upstream_pool=upstream,
+                       spool=spool,
+                       writer=writer,
+                       event_store=events,
+                       unpacker=unpacker,
+                       memory_scan_limit=args.memory_scan_limit,
+                       max_scan_size=args.max_scan_size,
+                       oversize_policy=args.oversize_policy,
+                       max_message_size=args.max_message_size,
+                       short_circuit=short_circuit(args),
+                       scan_failure_verdict=args.scan_failure_verdict,
+                       unpack_failure_verdict=args.unpack_failure_verdict,
+                       admission_control=admission,
+                       defer=executor.call if executor else None,
+                       listen_socket=listen_socket,
+                       listen=loop is None)
+
+    # Worker processes leave serving metrics to the supervisor
+    if args.metrics_port and worker is None:
+        metrics_server = MetricsServer((args.metrics_address,
+                                        args.metrics_port))
+        metrics_server.start()
+        logger.info('Bulk using %s' % metrics_server)
+
+    # Only one worker process profiles the rules
+    if args.rule_profile_directory and not worker:
+        runner = ProfileRunner(processors, args.rule_profile_directory,
+                               args.rule_profile_interval)
+        runner.start()
+        logger.info('Bulk using %s' % runner)
+
+    # Reload the rules on SIGHUP, without dropping the listening socket
+    reloader = RuleReloader(processors, args.processor_specs, engine, cache)
+    signal.signal(signal.SIGHUP, lambda signum, frame: reloader.reload())
+    if worker is None:
+        logger.info('Send SIGHUP to process %s to reload the rules'
+                    % os.getpid())
 
     # Kick off the main process
-    asyncore.loop()
+    if loop is None:
+        asyncore.loop()
+        return
+
+    frontend = SMTPServer(server,
+                          listen_socket or listen((args.bind_address,
+                                                   args.bind_port)),
+                          loop, args.session_timeout)
+    frontend.start()
+    logger.info('Bulk accepting connections on asyncio')
+    try:
+        frontend.run()
+
+    finally:
+        frontend.close()
+
+
+def supervise(args, processors):
+    """
+    Handle mail in several worker processes, restarting any that die.
+
+    Keyword arguments:
+    args -- a populated argument namespace from argparse
+    processors -- list of processors built from the arguments, which
+    the workers inherit
+
+    """
+    logger = logging.getLogger('bulk')
+    address = (args.bind_address, args.bind_port)
+
+    listen_socket = None
+    if args.reuse_port:
+        # Each worker listens on its own, but fail here if it cannot
+        listen(address, reuse_port=True).close()
+        logger.info('Each worker listening with SO_REUSEPORT')
+
+    else:
+        listen_socket = listen(address)
+
+    def work(index):
+        serve(args, processors,
+              listen_socket or listen(address, reuse_port=True), index)
+
+    # Workers started later on get the reloaded rules too
+    reloader = RuleReloader(processors, args.processor_specs)
+    supervisor = Supervisor(args.workers, work,
+                            on_hangup=reloader.reload_now)
+    logger.info('Bulk using %s' % supervisor)
+
+    servers = []
+    if args.metrics_port:
+        metrics_server = MetricsServer((args.metrics_address,
+                                        args.metrics_port), supervisor)
+        servers.append(metrics_server)
+        logger.info('Bulk using %s, adding up every worker'
+                    % metrics_server)
+
+    logger.info('Send SIGHUP to process %s to reload the rules'
+                % os.getpid())
+
+    supervisor.run(servers)
 
 
 def stop():
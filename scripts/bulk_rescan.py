@@ -0,0 +1,220 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+import os
+import sys
+import logging
+import argparse
+import multiprocessing
+
+from bulk import rescan
+from bulk.unpack import Unpacker
+from bulk.helpers import *
+
+
+if __name__ == '__main__':
+    """
+    Main
+    """
+    parser = argparse.ArgumentParser(description='Scan the messages and \
+                                     attachments Bulk stored again, such \
+                                     as after new rules land')
+
+    parser.add_argument(
+        '--base_log_directory',
+        default='/tmp/bulk/',
+        type=directory_name,
+        help='Base log directory bulk_proxy.py stored messages and \
+             attachments under. Default is /tmp/bulk/'
+    )
+
+    parser.add_argument(
+        '--trees',
+        default=list(rescan.TREES),
+        nargs='+',
+        choices=rescan.TREES,
+        help='Sub directories of the base log directory to rescan. \
+             Default is all of them'
+    )
+
+    parser.add_argument(
+        '--workers',
+        default=multiprocessing.cpu_count(),
+        type=int,
+        help='Number of worker processes to parse and scan in. Default \
+             is the number of CPUs'
+    )
+
+    parser.add_argument(
+        '--database',
+        default=None,
+        type=str,
+        help='SQLite database recording what was scanned with which \
+             rules, so nothing is scanned twice with the same rules. \
+             Default is rescan.db in the base log directory'
+    )
+
+    parser.add_argument(
+        '--report',
+        default=None,
+        type=str,
+        help='File to write the report of matches and failed scans to. \
+             Default is rescan-<rules fingerprint>.txt in the base log \
+             directory'
+    )
+
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Scan everything again, even what was already scanned with \
+             the same rules. Default is false'
+    )
+
+    parser.add_argument(
+        '--rule_cache_directory',
+        default=None,
+        type=directory_name,
+        help='Directory to keep compiled rules in, shared with \
+             bulk_proxy.py. Default is none, compile the rules'
+    )
+
+    parser.add_argument(
+        '--scan_timeout',
+        default=0,
+        type=float,
+        help='Seconds yara may spend scanning an attachment. Default is \
+             0, no limit'
+    )
+
+    parser.add_argument(
+        '--memory_scan_limit',
+        default=10 * 1024 * 1024,
+        type=int,
+        help='Largest attachment, encoded, to decode and scan in memory. \
+             Larger ones are decoded into a temporary file. Default is \
+             10485760 (10 MB)'
+    )
+
+    parser.add_argument(
+        '--unpack_depth',
+        default=3,
+        type=int,
+        help='Most levels of archives within archives to unpack, so \
+             their members are scanned too. 0 disables unpacking. \
+             Default is 3'
+    )
+
+    parser.add_argument(
+        '--unpack_max_members',
+        default=1000,
+        type=int,
+        help='Most archive members to unpack from one attachment. \
+             Default is 1000'
+    )
+
+    parser.add_argument(
+        '--unpack_max_ratio',
+        default=100,
+        type=int,
+        help='Highest compression ratio allowed for an archive member. \
+             Default is 100'
+    )
+
+    parser.add_argument(
+        '--unpack_max_bytes',
+        default=100 * 1024 * 1024,
+        type=int,
+        help='Most bytes to unpack from one attachment. \
+             Default is 104857600 (100 MB)'
+    )
+
+    parser.add_argument(
+        '--verbose',
+        action='store_true',
+        help='Log every attachment and match rather than just progress \
+             and problems. Default is false'
+    )
+
+    req = parser.add_argument_group('required')
+
+    req.add_argument(
+        '--processor',
+        default=[],
+        required=True,
+        nargs='+',
+        action=CreateProcessor,
+        dest='processor_specs',
+        help='Choose a processing engine by supplying an import string as \
+             the first positional argument and multiple rules files as \
+             optional following arguments, as for bulk_proxy.py. May be \
+             given more than once'
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(message)s',
+                        level=logging.INFO if args.verbose
+                        else logging.WARNING)
+    logger = logging.getLogger('bulk.rescan')
+    logger.setLevel(logging.INFO)
+
+    if not os.path.isdir(args.base_log_directory):
+        print 'Cannot find %s, exiting!' % args.base_log_directory
+        sys.exit(1)
+
+    options = {'cache_directory': args.rule_cache_directory,
+               'scan_timeout': args.scan_timeout}
+
+    # Catch broken rules before starting the workers, and with a rule
+    # cache, compile them once for all of the workers
+    for p in build_processors(args.processor_specs, **options):
+        logger.info('Rescanning with %s' % p)
+
+    unpacker = None
+    if args.unpack_depth:
+        unpacker = Unpacker(args.unpack_depth, args.unpack_max_members,
+                            args.unpack_max_ratio, args.unpack_max_bytes,
+                            args.memory_scan_limit)
+
+    fingerprint = rules_fingerprint(args.processor_specs)
+    database = args.database or args.base_log_directory + 'rescan.db'
+    report = args.report or '%srescan-%s.txt' % (args.base_log_directory,
+                                                  fingerprint)
+
+    summary = rescan.rescan(args.base_log_directory, args.processor_specs,
+                            options, fingerprint, database, args.trees,
+                            args.workers, unpacker, args.memory_scan_limit,
+                            args.force)
+
+    conn = rescan.connect(database)
+    try:
+        text = rescan.format_report(conn, fingerprint, summary)
+
+    finally:
+        conn.close()
+
+    with open(report, 'w') as f:
+        f.write(text)
+
+    sys.stdout.write(text)
+    logger.info('Report written to %s' % report)
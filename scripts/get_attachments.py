@@ -94,8 +94,7 @@ if __name__ == '__main__':
     print 'Reading email from file %s' % args.infile
     msg = message.Message(None, None, None, get_message(args.infile))
 
-    (names, contents) = msg.get_attachments()
-
-    for i, name in enumerate(names):
-        print 'Writing attachment %s to disk' % name
-        save(directory_name(args.output_path) + name, contents[i])
+    for attachment in msg.get_attachments():
+        print 'Writing attachment %s to disk' % attachment.name
+        save(directory_name(args.output_path) + attachment.name,
+             attachment.content)
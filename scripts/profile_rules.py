@@ -0,0 +1,97 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+import os
+import sys
+import logging
+import argparse
+
+from bulk import profiler
+from bulk.helpers import *
+
+
+if __name__ == '__main__':
+    """
+    Main
+    """
+    parser = argparse.ArgumentParser(description='Rank yara rules by the \
+                                     time they take to scan a directory of \
+                                     sample attachments')
+
+    parser.add_argument(
+        '--samples',
+        default='/tmp/bulk/profile/samples/',
+        type=str,
+        help='Directory of sample attachments, such as the samples kept \
+             by bulk_proxy.py --rule_profile_directory. Default is \
+             /tmp/bulk/profile/samples/'
+    )
+
+    parser.add_argument(
+        '--resolution',
+        default=0.05,
+        type=float,
+        help='Share of the total scanning time below which a set of rules \
+             is not split any further. Lower values time more rules on \
+             their own and take longer. Default is 0.05'
+    )
+
+    parser.add_argument(
+        '--repeat',
+        default=1,
+        type=int,
+        help='Times to scan each sample, keeping the fastest, to even \
+             out noise. Default is 1'
+    )
+
+    parser.add_argument(
+        '--timeout',
+        default=60,
+        type=int,
+        help='Seconds before yara gives up on a scan. Default is 60'
+    )
+
+    parser.add_argument(
+        'rules',
+        nargs='+',
+        help='Yara rule files to profile'
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(levelname)s %(message)s')
+
+    if profiler.yara is None:
+        print 'Cannot import yara, exiting!'
+        sys.exit(1)
+
+    paths = profiler.sample_paths(args.samples)
+    if not paths:
+        print 'Cannot find samples in %s, exiting!' % args.samples
+        sys.exit(1)
+
+    costs = profiler.profile(convert_rules(args.rules), {'includes': True},
+                             paths, resolution=args.resolution,
+                             repeat=args.repeat, timeout=args.timeout)
+
+    sys.stdout.write(profiler.format_report(costs, len(paths)))
@@ -0,0 +1,180 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+import os
+import sys
+import time
+import argparse
+import datetime
+
+from bulk import events
+
+
+def parse_time(value):
+    """
+    Turn a YYYY-MM-DD[THH:MM[:SS]] date or a number of days ago
+    into a Unix time.
+
+    Keyword arguments:
+    value -- string to parse
+
+    """
+    try:
+        return time.time() - float(value) * 86400
+
+    except ValueError:
+        pass
+
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            dt = datetime.datetime.strptime(value, fmt)
+            return time.mktime(dt.timetuple())
+
+        except ValueError:
+            pass
+
+    raise argparse.ArgumentTypeError('%s is not a date or a number of days'
+                                     % value)
+
+
+def show(conn, row):
+    """
+    Print a message and what was found in it.
+
+    Keyword arguments:
+    conn -- connection to the event database
+    row -- message row returned by events.search
+
+    """
+    msg_id, received, peer, mailfrom, size, malicious, elapsed, path = row
+
+    rcpttos = [r for r, in conn.execute(
+        'SELECT rcptto FROM recipients WHERE message_id = ?', (msg_id,))]
+
+    print '%s %s; From: %s; To: %s; Peer: %s; Size: %s; Time: %.2f ms' % (
+        datetime.datetime.fromtimestamp(received).isoformat(),
+        'MALICIOUS' if malicious else 'clean', mailfrom, ', '.join(rcpttos),
+        peer, size, elapsed * 1000)
+
+    if path:
+        print '    Saved: %s' % path
+
+    for name, sha256 in conn.execute(
+            'SELECT name, sha256 FROM attachments WHERE message_id = ?',
+            (msg_id,)):
+        hits = ['%s:%s' % (namespace, rule) for rule, namespace in
+                conn.execute('SELECT rule, namespace FROM hits '
+                             'WHERE message_id = ? AND sha256 = ?',
+                             (msg_id, sha256))]
+
+        print '    Attachment: %s; SHA256: %s; Rules: %s' % (
+            name, sha256, ', '.join(hits) or 'none')
+
+if __name__ == '__main__':
+    """
+    Main
+    """
+    parser = argparse.ArgumentParser(description='Search the verdicts and \
+                                     sightings recorded by bulk_proxy.py \
+                                     --record_events')
+
+    parser.add_argument(
+        '--database',
+        default='/tmp/bulk/events.db',
+        type=str,
+        help='Event database to search. Default is /tmp/bulk/events.db'
+    )
+
+    parser.add_argument(
+        '--rule',
+        type=str,
+        help='Only messages with an attachment that hit this rule'
+    )
+
+    parser.add_argument(
+        '--sender',
+        type=str,
+        help='Only messages from this envelope sender'
+    )
+
+    parser.add_argument(
+        '--recipient',
+        type=str,
+        help='Only messages to this envelope recipient'
+    )
+
+    parser.add_argument(
+        '--digest',
+        type=str,
+        help='Only messages with an attachment with this MD5, SHA1 \
+             or SHA256'
+    )
+
+    parser.add_argument(
+        '--since',
+        type=parse_time,
+        help='Only messages received since this date (YYYY-MM-DD) \
+             or this many days ago'
+    )
+
+    parser.add_argument(
+        '--until',
+        type=parse_time,
+        help='Only messages received before this date (YYYY-MM-DD) \
+             or this many days ago'
+    )
+
+    parser.add_argument(
+        '--malicious',
+        action='store_true',
+        help='Only malicious messages'
+    )
+
+    parser.add_argument(
+        '--limit',
+        default=100,
+        type=int,
+        help='Most messages to show, 0 for all. Default is 100'
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        print 'Cannot find event database %s, exiting!' % args.database
+        sys.exit(1)
+
+    conn = events.connect(args.database)
+    rows = events.search(conn,
+                         rule=args.rule,
+                         mailfrom=args.sender,
+                         rcptto=args.recipient,
+                         digest=args.digest,
+                         since=args.since,
+                         until=args.until,
+                         malicious=True if args.malicious else None,
+                         limit=args.limit)
+
+    for row in rows:
+        show(conn, row)
+
+    print '%s messages found' % len(rows)
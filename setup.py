@@ -43,5 +43,11 @@ setup(name='Bulk',
       author_email='sdicato@mitre.org',
       url='',
       packages=['bulk', 'bulk.processors'],
+      test_suite='tests',
       scripts=['scripts/bulk_proxy.py',
-               'scripts/get_attachments.py'])
+               'scripts/get_attachments.py',
+               'scripts/query_events.py',
+               'scripts/profile_rules.py',
+               'scripts/bulk_benchmark.py',
+               'scripts/bulk_rescan.py',
+               'scripts/bulk_ingest.py'])
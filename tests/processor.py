@@ -0,0 +1,65 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import time
+
+# Bulk Imports
+from bulk.processors import Result
+
+
+class Processor(object):
+    """
+    A processor for the tests that matches attachments containing the
+    word 'dirty', and raises on those containing 'boom'. Those
+    containing 'hang' take a minute, and those containing 'crash' kill
+    the process.
+
+    Like many third party processors, it only has match.
+    """
+
+    takes_attachments = True
+
+    def __init__(self, rule_files=None, **options):
+        self.calls = 0
+
+    def __str__(self):
+        return 'Processor ' + __name__
+
+    def match(self, attachment):
+        self.calls += 1
+        content = attachment.content
+        if 'boom' in content:
+            raise ValueError('boom')
+
+        if 'hang' in content:
+            time.sleep(60)
+
+        if 'crash' in content:
+            os._exit(1)
+
+        if 'dirty' in content:
+            return Result(__name__, True, [('dirty', 'tests')])
+
+        return Result(__name__, False)
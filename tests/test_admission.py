@@ -0,0 +1,185 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import logging
+import unittest
+
+# Bulk Imports
+from bulk import session
+from bulk.admission import AdmissionControl, DEFERRALS
+from bulk.scanner import Pending
+from bulk.session import SMTPSession
+from tests.test_session import Server, ENVELOPE
+
+
+class AdmissionControlTest(unittest.TestCase):
+
+    def setUp(self):
+        # Deferrals are logged on purpose
+        logging.getLogger('bulk').disabled = True
+
+    def tearDown(self):
+        logging.getLogger('bulk').disabled = False
+
+    def deferrals(self, reason):
+        return dict((values, count)
+                    for _, values, _, count in DEFERRALS.samples()) \
+            .get((reason,), 0)
+
+    def test_unlimited(self):
+        admission = AdmissionControl()
+        for _ in range(100):
+            self.assertTrue(admission.connect())
+            self.assertTrue(admission.buffer(1024 * 1024))
+
+        self.assertEqual(admission.busy(), None)
+
+    def test_connections(self):
+        admission = AdmissionControl(max_connections=2)
+        before = self.deferrals('connections')
+        self.assertTrue(admission.connect())
+        self.assertTrue(admission.connect())
+        self.assertFalse(admission.connect())
+        self.assertEqual(admission.connections, 2)
+        self.assertEqual(self.deferrals('connections'), before + 1)
+
+        admission.disconnect()
+        self.assertTrue(admission.connect())
+
+    def test_pending_scans(self):
+        pending = [1]
+        admission = AdmissionControl(max_pending_scans=2,
+                                     pending_scans=lambda: pending[0])
+        self.assertEqual(admission.busy(), None)
+        pending[0] = 2
+        self.assertEqual(admission.busy(), 'pending_scans')
+
+    def test_buffered_bytes(self):
+        admission = AdmissionControl(max_buffered_bytes=10)
+        self.assertTrue(admission.buffer(6))
+        # Taking the room would go over, so none is taken
+        self.assertFalse(admission.buffer(5))
+        self.assertEqual(admission.buffered, 6)
+        self.assertEqual(admission.busy(), None)
+
+        self.assertTrue(admission.buffer(4))
+        self.assertEqual(admission.busy(), 'buffered_bytes')
+
+        admission.release(4)
+        self.assertEqual(admission.busy(), None)
+
+
+class SessionAdmissionTest(unittest.TestCase):
+
+    def setUp(self):
+        session._fqdn[:] = ['bulk.test']
+        logging.getLogger('bulk').disabled = True
+        self.server = Server()
+        self.writes = []
+        self.closed = []
+
+    def tearDown(self):
+        logging.getLogger('bulk').disabled = False
+
+    def make_session(self, admission):
+        smtp = SMTPSession(self.server, ('127.0.0.1', 2525),
+                           self.writes.append,
+                           lambda: self.closed.append(True),
+                           admission=admission)
+        smtp.start()
+        return smtp
+
+    def replies(self):
+        """
+        Returns the reply codes sent since last asked.
+        """
+        codes = [line[:3] for line in ''.join(self.writes).split('\r\n')
+                 if line]
+        del self.writes[:]
+        return codes
+
+    def test_connections(self):
+        admission = AdmissionControl(max_connections=1)
+        first = self.make_session(admission)
+        self.assertEqual(self.replies(), ['220'])
+
+        # Turned away and hung up on
+        second = self.make_session(admission)
+        self.assertEqual(self.replies(), ['421'])
+        self.assertEqual(self.closed, [True])
+        self.assertTrue(second.closed)
+        # Without giving back a connection it never had
+        self.assertEqual(admission.connections, 1)
+
+        first.close()
+        self.make_session(admission)
+        self.assertEqual(self.replies(), ['220'])
+
+    def test_pending_scans(self):
+        pending = [0]
+        admission = AdmissionControl(max_pending_scans=1,
+                                     pending_scans=lambda: pending[0])
+        smtp = self.make_session(admission)
+        smtp.feed('HELO client\r\n' + ENVELOPE + 'RSET\r\n')
+        pending[0] = 1
+        smtp.feed(ENVELOPE)
+        self.assertEqual(self.replies(),
+                         ['220', '250', '250', '250', '250', '451', '503'])
+
+    def test_buffered_bytes(self):
+        admission = AdmissionControl(max_buffered_bytes=100)
+        smtp = self.make_session(admission)
+        smtp.feed('HELO client\r\n' + ENVELOPE + 'DATA\r\n')
+        smtp.feed('x' * 200 + '\r\n.\r\n')
+        self.assertEqual(self.replies(),
+                         ['220', '250', '250', '250', '354', '451'])
+        self.assertEqual(self.server.messages, [])
+        self.assertEqual(admission.buffered, 0)
+
+    def test_release(self):
+        # The message is held until its verdict is in
+        admission = AdmissionControl(max_buffered_bytes=1000)
+        self.server.status = Pending()
+        smtp = self.make_session(admission)
+        smtp.feed('HELO client\r\n' + ENVELOPE + 'DATA\r\n'
+                  'Subject: one\r\n\r\n.\r\n')
+        self.assertTrue(admission.buffered > 0)
+
+        self.server.status.fire(None)
+        self.assertEqual(admission.buffered, 0)
+
+    def test_close(self):
+        admission = AdmissionControl(max_connections=1,
+                                     max_buffered_bytes=1000)
+        smtp = self.make_session(admission)
+        smtp.feed('HELO client\r\n' + ENVELOPE + 'DATA\r\nSubject: one')
+        self.assertTrue(admission.buffered > 0)
+
+        smtp.close()
+        self.assertEqual(admission.buffered, 0)
+        self.assertEqual(admission.connections, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
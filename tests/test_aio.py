@@ -0,0 +1,245 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+import threading
+
+# Bulk Imports
+from bulk import session
+from bulk.aio import SMTPServer, Executor, ExecutorEngine, asyncio
+from bulk.message import Attachment
+from bulk.proxy import BulkProxy
+from bulk.prefork import listen
+from bulk.scanner import Pending
+from bulk.stream import MessageStream
+from tests.processor import Processor
+from tests.test_pipeline import build_data
+
+
+class Server(object):
+    """
+    Stands in for a BulkProxy, keeping every message it is handed.
+    """
+
+    max_message_size = 0
+    admission = None
+
+    def __init__(self):
+        self.messages = []
+        self.status = None
+
+    def begin_message(self, peer, mailfrom, rcpttos):
+        return MessageStream()
+
+    def process_message(self, peer, mailfrom, rcpttos, data, stream=None):
+        self.messages.append((mailfrom, rcpttos, data))
+        return self.status
+
+
+class Threaded(Processor):
+    """
+    The test processor, noting the threads it is called on.
+    """
+
+    def __init__(self, rule_files=None, **options):
+        Processor.__init__(self, rule_files, **options)
+        self.threads = set()
+
+    def match(self, attachment):
+        self.threads.add(threading.current_thread())
+        return Processor.match(self, attachment)
+
+
+MESSAGE = 'MAIL FROM:<a@b>\r\nRCPT TO:<c@d>\r\nDATA\r\n'
+
+
+@unittest.skipIf(asyncio is None, 'needs asyncio or trollius')
+class AsyncioTest(unittest.TestCase):
+
+    def setUp(self):
+        session._fqdn[:] = ['bulk.test']
+        self.server = Server()
+        self.loop = asyncio.new_event_loop()
+        self.thread = None
+        self.frontend = None
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+        if self.frontend is not None:
+            self.frontend.close()
+
+        self.loop.close()
+
+    def serve(self, server=None, timeout=300):
+        """
+        Run a front end for server on a thread of its own.
+
+        Returns the port it listens on.
+        """
+        sock = listen(('127.0.0.1', 0))
+        self.frontend = SMTPServer(server or self.server, sock, self.loop,
+                                   timeout)
+        self.frontend.start()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return sock.getsockname()[1]
+
+    def connect(self, port):
+        """
+        Returns a file for talking to the front end, the greeting read.
+        """
+        client = socket.create_connection(('127.0.0.1', port), 5)
+        f = client.makefile('rb+', 0)
+        client.close()
+        self.assertEqual(self.reply(f), '220')
+        return f
+
+    def reply(self, f):
+        """
+        Returns the code of the next reply, '' once disconnected.
+        """
+        line = f.readline()
+        while line[3:4] == '-':
+            line = f.readline()
+
+        return line[:3]
+
+    def on_loop(self, func, *args):
+        """
+        Run func(*args) on the loop and wait for the pending result
+        it returns to fire.
+
+        Returns the result and the thread the result fired on.
+        """
+        fired = []
+        event = threading.Event()
+
+        def call():
+            pending = func(*args)
+
+            def done(result):
+                fired.append((result, threading.current_thread()))
+                event.set()
+
+            pending.add_callback(done)
+
+        self.loop.call_soon_threadsafe(call)
+        self.assertTrue(event.wait(5))
+        return fired[0]
+
+    def test_session(self):
+        f = self.connect(self.serve())
+        f.write('EHLO client\r\n')
+        self.assertEqual(self.reply(f), '250')
+        f.write(MESSAGE)
+        self.assertEqual([self.reply(f) for i in range(3)],
+                         ['250', '250', '354'])
+        f.write('Subject: test\r\n\r\nbody\r\n.\r\nQUIT\r\n')
+        self.assertEqual([self.reply(f) for i in range(3)],
+                         ['250', '221', ''])
+        self.assertEqual(self.server.messages,
+                         [('a@b', ['c@d'], 'Subject: test\n\nbody')])
+
+    def test_timeout(self):
+        f = self.connect(self.serve(timeout=0.2))
+        f.write('HELO client\r\n')
+        self.assertEqual(self.reply(f), '250')
+        # Nothing more is sent
+        self.assertEqual(self.reply(f), '421')
+        self.assertEqual(self.reply(f), '')
+
+    def test_timeout_waiting(self):
+        # A client waiting on a verdict is not timed out
+        pending = self.server.status = Pending()
+        f = self.connect(self.serve(timeout=0.2))
+        f.write('HELO client\r\n' + MESSAGE + '\r\n.\r\n')
+        self.assertEqual([self.reply(f) for i in range(4)],
+                         ['250', '250', '250', '354'])
+        threading.Timer(0.5, self.loop.call_soon_threadsafe,
+                        (pending.fire, '554 blocked')).start()
+        self.assertEqual(self.reply(f), '554')
+        # Idle again once answered
+        self.assertEqual(self.reply(f), '421')
+
+    def test_executor(self):
+        self.serve()
+        executor = Executor(self.loop)
+        result, thread = self.on_loop(executor.call, lambda x: x + 1, 1)
+        self.assertEqual(result, 2)
+        # The result comes back to the loop
+        self.assertEqual(thread, self.thread)
+
+    def test_executor_raises(self):
+        self.serve()
+        executor = Executor(self.loop)
+        result, thread = self.on_loop(executor.call, lambda: 1 / 0)
+        self.assertEqual(result[:3], '451')
+
+    def test_engine(self):
+        self.serve()
+        processor = Threaded()
+        engine = ExecutorEngine([processor], Executor(self.loop))
+        verdicts, thread = self.on_loop(
+            engine.submit, [Attachment('a', 'dirty'),
+                            Attachment('b', 'boom')])
+        self.assertTrue(verdicts[0][0])
+        self.assertTrue(verdicts[1][0].failed)
+        self.assertEqual(thread, self.thread)
+        self.assertNotIn(self.thread, processor.threads)
+        self.assertEqual(engine.pending, 0)
+
+    def test_proxy(self):
+        # Scanning and quarantining run off the loop
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.mkdir(os.path.join(directory, 'quarantine'))
+        processor = Threaded()
+        executor = Executor(self.loop)
+        proxy = BulkProxy(('127.0.0.1', 0), ('127.0.0.1', 0), [processor],
+                          listen=False, block=True, always_block=True,
+                          base_directory=directory + '/',
+                          scan_engine=ExecutorEngine([processor], executor),
+                          defer=executor.call)
+        f = self.connect(self.serve(proxy))
+        f.write('HELO client\r\n' + MESSAGE)
+        self.assertEqual([self.reply(f) for i in range(4)],
+                         ['250', '250', '250', '354'])
+        f.write(build_data([('a', 'dirty')]) + '\r\n.\r\n')
+        self.assertEqual(self.reply(f), '250')
+        self.assertEqual(processor.calls, 1)
+        self.assertNotIn(self.thread, processor.threads)
+        self.assertEqual(len(os.listdir(os.path.join(directory,
+                                                    'quarantine'))), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import time
+import logging
+import unittest
+import threading
+
+# Bulk Imports
+from bulk import cache
+from bulk.cache import VerdictCache
+
+
+class Clock(object):
+    """
+    A stand-in for the time module whose time only moves when told to.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class VerdictCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        cache.time = self.clock
+        logging.getLogger('bulk').disabled = True
+
+    def tearDown(self):
+        cache.time = time
+        logging.getLogger('bulk').disabled = False
+
+    def test_get_put(self):
+        verdicts = VerdictCache()
+        self.assertEqual(verdicts.get('a'), None)
+        verdicts.put('a', ['result'])
+        self.assertEqual(verdicts.get('a'), ['result'])
+        self.assertEqual((verdicts.hits, verdicts.misses), (1, 1))
+        self.assertEqual(len(verdicts), 1)
+
+    def test_lru(self):
+        verdicts = VerdictCache(max_entries=2)
+        verdicts.put('a', 1)
+        verdicts.put('b', 2)
+        # Using a makes b the least recently used
+        verdicts.get('a')
+        verdicts.put('c', 3)
+        self.assertEqual(verdicts.get('b'), None)
+        self.assertEqual(verdicts.get('a'), 1)
+        self.assertEqual(verdicts.get('c'), 3)
+        self.assertEqual(verdicts.evictions, 1)
+        self.assertEqual(len(verdicts), 2)
+
+    def test_put_again(self):
+        verdicts = VerdictCache(max_entries=2)
+        verdicts.put('a', 1)
+        verdicts.put('b', 2)
+        verdicts.put('a', 3)
+        verdicts.put('c', 4)
+        self.assertEqual(verdicts.get('a'), 3)
+        self.assertEqual(verdicts.get('b'), None)
+
+    def test_ttl(self):
+        verdicts = VerdictCache(ttl=60)
+        verdicts.put('a', 1)
+        self.clock.now += 59
+        self.assertEqual(verdicts.get('a'), 1)
+        self.clock.now += 2
+        self.assertEqual(verdicts.get('a'), None)
+        self.assertEqual(verdicts.expirations, 1)
+        # Expired entries are dropped
+        self.assertEqual(len(verdicts), 0)
+
+    def test_no_ttl(self):
+        verdicts = VerdictCache(ttl=0)
+        verdicts.put('a', 1)
+        self.clock.now += 10 ** 9
+        self.assertEqual(verdicts.get('a'), 1)
+
+    def test_fingerprint(self):
+        verdicts = VerdictCache(fingerprint='one')
+        verdicts.put('a', 1)
+        verdicts.set_fingerprint('one')
+        self.assertEqual(verdicts.get('a'), 1)
+
+        verdicts.set_fingerprint('two')
+        self.assertEqual(len(verdicts), 0)
+        self.assertEqual(verdicts.get('a'), None)
+        self.assertEqual(verdicts.fingerprint, 'two')
+
+    def test_stats(self):
+        verdicts = VerdictCache(max_entries=1)
+        verdicts.put('a', 1)
+        verdicts.put('b', 2)
+        verdicts.get('a')
+        verdicts.get('b')
+        self.assertEqual(verdicts.stats(),
+                         {'entries': 1, 'max_entries': 1, 'hits': 1,
+                          'misses': 1, 'evictions': 1, 'expirations': 0})
+        self.assertTrue('Hits: 1' in str(verdicts))
+
+    def test_threads(self):
+        verdicts = VerdictCache(max_entries=50)
+
+        def worker(n):
+            for i in range(500):
+                key = '%s-%s' % (n, i % 100)
+                if verdicts.get(key) is None:
+                    verdicts.put(key, i)
+
+        threads = [threading.Thread(target=worker, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(verdicts), 50)
+        self.assertEqual(verdicts.hits + verdicts.misses, 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
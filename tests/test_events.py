@@ -0,0 +1,118 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import tempfile
+import unittest
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+
+# Bulk Imports
+from bulk import events
+from bulk.message import Message, Attachment
+from bulk.processors import Result
+
+
+def build_message(mailfrom, filename, content='payload'):
+    """
+    Build a message carrying one attachment.
+    """
+    mime = MIMEMultipart()
+    mime['Subject'] = 'test'
+    part = MIMEApplication(content)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    mime.attach(part)
+    return Message(('127.0.0.1', 2525), mailfrom, ['c@d'], mime.as_string())
+
+
+class EventStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'events.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, *entries):
+        store = events.EventStore(self.path, flush_interval=0.01)
+        for msg, verdicts in entries:
+            store.record(msg, verdicts, False)
+
+        store.close()
+        return store
+
+    def test_non_ascii(self):
+        msg = build_message('j\xc3\xb6rg@b', 'r\xc3\xa9sum\xc3\xa9.exe')
+        msg.get_attachments()
+        store = self.record((msg, [[Result('test', False)]]))
+
+        self.assertEqual(store.recorded, 1)
+        self.assertEqual(store.lost, 0)
+        conn = events.connect(self.path)
+        self.assertEqual(conn.execute('SELECT mailfrom FROM messages')
+                         .fetchall(), [('j\xc3\xb6rg@b',)])
+        self.assertEqual(conn.execute('SELECT name FROM attachments')
+                         .fetchall(), [('r\xc3\xa9sum\xc3\xa9.exe',)])
+
+    def test_bad_event_loses_only_itself(self):
+        good = build_message('a@b', 'a.bin')
+        good.get_attachments()
+        bad = build_message('a@b', 'b.bin')
+        bad.get_attachments()
+        # Not something sqlite can store
+        bad._mailfrom = object()
+
+        store = self.record((good, [[]]), (bad, [[]]))
+
+        self.assertEqual(store.recorded, 1)
+        self.assertEqual(store.lost, 1)
+        conn = events.connect(self.path)
+        self.assertEqual(len(events.search(conn)), 1)
+
+    def test_members_recorded_by_digest(self):
+        msg = build_message('a@b', 'outer.zip')
+        outer = msg.get_attachments()[0]
+        member = Attachment('outer.zip/inner.exe', 'inner')
+        outer.members = [member]
+
+        outer_result = Result('test', False)
+        outer_result.sha256 = outer.sha256
+        member_result = Result('test', True, [('rule', 'namespace')])
+        member_result.sha256 = member.sha256
+        self.record((msg, [[outer_result, member_result]]))
+
+        conn = events.connect(self.path)
+        self.assertEqual(
+            sorted(conn.execute('SELECT name, sha256 FROM attachments')),
+            sorted([('outer.zip', outer.sha256),
+                    ('outer.zip/inner.exe', member.sha256)]))
+        self.assertEqual(conn.execute('SELECT sha256 FROM hits').fetchall(),
+                         [(member.sha256,)])
+        self.assertEqual(len(events.search(conn, digest=member.sha256)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
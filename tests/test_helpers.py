@@ -0,0 +1,155 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import tempfile
+import unittest
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+# Bulk Imports
+from bulk.helpers import imap_windowed, rule_sources, rules_fingerprint
+
+
+class RulesFingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'common'))
+        self.write('main.yar', 'include "common/strings.yar"\n'
+                               'rule main { condition: true }\n')
+        self.write('common/strings.yar', 'include "../main.yar"\n'
+                                         'rule strings { condition: true }\n')
+        self.specs = [('bulk.processors.yara_processor',
+                       {'main': self.path('main.yar')})]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'wb') as f:
+            f.write(content)
+
+    def test_sources(self):
+        sources = list(rule_sources(self.path('main.yar')))
+        self.assertEqual([path for path, source in sources],
+                         [self.path('main.yar'),
+                          self.path('common/strings.yar')])
+
+        sources = list(rule_sources(self.path('main.yar'), includes=False))
+        self.assertEqual(len(sources), 1)
+
+    def test_include_changes(self):
+        before = rules_fingerprint(self.specs)
+        self.assertEqual(rules_fingerprint(self.specs), before)
+
+        self.write('common/strings.yar', 'rule strings { condition: false }\n')
+        self.assertNotEqual(rules_fingerprint(self.specs), before)
+
+    def test_missing(self):
+        self.write('main.yar', 'include "missing.yar"\n')
+        before = rules_fingerprint(self.specs)
+        os.remove(self.path('main.yar'))
+        self.assertNotEqual(rules_fingerprint(self.specs), before)
+
+
+def square(x):
+    if x < 0:
+        raise ValueError('negative')
+
+    return x * x
+
+
+class ImapWindowedTest(unittest.TestCase):
+
+    def test_results(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertEqual(sorted(imap_windowed(pool, square, xrange(100),
+                                                  10, 3)),
+                             [x * x for x in xrange(100)])
+
+        finally:
+            pool.terminate()
+
+    def test_error(self):
+        pool = ThreadPool(2)
+        try:
+            with self.assertRaises(ValueError):
+                list(imap_windowed(pool, square, [1, 2, -1, 3], 2))
+
+        finally:
+            pool.terminate()
+
+    def test_window(self):
+        # Tasks are only taken as there is room for them
+        taken = []
+
+        def tasks():
+            for x in xrange(20):
+                taken.append(x)
+                yield x
+
+        pool = ThreadPool(2)
+        try:
+            results = imap_windowed(pool, square, tasks(), 4, 2)
+            next(results)
+            self.assertTrue(len(taken) <= 6)
+            self.assertEqual(len(list(results)), 19)
+
+        finally:
+            pool.terminate()
+
+    def test_slow_task(self):
+        # The rest keep going while one task of the window is slow
+        release = threading.Event()
+
+        def work(x):
+            if x == 0:
+                release.wait(5)
+
+            return x
+
+        pool = ThreadPool(2)
+        try:
+            results = []
+            for result in imap_windowed(pool, work, xrange(10), 2):
+                results.append(result)
+                if len(results) == 9:
+                    release.set()
+
+            self.assertEqual(results, range(1, 10) + [0])
+
+        finally:
+            release.set()
+            pool.terminate()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,179 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import json
+import shutil
+import zipfile
+import tempfile
+import unittest
+from StringIO import StringIO
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+
+# Bulk Imports
+from bulk import ingest
+from bulk.unpack import Unpacker
+
+
+SPECS = [('tests.processor', {})]
+
+
+def build_message(attachments, subject='test'):
+    """
+    Build the text of a message carrying (filename, content) attachments.
+    """
+    mime = MIMEMultipart()
+    mime['Subject'] = subject
+    for filename, content in attachments:
+        part = MIMEApplication(content)
+        part.add_header('Content-Disposition', 'attachment',
+                        filename=filename)
+        mime.attach(part)
+
+    return mime.as_string()
+
+
+def build_zip(members):
+    """
+    Build a zip archive of (name, content) members, compressed so the
+    members cannot be matched without unpacking them.
+    """
+    f = StringIO()
+    archive = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+    for name, content in members:
+        archive.writestr(name, content)
+
+    archive.close()
+    return f.getvalue()
+
+
+class IngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        # An mbox holding a dirty and a clean message, with a From line
+        # quoted in the body of the second
+        self.mbox = os.path.join(self.directory, 'mbox')
+        with open(self.mbox, 'wb') as f:
+            f.write('From a@b Mon Jan  1 00:00:00 2024\n')
+            f.write(build_message([('bad.exe', 'dirty')], 'one') + '\n\n')
+            f.write('From c@d Mon Jan  1 00:00:00 2024\n')
+            f.write(build_message([('notes.txt', 'clean')], 'two') +
+                    '\n>From the body\n\n')
+
+        # A Maildir with a zipped dirty attachment and a message that
+        # breaks the processor
+        self.maildir = os.path.join(self.directory, 'Maildir')
+        for dn in ['cur', 'new', 'tmp']:
+            os.makedirs(os.path.join(self.maildir, dn))
+
+        with open(os.path.join(self.maildir, 'new', '1'), 'wb') as f:
+            f.write(build_message([('a.zip',
+                                    build_zip([('bad.exe', 'dirty')]))],
+                                  'three'))
+
+        with open(os.path.join(self.maildir, 'cur', '2:2,S'), 'wb') as f:
+            f.write(build_message([('boom.bin', 'boom')], 'four'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_ingest(self, **kwargs):
+        kwargs.setdefault('workers', 1)
+        output = StringIO()
+        summary = ingest.ingest([self.mbox, self.maildir], SPECS, {}, output,
+                                **kwargs)
+        records = [json.loads(line)
+                   for line in output.getvalue().splitlines()]
+        return summary, dict((record['subject'], record)
+                             for record in records)
+
+    def test_mbox_messages(self):
+        found = list(ingest.mbox_messages(self.mbox))
+        self.assertEqual(len(found), 2)
+        # Reading a little at a time finds the same messages
+        self.assertEqual(list(ingest.mbox_messages(self.mbox, 7)), found)
+
+        data, mailfrom = ingest.read_message(self.mbox, *found[1])
+        self.assertEqual(mailfrom, 'c@d')
+        self.assertTrue(data.startswith('Content-Type'))
+        self.assertTrue(data.endswith('>From the body\n'))
+
+    def test_maildir_messages(self):
+        self.assertEqual([os.path.relpath(path, self.maildir)
+                          for path in ingest.maildir_messages(self.maildir)],
+                         ['cur/2:2,S', 'new/1'])
+
+    def test_ingest(self):
+        summary, records = self.run_ingest()
+        self.assertEqual(summary['messages'], 4)
+        self.assertEqual(summary['malicious'], 1)
+        self.assertEqual(summary['failed'], 1)
+        self.assertEqual(summary['errors'], 0)
+
+        self.assertEqual(records['one']['verdict'], 'malicious')
+        self.assertEqual(records['one']['mailfrom'], 'a@b')
+        self.assertEqual(records['one']['attachments'][0]['results'][0]
+                         ['hits'], [{'rule': 'dirty', 'namespace': 'tests'}])
+        self.assertEqual(records['two']['verdict'], 'clean')
+        # Without an unpacker the zip is scanned as it is
+        self.assertEqual(records['three']['verdict'], 'clean')
+        self.assertEqual(records['four']['verdict'], 'failed')
+        self.assertEqual(records['four']['offset'], None)
+
+    def test_workers(self):
+        # Messages handed out one at a time to several workers come out
+        # with the same verdicts, whatever order they finish in
+        summary, records = self.run_ingest()
+        verdicts = dict((subject, record['verdict'])
+                        for subject, record in records.items())
+        summary, records = self.run_ingest(workers=2, chunk_size=1)
+        self.assertEqual(summary['messages'], 4)
+        self.assertEqual(dict((subject, record['verdict'])
+                              for subject, record in records.items()),
+                         verdicts)
+
+    def test_no_cache(self):
+        summary, records = self.run_ingest(cache_size=0)
+        self.assertEqual(summary['malicious'], 1)
+        self.assertEqual(records['two']['verdict'], 'clean')
+
+    def test_unpack(self):
+        summary, records = self.run_ingest(unpacker=Unpacker())
+        self.assertEqual(records['three']['verdict'], 'malicious')
+        self.assertEqual([attachment['name'] for attachment
+                          in records['three']['attachments']],
+                         ['a.zip', 'a.zip/bad.exe'])
+
+    def test_unpack_problems(self):
+        summary, records = self.run_ingest(unpacker=Unpacker(max_depth=0))
+        self.assertEqual(records['three']['verdict'], 'incomplete')
+        self.assertEqual(summary['incomplete'], 1)
+        self.assertEqual(len(records['three']['problems']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
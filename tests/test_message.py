@@ -0,0 +1,132 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import pickle
+import hashlib
+import tempfile
+import unittest
+
+# Bulk Imports
+from bulk.message import Attachment, Message
+from tests.test_pipeline import build_data
+
+
+class AttachmentTest(unittest.TestCase):
+
+    def setUp(self):
+        # Hash in several steps
+        self.chunk_size = Attachment.CHUNK_SIZE
+        Attachment.CHUNK_SIZE = 7
+        self.content = ''.join(chr(i) for i in range(256)) * 3
+
+    def tearDown(self):
+        Attachment.CHUNK_SIZE = self.chunk_size
+
+    def assertDigests(self, attachment):
+        self.assertEqual(attachment.size, len(self.content))
+        self.assertEqual(attachment.md5,
+                         hashlib.md5(self.content).hexdigest())
+        self.assertEqual(attachment.sha1,
+                         hashlib.sha1(self.content).hexdigest())
+        self.assertEqual(attachment.sha256,
+                         hashlib.sha256(self.content).hexdigest())
+
+    def temporary_file(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.content)
+
+        return path
+
+    def test_content(self):
+        attachment = Attachment('a', self.content)
+        self.assertDigests(attachment)
+        self.assertEqual(attachment.open().read(), self.content)
+
+    def test_empty(self):
+        attachment = Attachment('a', None)
+        self.assertEqual(attachment.size, 0)
+        self.assertEqual(attachment.md5, hashlib.md5('').hexdigest())
+
+    def test_path(self):
+        path = self.temporary_file()
+        attachment = Attachment('a', path=path)
+        self.assertDigests(attachment)
+        self.assertEqual(attachment.content, self.content)
+
+        # Copies leave the file to the original
+        copy = pickle.loads(pickle.dumps(attachment))
+        del copy
+        self.assertTrue(os.path.exists(path))
+        del attachment
+        self.assertFalse(os.path.exists(path))
+
+    def test_keep(self):
+        path = self.temporary_file()
+        attachment = Attachment('a', path=path, keep=True)
+        self.assertDigests(attachment)
+        del attachment
+        self.assertTrue(os.path.exists(path))
+        os.remove(path)
+
+
+class MessageTest(unittest.TestCase):
+
+    def count_walks(self, msg):
+        """
+        Count how often the message's parts are looked through.
+        """
+        walks = []
+        walk = msg._parsed_message.walk
+        msg._parsed_message.walk = lambda: walks.append(True) or walk()
+        return walks
+
+    def test_attachments(self):
+        msg = Message(None, 'a@b', ['c@d'], build_data([('a', 'content')]))
+        walks = self.count_walks(msg)
+        [attachment] = msg.get_attachments()
+        self.assertEqual(attachment.content, 'content')
+        self.assertIs(msg.get_attachments()[0], attachment)
+        self.assertEqual(len(walks), 1)
+
+    def test_no_attachments(self):
+        # Finding none is remembered too
+        msg = Message(None, 'a@b', ['c@d'], build_data([]))
+        walks = self.count_walks(msg)
+        self.assertEqual(msg.get_attachments(), [])
+        self.assertEqual(msg.get_attachments(), [])
+        self.assertEqual(len(walks), 1)
+
+    def test_given(self):
+        # Pulled out already, such as while the message streamed in
+        msg = Message(None, 'a@b', ['c@d'], build_data([('a', 'content')]),
+                      attachments=[])
+        walks = self.count_walks(msg)
+        self.assertEqual(msg.get_attachments(), [])
+        self.assertEqual(walks, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
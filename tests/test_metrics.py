@@ -0,0 +1,171 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import logging
+import threading
+import unittest
+
+# Bulk Imports
+from bulk.metrics import Registry, merge, render
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('c', 'Count')
+        counter.inc()
+        counter.inc(2)
+        self.assertEqual(counter.samples(), [('', (), None, 3)])
+
+    def test_labels(self):
+        counter = self.registry.counter('c', 'Count', ['verdict'])
+        counter.labels('clean').inc()
+        counter.labels('malicious').inc()
+        counter.labels('clean').inc()
+        self.assertEqual(counter.samples(),
+                         [('', ('clean',), None, 2),
+                          ('', ('malicious',), None, 1)])
+
+    def test_threads(self):
+        # Every thread counts into its own shard, all of them add up
+        counter = self.registry.counter('c', 'Count')
+
+        def count():
+            for _ in xrange(1000):
+                counter.inc()
+
+        threads = [threading.Thread(target=count) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(counter._shards), 8)
+        self.assertEqual(counter.samples(), [('', (), None, 8000)])
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('h', 'Seconds',
+                                            buckets=(1.0, 2.0))
+        for value in (0.5, 1.0, 1.5, 3.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.samples(),
+                         [('_bucket', (), ('le', '1.0'), 2),
+                          ('_bucket', (), ('le', '2.0'), 3),
+                          ('_bucket', (), ('le', '+Inf'), 4),
+                          ('_sum', (), None, 6.0),
+                          ('_count', (), None, 4)])
+
+    def test_histogram_threads(self):
+        histogram = self.registry.histogram('h', 'Seconds',
+                                            buckets=(1.0,))
+        thread = threading.Thread(target=histogram.observe, args=(2.0,))
+        thread.start()
+        thread.join()
+        histogram.observe(0.5)
+
+        self.assertEqual(histogram.samples(),
+                         [('_bucket', (), ('le', '1.0'), 1),
+                          ('_bucket', (), ('le', '+Inf'), 2),
+                          ('_sum', (), None, 2.5),
+                          ('_count', (), None, 2)])
+
+    def test_callback(self):
+        depth = [None]
+        self.registry.callback('q', 'Depth', lambda: depth[0])
+        self.assertEqual(self.registry.snapshot(),
+                         [('q', 'Depth', 'gauge', (), [])])
+
+        depth[0] = 5
+        # Replaces the callback of the same name
+        self.registry.callback('q', 'Depth', lambda: depth[0] * 2)
+        self.assertEqual(self.registry.snapshot(),
+                         [('q', 'Depth', 'gauge', (), [('', (), None, 10)])])
+
+    def test_broken_callback(self):
+        logging.getLogger('bulk').disabled = True
+        try:
+            self.registry.callback('q', 'Depth', lambda: 1 / 0)
+            self.registry.counter('c', 'Count').inc()
+            self.assertEqual([metric[0]
+                              for metric in self.registry.snapshot()],
+                             ['c'])
+
+        finally:
+            logging.getLogger('bulk').disabled = False
+
+    def test_merge(self):
+        counter = self.registry.counter('c', 'Count', ['verdict'])
+        counter.labels('clean').inc()
+        first = self.registry.snapshot()
+        counter.labels('malicious').inc(2)
+        second = self.registry.snapshot()
+
+        self.assertEqual(merge([first, second]),
+                         [('c', 'Count', 'counter', ('verdict',),
+                           [('', ('clean',), None, 2),
+                            ('', ('malicious',), None, 2)])])
+
+    def test_merge_histogram(self):
+        histogram = self.registry.histogram('h', 'Seconds',
+                                            buckets=(1.0,))
+        histogram.observe(0.5)
+        snapshot = self.registry.snapshot()
+
+        [(name, _, _, _, samples)] = merge([snapshot, snapshot])
+        self.assertEqual(samples,
+                         [('_bucket', (), ('le', '1.0'), 2),
+                          ('_bucket', (), ('le', '+Inf'), 2),
+                          ('_sum', (), None, 1.0),
+                          ('_count', (), None, 2)])
+
+    def test_render(self):
+        counter = self.registry.counter('bulk_c', 'Count', ['verdict'])
+        counter.labels('clean').inc()
+        counter.labels('say "hi"\n').inc(2)
+        histogram = self.registry.histogram('bulk_h', 'Seconds',
+                                            buckets=(1.0,))
+        histogram.observe(2.0)
+
+        self.assertEqual(render(self.registry.snapshot()), '\n'.join([
+            '# HELP bulk_c Count',
+            '# TYPE bulk_c counter',
+            'bulk_c{verdict="clean"} 1.0',
+            r'bulk_c{verdict="say \"hi\"\n"} 2.0',
+            '# HELP bulk_h Seconds',
+            '# TYPE bulk_h histogram',
+            'bulk_h_bucket{le="1.0"} 0.0',
+            'bulk_h_bucket{le="+Inf"} 1.0',
+            'bulk_h_sum 2.0',
+            'bulk_h_count 1.0']) + '\n')
+        self.assertEqual(self.registry.render(),
+                         render(self.registry.snapshot()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import unittest
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+
+# Bulk Imports
+from bulk.proxy import BulkProxy
+from bulk.cache import VerdictCache
+from bulk.message import Attachment
+from bulk.pipeline import Pipeline
+from tests.processor import Processor
+from tests.legacy_processor import Processor as Legacy
+
+
+def build_data(attachments):
+    """
+    Build raw DATA, as received over SMTP, for a message carrying
+    (filename, content) attachments.
+    """
+    mime = MIMEMultipart()
+    mime['Subject'] = 'test'
+    for filename, content in attachments:
+        part = MIMEApplication(content)
+        part.add_header('Content-Disposition', 'attachment',
+                        filename=filename)
+        mime.attach(part)
+
+    return mime.as_string().replace('\n', '\r\n')
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processors = [Processor(), Processor()]
+        self.attachments = [Attachment('a', 'dirty'), Attachment('b', 'x')]
+
+    def test_everything(self):
+        verdicts = Pipeline(self.processors).match_batch(self.attachments)
+        self.assertEqual([len(verdict) for verdict in verdicts], [2, 2])
+        self.assertTrue(verdicts[0][0])
+        self.assertFalse(any(verdicts[1]))
+
+    def test_short_circuit(self):
+        pipeline = Pipeline(self.processors, short_circuit=True)
+        verdicts = pipeline.match_batch(self.attachments)
+        # The first processor's match decides the whole batch
+        self.assertEqual([len(verdict) for verdict in verdicts], [1, 1])
+        self.assertTrue(verdicts[0][0])
+        self.assertEqual(sum(processor.calls
+                             for processor in self.processors), 2)
+        self.assertEqual(pipeline.skipped, 2)
+
+    def test_failure(self):
+        attachments = [Attachment('a', 'boom'), Attachment('b', 'dirty')]
+        verdicts = Pipeline(self.processors[:1]).match_batch(attachments)
+        self.assertTrue(verdicts[0][0].failed)
+        self.assertTrue(verdicts[1][0])
+
+    def test_legacy(self):
+        # Processors returning bools still decide, and short circuit
+        legacy = Legacy()
+        pipeline = Pipeline([legacy, Processor()], short_circuit=True)
+        verdicts = pipeline.match_batch(self.attachments)
+        self.assertEqual(legacy.data, ['dirty', 'x'])
+        self.assertEqual([len(verdict) for verdict in verdicts], [1, 1])
+        self.assertTrue(verdicts[0][0].matched)
+        self.assertFalse(verdicts[1][0].matched)
+        self.assertFalse(verdicts[0][0].failed)
+
+
+class ProxyShortCircuitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = Processor()
+
+    def proxy(self, **kwargs):
+        return BulkProxy(('127.0.0.1', 0), ('127.0.0.1', 0),
+                         [self.processor], listen=False, block=True,
+                         always_block=True, base_directory='/nonexistent/',
+                         **kwargs)
+
+    def scan(self, proxy, attachments):
+        stream = proxy.begin_message(('127.0.0.1', 0), 'a@b', ['c@d'])
+        stream.feed(build_data(attachments) + '\r\n')
+        stream.close()
+        return [pending.result for pending in stream.results]
+
+    def test_stream(self):
+        scans = self.scan(self.proxy(short_circuit=True),
+                          [('a', 'dirty'), ('b', 'clean'), ('c', 'clean')])
+        self.assertEqual(self.processor.calls, 1)
+        self.assertTrue(scans[0][0][0])
+        for scan in scans[1:]:
+            self.assertEqual(len(scan[0]), 1)
+            self.assertFalse(scan[0][0])
+            self.assertIn('Not scanned', scan[0][0].error)
+
+    def test_scan_everything(self):
+        self.scan(self.proxy(), [('a', 'dirty'), ('b', 'clean')])
+        self.assertEqual(self.processor.calls, 2)
+
+    def test_cached_match(self):
+        cache = VerdictCache()
+        proxy = self.proxy(short_circuit=True, verdict_cache=cache)
+        self.scan(proxy, [('a', 'dirty')])
+        self.assertEqual(len(cache), 1)
+
+        # The cached match decides the message before anything is scanned
+        attachments = [Attachment('b', 'clean'), Attachment('a', 'dirty')]
+        verdicts = proxy.scan_attachments('a@b', ['c@d'], attachments).result
+        self.assertEqual(self.processor.calls, 1)
+        self.assertIn('Not scanned', verdicts[0][0].error)
+        self.assertTrue(verdicts[1][0])
+        # What was left unscanned is not cached as clean
+        self.assertEqual(len(cache), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
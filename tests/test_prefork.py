@@ -0,0 +1,165 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import time
+import shutil
+import signal
+import logging
+import tempfile
+import threading
+import unittest
+
+# Bulk Imports
+from bulk.prefork import Supervisor, RESTARTS
+
+
+def restarts():
+    return sum(count for _, _, _, count in RESTARTS.samples())
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.handlers = dict((signum, signal.getsignal(signum))
+                             for signum in (signal.SIGTERM, signal.SIGINT,
+                                            signal.SIGHUP))
+        # Restarts are logged on purpose
+        logging.getLogger('bulk').disabled = True
+
+    def tearDown(self):
+        for signum, handler in self.handlers.items():
+            signal.signal(signum, handler)
+
+        logging.getLogger('bulk').disabled = False
+        shutil.rmtree(self.directory)
+
+    def reap(self, supervisor):
+        """
+        Wait for the workers to exit and deal with them.
+        """
+        deadline = time.time() + 10
+        while supervisor._children and time.time() < deadline:
+            time.sleep(0.01)
+            supervisor._reap()
+
+        self.assertEqual(supervisor._children, {})
+
+    def fail_once(self, supervisor, uptime=0):
+        """
+        Run a worker that fails right away, as if it had been running
+        for uptime seconds.
+
+        Returns how long until it is started again.
+        """
+        supervisor._spawn(0)
+        [(pid, (index, started, conn))] = supervisor._children.items()
+        supervisor._children[pid] = (index, started - uptime, conn)
+        self.reap(supervisor)
+        return supervisor._due.pop(0) - time.time()
+
+    def test_backoff(self):
+        # Workers leave with os._exit, so the test runner is not carried
+        # on in the forked process
+        supervisor = Supervisor(1, lambda index: os._exit(1))
+        supervisor.MAX_DELAY = 3
+        before = restarts()
+
+        # Doubling every time it fails soon after starting, up to a limit
+        delays = [self.fail_once(supervisor) for _ in range(3)]
+        self.assertAlmostEqual(delays[0], 1, delta=0.5)
+        self.assertAlmostEqual(delays[1], 2, delta=0.5)
+        self.assertAlmostEqual(delays[2], 3, delta=0.5)
+        self.assertEqual(restarts(), before + 3)
+
+        # Starting fine resets it
+        self.assertAlmostEqual(
+            self.fail_once(supervisor, supervisor.MIN_UPTIME + 1), 1,
+            delta=0.5)
+        self.assertAlmostEqual(self.fail_once(supervisor), 2, delta=0.5)
+
+    def test_stopping(self):
+        supervisor = Supervisor(1, lambda index: os._exit(1))
+        supervisor._stopping = True
+        before = restarts()
+        supervisor._spawn(0)
+        self.reap(supervisor)
+        self.assertEqual(supervisor._due, {})
+        self.assertEqual(restarts(), before)
+
+    def worker(self, index):
+        """
+        Note starting and every SIGHUP in a file, until SIGTERM.
+        """
+        def note(line):
+            with open(os.path.join(self.directory, str(index)), 'a') as f:
+                f.write(line + '\n')
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+        signal.signal(signal.SIGHUP, lambda signum, frame: note('hup'))
+        note('start')
+        while True:
+            time.sleep(0.01)
+
+    def notes(self):
+        notes = {}
+        for name in os.listdir(self.directory):
+            with open(os.path.join(self.directory, name)) as f:
+                notes[int(name)] = f.read().split()
+
+        return notes
+
+    def wait_for(self, notes):
+        deadline = time.time() + 10
+        while self.notes() != notes and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_hangup(self):
+        hangups = []
+        supervisor = Supervisor(2, self.worker, report_interval=60,
+                                on_hangup=lambda: hangups.append(True))
+
+        def signal_supervisor():
+            try:
+                self.wait_for({0: ['start'], 1: ['start']})
+                os.kill(os.getpid(), signal.SIGHUP)
+                self.wait_for({0: ['start', 'hup'], 1: ['start', 'hup']})
+
+            finally:
+                os.kill(os.getpid(), signal.SIGTERM)
+
+        thread = threading.Thread(target=signal_supervisor)
+        thread.start()
+        supervisor.run()
+        thread.join()
+
+        self.assertEqual(hangups, [True])
+        self.assertEqual(self.notes(), {0: ['start', 'hup'],
+                                        1: ['start', 'hup']})
+        self.assertEqual(supervisor._children, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import unittest
+
+# Bulk Imports
+from bulk.message import Attachment
+from bulk.helpers import build_processor
+from bulk.processors import Result, match, match_batch
+from bulk.processors import basic
+from tests.processor import Processor
+from tests.legacy_processor import Processor as Legacy
+
+
+class Batched(Processor):
+    """
+    The test processor, with a match_batch of its own.
+    """
+
+    def __init__(self, rule_files=None, **options):
+        Processor.__init__(self, rule_files, **options)
+        self.batches = []
+
+    def match_batch(self, attachments):
+        self.batches.append(len(attachments))
+        return [Result(__name__, False) for attachment in attachments]
+
+
+class MatchBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.attachments = [Attachment('a', 'dirty'), Attachment('b', 'x')]
+
+    def test_match_only(self):
+        processor = Processor()
+        results = match_batch(processor, self.attachments)
+        self.assertEqual(processor.calls, 2)
+        self.assertEqual([bool(result) for result in results],
+                         [True, False])
+        self.assertEqual(results[0].hits, [('dirty', 'tests')])
+
+    def test_match_only_raises(self):
+        self.assertRaises(ValueError, match_batch, Processor(),
+                          [Attachment('a', 'boom')])
+
+    def test_batched(self):
+        processor = Batched()
+        results = match_batch(processor, self.attachments)
+        self.assertEqual(processor.batches, [2])
+        self.assertEqual(processor.calls, 0)
+        self.assertEqual(len(results), 2)
+
+    def test_basic(self):
+        results = match_batch(basic.Processor(), self.attachments)
+        self.assertEqual([bool(result) for result in results], [True, True])
+
+    def test_legacy(self):
+        processor = Legacy()
+        results = match_batch(processor, self.attachments)
+        self.assertEqual(processor.data, ['dirty', 'x'])
+        self.assertTrue(all(isinstance(result, Result)
+                            for result in results))
+        self.assertEqual([result.matched for result in results],
+                         [True, False])
+        self.assertEqual(results[0].processor, 'tests.legacy_processor')
+
+    def test_legacy_match(self):
+        result = match(Legacy(), Attachment('a', 'dirty'))
+        self.assertTrue(isinstance(result, Result))
+        self.assertTrue(result)
+
+    def test_legacy_build(self):
+        # Legacy processors are built with the rules alone
+        processor = build_processor('tests.legacy_processor',
+                                    cache_directory='/nonexistent')
+        self.assertTrue(isinstance(processor, Legacy))
+
+    def test_empty(self):
+        self.assertEqual(match_batch(Processor(), []), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import tempfile
+import unittest
+
+# Bulk Imports
+from bulk import profiler
+
+
+MAIN = '''import "math"
+include "common/strings.yar"
+
+rule fast { condition: common }
+rule slow { strings: $a = "include \\"x\\"" condition: $a }
+rule other { condition: false }
+'''
+
+COMMON = '''rule common { condition: true }
+'''
+
+
+class SplitRulesTest(unittest.TestCase):
+
+    def test_split(self):
+        header, rules = profiler.split_rules(MAIN)
+        self.assertEqual(header, 'import "math"\ninclude "common/strings.yar"')
+        self.assertEqual([rule[0] for rule in rules],
+                         ['fast', 'slow', 'other'])
+        # Rules from included files are not known to the splitter
+        self.assertEqual(rules[0][3], set())
+
+    def test_global(self):
+        header, rules = profiler.split_rules(
+            'global rule g { condition: true }\n'
+            'rule r { condition: g }\n')
+        self.assertEqual(rules[0][2], True)
+        self.assertEqual(rules[1][3], set(['g']))
+
+
+@unittest.skipIf(profiler.yara is None, 'needs yara')
+class RuleProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'common'))
+        self.write('main.yar', MAIN)
+        self.write('common/strings.yar', COMMON)
+        self.write('sample', 'include "x" ' * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, name, content):
+        with open(self.path(name), 'wb') as f:
+            f.write(content)
+
+    def test_includes(self):
+        # Every set of rules gets split, down to the single rules
+        rule_profiler = profiler.RuleProfiler({'main': self.path('main.yar')},
+                                              {'includes': True},
+                                              resolution=0.0)
+        costs = rule_profiler.profile([self.path('sample')])
+        self.assertEqual(sorted(cost.rules for cost in costs),
+                         [('fast',), ('other',), ('slow',)])
+        matched = dict((cost.rules, cost.matches) for cost in costs)
+        self.assertEqual(matched[('fast',)], 1)
+        self.assertEqual(matched[('slow',)], 1)
+
+        # The temporary files are gone
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['common', 'main.yar', 'sample'])
+
+    def test_options(self):
+        # Subsets are compiled with the same options as the whole file
+        rule_profiler = profiler.RuleProfiler(
+            {'main': self.path('main.yar')},
+            {'includes': True, 'externals': {'flag': True}},
+            resolution=0.0)
+        self.write('main.yar', 'rule a { condition: flag }\n'
+                               'rule b { condition: not flag }\n')
+        costs = rule_profiler.profile([self.path('sample')])
+        self.assertEqual(sorted(cost.rules for cost in costs),
+                         [('a',), ('b',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import tempfile
+import unittest
+
+# Bulk Imports
+from bulk import message
+from bulk.proxy import BulkProxy
+from bulk.store import AttachmentStore
+from tests.processor import Processor
+from tests.test_pipeline import build_data
+
+
+class Recording(Processor):
+    """
+    The test processor, noting what it was handed to scan.
+    """
+
+    def __init__(self, rule_files=None, **options):
+        Processor.__init__(self, rule_files, **options)
+        self.scanned = []
+
+    def match(self, attachment):
+        self.scanned.append((attachment.content, attachment.path))
+        return Processor.match(self, attachment)
+
+
+class SizeTierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = Recording()
+
+    def scan(self, content, **kwargs):
+        """
+        Scan an attachment holding content the way the proxy does.
+
+        Returns its processor Results.
+        """
+        proxy = BulkProxy(('127.0.0.1', 0), ('127.0.0.1', 0),
+                          [self.processor], listen=False,
+                          base_directory='/nonexistent/', **kwargs)
+        msg = message.Message(('127.0.0.1', 0), 'a@b', ['c@d'],
+                              build_data([('a', content)]),
+                              memory_limit=kwargs.get('memory_scan_limit',
+                                                      0))
+        return proxy.scan_attachments('a@b', ['c@d'],
+                                      msg.get_attachments()).result[0]
+
+    def test_memory(self):
+        results = self.scan('x' * 100, memory_scan_limit=1000)
+        self.assertEqual(self.processor.scanned, [('x' * 100, None)])
+        self.assertEqual(len(results), 1)
+
+    def test_temporary_file(self):
+        self.scan('x' * 1000, memory_scan_limit=100)
+        [(content, path)] = self.processor.scanned
+        self.assertEqual(content, 'x' * 1000)
+        self.assertNotEqual(path, None)
+        # Removed once the message is done with
+        self.assertFalse(os.path.exists(path))
+
+    def test_headtail(self):
+        content = 'h' * 60 + 'x' * 1000 + 't' * 60
+        results = self.scan(content, max_scan_size=100)
+        self.assertEqual(self.processor.scanned, [('h' * 50 + 't' * 50,
+                                                   None)])
+        self.assertIn('first and last 50 bytes', results[-1].error)
+
+    def test_headtail_file(self):
+        # How much is scanned does not depend on the memory limit,
+        # only where it is kept
+        content = 'h' * 60 + 'x' * 1000 + 't' * 60
+        self.scan(content, max_scan_size=100, memory_scan_limit=60)
+        [(scanned, path)] = self.processor.scanned
+        self.assertEqual(scanned, 'h' * 50 + 't' * 50)
+        self.assertNotEqual(path, None)
+        self.assertFalse(os.path.exists(path))
+
+    def test_skip(self):
+        results = self.scan('dirty' * 100, max_scan_size=100,
+                            oversize_policy='skip')
+        self.assertEqual(self.processor.scanned, [])
+        self.assertFalse(results[0])
+        self.assertIn('Not scanned', results[0].error)
+
+    def test_quarantine(self):
+        results = self.scan('x' * 1000, max_scan_size=100,
+                            oversize_policy='quarantine')
+        self.assertEqual(self.processor.scanned, [])
+        self.assertTrue(results[0])
+
+
+class SaveAttachmentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'quarantine'))
+        os.mkdir(os.path.join(self.directory, 'messages'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def process(self, content, **kwargs):
+        """
+        Run a message with an attachment holding content through a proxy
+        saving attachments.
+
+        Returns the sightings recorded for the attachment.
+        """
+        proxy = BulkProxy(('127.0.0.1', 0), ('127.0.0.1', 0),
+                          [Processor()], listen=False, block=True,
+                          always_block=True, save_attachments=True,
+                          base_directory=self.directory + '/', **kwargs)
+        proxy.process_message(('127.0.0.1', 0), 'a@b', ['c@d'],
+                              build_data([('a', content)]))
+        store = AttachmentStore(os.path.join(self.directory,
+                                             'attachments'))
+        return list(store.sightings(message.Attachment('a',
+                                                       content).sha256))
+
+    def saved(self, directory):
+        return os.listdir(os.path.join(self.directory, directory))
+
+    def test_clean(self):
+        # Only the attachments are saved, not the message
+        [sighting] = self.process('clean')
+        self.assertEqual(sighting['email'], None)
+        self.assertEqual(self.saved('messages'), [])
+
+    def test_logged(self):
+        [sighting] = self.process('clean', log=True)
+        self.assertEqual(self.saved('messages'),
+                         [os.path.basename(sighting['email'])])
+
+    def test_quarantined(self):
+        [sighting] = self.process('dirty')
+        self.assertEqual(self.saved('messages'), [])
+        self.assertEqual(self.saved('quarantine'),
+                         [os.path.basename(sighting['email'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
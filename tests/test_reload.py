@@ -0,0 +1,163 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+# Bulk Imports
+from bulk.proxy import BulkProxy
+from bulk.cache import VerdictCache
+from bulk.helpers import rules_fingerprint
+from bulk.message import Attachment
+from bulk.reload import RuleReloader
+from bulk.scanner import Pending
+from bulk.processors import Result
+
+
+class Processor(object):
+    """
+    A reloadable processor for the tests, matching attachments that
+    contain the word in its rule file.
+    """
+
+    takes_attachments = True
+
+    def __init__(self, rule_files=None, cache=None):
+        self._path = rule_files['tests']
+        self._cache = cache
+        self.word = self.load_rules()
+        self.calls = 0
+        self.locked = []
+
+    def load_rules(self):
+        with open(self._path) as f:
+            return f.read()
+
+    def use_rules(self, rules):
+        if self._cache is not None:
+            self.locked.append(self._cache._lock.locked())
+
+        self.word = rules
+
+    def match(self, attachment):
+        self.calls += 1
+        return Result(__name__, self.word in attachment.content)
+
+
+class Engine(object):
+    """
+    Stands in for a ScanEngine, holding on to scans until told to
+    finish them.
+    """
+
+    def __init__(self):
+        self.scans = []
+
+    def submit(self, attachments):
+        pending = Pending()
+        self.scans.append(pending)
+        return pending
+
+    def reload(self, swap=None):
+        swap()
+
+
+class ReloadTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.getLogger('bulk').disabled = True
+        self.directory = tempfile.mkdtemp()
+        self.rules = {'tests': os.path.join(self.directory, 'rules')}
+        self.write_rules('old')
+        self.specs = [(__name__, self.rules)]
+        self.cache = VerdictCache(fingerprint=rules_fingerprint(self.specs))
+        self.processor = Processor(self.rules, self.cache)
+
+    def tearDown(self):
+        logging.getLogger('bulk').disabled = False
+        shutil.rmtree(self.directory)
+
+    def write_rules(self, word):
+        with open(self.rules['tests'], 'w') as f:
+            f.write(word)
+
+    def proxy(self, **kwargs):
+        return BulkProxy(('127.0.0.1', 0), ('127.0.0.1', 0),
+                         [self.processor], listen=False, block=True,
+                         always_block=True, base_directory='/nonexistent/',
+                         verdict_cache=self.cache, **kwargs)
+
+    def scan(self, proxy, content):
+        return proxy.scan_attachments('a@b', ['c@d'],
+                                      [Attachment('a', content)])
+
+    def reload(self, engine=None):
+        self.write_rules('new')
+        RuleReloader([self.processor], self.specs, engine,
+                     self.cache).reload_now()
+
+    def test_reload(self):
+        proxy = self.proxy()
+        self.assertTrue(self.scan(proxy, 'old').result[0][0])
+        self.assertTrue(self.scan(proxy, 'old').result[0][0])
+        self.assertEqual(self.processor.calls, 1)
+
+        self.reload()
+        # The rules changed with the cache locked
+        self.assertEqual(self.processor.locked, [True])
+        self.assertEqual(self.cache.fingerprint,
+                         rules_fingerprint(self.specs))
+        self.assertFalse(self.scan(proxy, 'old').result[0][0])
+        self.assertEqual(self.processor.calls, 2)
+
+    def test_scan_across_reload(self):
+        engine = Engine()
+        proxy = self.proxy(scan_engine=engine)
+        pending = self.scan(proxy, 'old')
+
+        # A scan with the old rules finishes after the reload
+        self.reload(engine)
+        self.assertEqual(self.processor.locked, [True])
+        engine.scans[0].fire([[Result(__name__, True)]])
+        self.assertTrue(pending.result[0][0])
+        self.assertEqual(len(self.cache), 0)
+
+        # So the next copy is scanned with the new rules
+        self.scan(proxy, 'old')
+        self.assertEqual(len(engine.scans), 2)
+
+    def test_stale_put(self):
+        fingerprint = self.cache.fingerprint
+        self.cache.set_fingerprint('new')
+        self.cache.put('a', 1, fingerprint)
+        self.assertEqual(self.cache.get('a'), None)
+        self.cache.put('a', 2, 'new')
+        self.assertEqual(self.cache.get('a'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import tempfile
+import unittest
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+
+# Bulk Imports
+from bulk import rescan
+from bulk.message import Message
+from bulk.store import AttachmentStore
+from bulk.helpers import create_sub_directories
+
+
+SPECS = [('tests.processor', {})]
+
+
+def build_message(attachments, mailfrom='a@b'):
+    """
+    Build a message carrying (filename, content) attachments.
+    """
+    mime = MIMEMultipart()
+    mime['Subject'] = 'test'
+    for filename, content in attachments:
+        part = MIMEApplication(content)
+        part.add_header('Content-Disposition', 'attachment',
+                        filename=filename)
+        mime.attach(part)
+
+    return Message(('127.0.0.1', 2525), mailfrom, ['c@d'], mime.as_string())
+
+
+class RescanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp() + os.sep
+        create_sub_directories(self.basedir)
+        self.database = self.basedir + 'rescan.db'
+
+        dirty = build_message([('r\xc3\xa9sum\xc3\xa9.exe', 'dirty'),
+                               ('notes.txt', 'clean')],
+                              'j\xc3\xb6rg@b')
+        dirty.save(self.basedir + 'quarantine/')
+        dirty.save_attachments(AttachmentStore(self.basedir + 'attachments'))
+
+        # The same clean attachment again, in another message
+        build_message([('notes.txt', 'clean')]).save(
+            self.basedir + 'messages/')
+        build_message([]).save(self.basedir + 'messages/')
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def rescan(self, fingerprint='rules', **kwargs):
+        return rescan.rescan(self.basedir, SPECS, {}, fingerprint,
+                             self.database, workers=1, **kwargs)
+
+    def test_load_message(self):
+        path = os.path.join(self.basedir + 'quarantine',
+                            os.listdir(self.basedir + 'quarantine')[0])
+        msg = rescan.load_message(path)
+
+        self.assertEqual(msg.mailfrom, 'j\xc3\xb6rg@b')
+        self.assertEqual(msg.rcpttos, ['c@d'])
+        self.assertEqual([a.name for a in msg.get_attachments()],
+                         ['r\xc3\xa9sum\xc3\xa9.exe', 'notes.txt'])
+
+    def test_walk_leaves_out_sightings(self):
+        trees = [tree for tree, path in rescan.walk(self.basedir)]
+        self.assertEqual(sorted(trees), ['attachments', 'attachments',
+                                         'messages', 'messages',
+                                         'quarantine'])
+
+    def test_rescan(self):
+        summary = self.rescan()
+
+        self.assertEqual(summary['files'], 5)
+        self.assertEqual(summary['unreadable'], 0)
+        # Two distinct attachments, the rest seen before
+        self.assertEqual(summary['scanned'], 2)
+        self.assertEqual(summary['skipped'], 3)
+        self.assertEqual(summary['matched'], 1)
+
+        conn = rescan.connect(self.database)
+        report = rescan.format_report(conn, 'rules', summary)
+        self.assertIn('1 findings', report)
+        self.assertIn('r\xc3\xa9sum\xc3\xa9.exe', report)
+        self.assertIn('tests:dirty', report)
+
+    def test_same_rules_skip(self):
+        self.rescan()
+        summary = self.rescan()
+
+        self.assertEqual(summary['scanned'], 0)
+
+        # Other rules scan everything again, and so does force
+        self.assertEqual(self.rescan('other')['scanned'], 2)
+        self.assertEqual(self.rescan(force=True)['scanned'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
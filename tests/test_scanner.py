@@ -0,0 +1,179 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import logging
+import unittest
+import threading
+import multiprocessing
+
+# Bulk Imports
+from bulk.message import Attachment
+from bulk.scanner import Pending, ScanEngine, _Waker, gather
+
+
+class PendingTest(unittest.TestCase):
+
+    def setUp(self):
+        # The failures below are logged on purpose
+        logging.getLogger('bulk').disabled = True
+
+    def tearDown(self):
+        logging.getLogger('bulk').disabled = False
+
+    def test_callbacks(self):
+        seen = []
+        pending = Pending()
+        pending.add_callback(seen.append)
+        self.assertFalse(pending.done)
+        pending.fire(1)
+        pending.add_callback(seen.append)
+        self.assertTrue(pending.done)
+        self.assertEqual(seen, [1, 1])
+
+    def test_then(self):
+        pending = Pending()
+        chained = pending.then(lambda result: result + 1)
+        pending.fire(1)
+        self.assertTrue(chained.done)
+        self.assertEqual(chained.result, 2)
+
+    def test_then_pending(self):
+        # A pending result returned by the function is waited on
+        pending = Pending()
+        inner = Pending()
+        chained = pending.then(lambda result: inner)
+        pending.fire(1)
+        self.assertFalse(chained.done)
+        inner.fire(2)
+        self.assertEqual(chained.result, 2)
+
+    def test_then_raises(self):
+        pending = Pending()
+        chained = pending.then(lambda result: 1 / result)
+        pending.fire(0)
+        self.assertTrue(chained.done)
+        self.assertTrue(chained.result.startswith('451 '))
+
+    def test_gather(self):
+        pendings = [Pending(), Pending()]
+        gathered = gather(pendings)
+        pendings[1].fire('b')
+        self.assertFalse(gathered.done)
+        pendings[0].fire('a')
+        self.assertEqual(gathered.result, ['a', 'b'])
+
+        self.assertEqual(gather([]).result, [])
+
+
+class WakerTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.getLogger('bulk').disabled = True
+        self.waker = _Waker()
+
+    def tearDown(self):
+        logging.getLogger('bulk').disabled = False
+        self.waker.close()
+
+    def test_raising_callback(self):
+        seen = []
+        self.waker.call(lambda: 1 / 0)
+        self.waker.call(seen.append, 1)
+        self.waker.handle_read()
+        self.assertEqual(seen, [1])
+
+        # The waker is still there for the next verdict
+        self.waker.call(seen.append, 2)
+        self.waker.handle_read()
+        self.assertEqual(seen, [1, 2])
+        self.assertTrue(self.waker.readable())
+
+
+class ScanEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.getLogger('bulk').disabled = True
+        self.engine = ScanEngine([('tests.processor', {})], 1,
+                                 call_soon_threadsafe=self.call,
+                                 timeout=0.1)
+
+    def tearDown(self):
+        logging.getLogger('bulk').disabled = False
+        self.engine.close()
+
+    def call(self, func, *args):
+        # Verdicts are handed over straight from the feeding thread
+        func(*args)
+
+    def scan(self, *contents):
+        """
+        Returns the verdicts for attachments holding contents, once in.
+        """
+        event = threading.Event()
+        pending = self.engine.submit([Attachment(str(i), content)
+                                      for i, content in enumerate(contents)])
+        pending.add_callback(lambda verdicts: event.set())
+        self.assertTrue(event.wait(10))
+        return pending.result
+
+    def workers(self):
+        return [process.pid for process in multiprocessing.active_children()
+                if process.name == 'bulk-scanner']
+
+    def test_scan(self):
+        verdicts = self.scan('dirty', 'clean')
+        self.assertTrue(verdicts[0][0])
+        self.assertFalse(verdicts[1][0])
+        self.assertEqual(self.engine.pending, 0)
+
+    def test_timeout(self):
+        before = self.workers()
+        verdicts = self.scan('hang')
+        self.assertTrue(verdicts[0][0].failed)
+        self.assertIn('timed out', verdicts[0][0].error)
+        # The worker was killed and replaced, and scans again
+        self.assertTrue(self.scan('dirty')[0][0])
+        after = self.workers()
+        self.assertEqual(len(after), 1)
+        self.assertNotEqual(after, before)
+
+    def test_crash(self):
+        before = self.workers()
+        verdicts = self.scan('crash', 'dirty')
+        self.assertEqual([verdict[0].failed for verdict in verdicts],
+                         [True, True])
+        self.assertIn('crashed', verdicts[0][0].error)
+        self.assertTrue(self.scan('dirty')[0][0])
+        self.assertNotEqual(self.workers(), before)
+
+    def test_deadline(self):
+        self.assertEqual(self.engine._deadline(1), 0.2)
+        self.assertEqual(self.engine._deadline(0), 0.2)
+        # However many attachments, a scan is cut off in the end
+        self.assertEqual(self.engine._deadline(1000),
+                         0.1 * ScanEngine.KILL_CAP)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,214 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import unittest
+
+# Bulk Imports
+from bulk import session
+from bulk.scanner import Pending
+from bulk.stream import MessageStream
+from bulk.session import SMTPSession
+
+
+class Server(object):
+    """
+    Stands in for a BulkProxy, keeping every message it is handed.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.status = None
+
+    def begin_message(self, peer, mailfrom, rcpttos):
+        return MessageStream()
+
+    def process_message(self, peer, mailfrom, rcpttos, data, stream=None):
+        self.messages.append((mailfrom, rcpttos, data))
+        if isinstance(self.status, Exception):
+            raise self.status
+
+        return self.status
+
+
+ENVELOPE = 'MAIL FROM:<a@b>\r\nRCPT TO:<c@d>\r\n'
+
+
+class SMTPSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        session._fqdn[:] = ['bulk.test']
+        self.server = Server()
+        self.writes = []
+        self.closed = []
+        self.paused = []
+        self.session = self.make_session()
+
+    def make_session(self, **kwargs):
+        smtp = SMTPSession(self.server, ('127.0.0.1', 2525),
+                           self.writes.append,
+                           lambda: self.closed.append(True),
+                           lambda: self.paused.append(True),
+                           lambda: self.paused.append(False), **kwargs)
+        smtp.start()
+        del self.writes[:]
+        return smtp
+
+    def replies(self):
+        """
+        Returns the reply codes sent since last asked.
+        """
+        codes = [line[:3] for line in ''.join(self.writes).split('\r\n')
+                 if line]
+        del self.writes[:]
+        return codes
+
+    def test_ehlo(self):
+        self.session.feed('EHLO client\r\n')
+        lines = ''.join(self.writes).split('\r\n')
+        self.assertIn('250-PIPELINING', lines)
+        self.assertIn('250 CHUNKING', lines)
+
+    def test_data(self):
+        self.session.feed('HELO client\r\n' + ENVELOPE + 'DATA\r\n')
+        self.assertEqual(self.replies(), ['250', '250', '250', '354'])
+
+        self.session.feed('Subject: test\r\n\r\n..dotted\r\nbody\r\n.')
+        self.assertEqual(self.server.messages, [])
+        self.session.feed('\r\n')
+        self.assertEqual(self.replies(), ['250'])
+        self.assertEqual(self.server.messages,
+                         [('a@b', ['c@d'],
+                           'Subject: test\n\n.dotted\nbody')])
+
+    def test_empty_data(self):
+        self.session.feed('HELO client\r\n' + ENVELOPE + 'DATA\r\n.\r\n')
+        self.assertEqual(self.replies(), ['250', '250', '250', '354', '250'])
+        self.assertEqual(self.server.messages, [('a@b', ['c@d'], '')])
+
+    def test_pipelining(self):
+        # Every reply to a pipelined group goes out in one write
+        self.session.feed('EHLO client\r\n')
+        del self.writes[:]
+        self.session.feed(ENVELOPE + 'RCPT TO:<e@f>\r\nDATA\r\n')
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(self.replies(), ['250', '250', '250', '354'])
+
+    def test_pending(self):
+        self.server.status = Pending()
+        self.session.feed('HELO client\r\n' + ENVELOPE + 'DATA\r\n'
+                          'Subject: one\r\n\r\n.\r\n' + ENVELOPE)
+        # The second envelope waits on the first message's verdict
+        self.assertTrue(self.session.waiting)
+        self.assertEqual(self.paused, [True])
+        self.assertEqual(self.replies(), ['250', '250', '250', '354'])
+
+        self.server.status.fire('554 blocked')
+        self.assertFalse(self.session.waiting)
+        self.assertEqual(self.paused, [True, False])
+        self.assertEqual(self.replies(), ['554', '250', '250'])
+
+    def test_process_raises(self):
+        self.server.status = ValueError('broken')
+        self.session.feed('HELO client\r\n' + ENVELOPE + 'DATA\r\n.\r\n'
+                          'NOOP\r\n')
+        self.assertEqual(self.replies(), ['250', '250', '250', '354', '451',
+                                          '250'])
+
+    def test_pipelined_raises(self):
+        # The next message fails as the first one's verdict comes in
+        pending = self.server.status = Pending()
+        self.session.feed('HELO client\r\n' + ENVELOPE + 'DATA\r\n.\r\n' +
+                          ENVELOPE + 'DATA\r\n.\r\nNOOP\r\n')
+        self.server.status = ValueError('broken')
+        pending.fire(None)
+        self.assertEqual(self.replies(), ['250', '250', '250', '354', '250',
+                                          '250', '250', '354', '451', '250'])
+        self.assertFalse(self.session.closed)
+
+    def test_bdat(self):
+        self.session.feed('EHLO client\r\n' + ENVELOPE)
+        del self.writes[:]
+        chunk = 'Subject: test\r\n\r\n.dot'
+        self.session.feed('BDAT %s\r\n%s' % (len(chunk), chunk))
+        self.assertEqual(self.replies(), ['250'])
+
+        last = '\r\nbody\r\n'
+        self.session.feed('BDAT %s LAST\r\n%s' % (len(last), last))
+        self.assertEqual(self.replies(), ['250'])
+        # Not dot-stuffed, and the final line ending is not kept
+        self.assertEqual(self.server.messages,
+                         [('a@b', ['c@d'], 'Subject: test\n\n.dot\nbody')])
+
+    def test_bdat_pipelined(self):
+        self.session.feed('EHLO client\r\n')
+        del self.writes[:]
+        self.session.feed(ENVELOPE + 'BDAT 4\r\nab\r\nBDAT 0 LAST\r\n'
+                          'QUIT\r\n')
+        self.assertEqual(self.replies(), ['250', '250', '250', '250', '221'])
+        self.assertEqual(self.server.messages, [('a@b', ['c@d'], 'ab')])
+        self.assertEqual(self.closed, [True])
+
+    def test_bdat_syntax(self):
+        self.session.feed('EHLO client\r\n' + ENVELOPE)
+        del self.writes[:]
+        self.session.feed('BDAT\r\nBDAT 1 FIRST\r\n')
+        self.assertEqual(self.replies(), ['501', '501'])
+
+    def test_bdat_without_rcpt(self):
+        # The chunk is read and thrown away
+        self.session.feed('EHLO client\r\nBDAT 4 LAST\r\nNOOPNOOP\r\n')
+        self.assertEqual(self.replies()[-2:], ['503', '250'])
+        self.assertEqual(self.server.messages, [])
+
+    def test_size(self):
+        smtp = self.make_session(max_size=10)
+        smtp.feed('EHLO client\r\nMAIL FROM:<a@b> SIZE=11\r\n')
+        self.assertEqual(self.replies()[-1], '552')
+
+        smtp.feed(ENVELOPE + 'DATA\r\n' + 'x' * 20 + '\r\n.\r\n')
+        self.assertEqual(self.replies(), ['250', '250', '354', '552'])
+        self.assertEqual(self.server.messages, [])
+
+    def test_mail_params(self):
+        self.session.feed('EHLO client\r\n')
+        del self.writes[:]
+        self.session.feed('MAIL FROM:<a@b> BODY=8BITMIME SIZE=10\r\nRSET\r\n'
+                          'MAIL FROM:<a@b> BODY=BINARYMIME\r\n'
+                          'MAIL FROM:<a@b> SIZE=ten\r\n'
+                          'MAIL FROM:<a@b> AUTH=<>\r\n')
+        self.assertEqual(self.replies(), ['250', '250', '501', '501', '555'])
+
+    def test_params_need_ehlo(self):
+        self.session.feed('HELO client\r\nMAIL FROM:<a@b> SIZE=10\r\n')
+        self.assertEqual(self.replies(), ['250', '501'])
+
+    def test_nested_mail(self):
+        self.session.feed('HELO client\r\n' + ENVELOPE +
+                          'MAIL FROM:<e@f>\r\nRSET\r\nMAIL FROM:<e@f>\r\n')
+        self.assertEqual(self.replies(), ['250', '250', '250', '503', '250',
+                                          '250'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import logging
+import tempfile
+import unittest
+
+# Bulk Imports
+from bulk.spool import Spool
+
+
+class Upstream(object):
+    """
+    An upstream.UpstreamPool stand-in that records what it sends.
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, mailfrom, rcpttos, data):
+        self.sent.append((mailfrom, rcpttos, data))
+        return {}
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.upstream = Upstream()
+        self.spool = Spool(self.directory, self.upstream)
+        # The failures below are logged on purpose
+        logging.getLogger('bulk').disabled = True
+
+    def tearDown(self):
+        logging.getLogger('bulk').disabled = False
+        shutil.rmtree(self.directory)
+
+    def listdir(self, name):
+        return os.listdir(os.path.join(self.directory, name))
+
+    def test_deliver(self):
+        self.spool.enqueue('a@b', ['c@d'], 'data')
+        self.spool._attempt(self.spool._next())
+        self.assertEqual(self.upstream.sent, [('a@b', ['c@d'], 'data')])
+        self.assertEqual(self.listdir('queue'), [])
+        self.assertEqual(self.spool.stats(), (0, 0.0))
+
+    def test_unreadable(self):
+        self.spool.enqueue('a@b', ['c@d'], 'data')
+        envelope_id = self.listdir('queue')[0]
+        with open(os.path.join(self.directory, 'queue', envelope_id),
+                  'wb') as f:
+            f.write('not a pickle')
+
+        self.spool._attempt(self.spool._next())
+        self.assertEqual(self.upstream.sent, [])
+        self.assertEqual(self.listdir('failed'), [envelope_id])
+        self.assertEqual(self.spool.stats(), (0, 0.0))
+
+    def test_cannot_fail(self):
+        self.spool.enqueue('a@b', ['c@d'], 'data')
+        envelope_id = self.spool._next()
+        os.rmdir(os.path.join(self.directory, 'failed'))
+
+        # Left in the queue for the next run, but no longer tracked
+        self.spool._fail(envelope_id)
+        self.assertEqual(self.listdir('queue'), [envelope_id])
+        self.assertEqual(self.spool.stats(), (0, 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
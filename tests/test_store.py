@@ -0,0 +1,115 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+# Bulk Imports
+from bulk.message import Attachment
+from bulk.store import AttachmentStore
+from bulk.writer import StorageWriter
+
+
+class AttachmentStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = AttachmentStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_path(self):
+        sha256 = hashlib.sha256('a').hexdigest()
+        self.assertEqual(self.store.path(sha256),
+                         os.path.join(self.directory, sha256[:2],
+                                      sha256[2:4], sha256))
+
+        store = AttachmentStore(self.directory, levels=1, width=3)
+        self.assertEqual(store.path(sha256),
+                         os.path.join(self.directory, sha256[:3], sha256))
+
+    def test_add(self):
+        attachment = Attachment('a.exe', 'content')
+        path = self.store.add(attachment, {'email': 'm1'})
+        self.assertEqual(path, self.store.path(attachment.sha256))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), 'content')
+
+        [sighting] = list(self.store.sightings(attachment.sha256))
+        self.assertEqual(sighting['email'], 'm1')
+        self.assertEqual(sighting['name'], 'a.exe')
+        self.assertEqual(sighting['size'], 7)
+        self.assertEqual(sighting['attachment'], path)
+
+    def test_once(self):
+        first = Attachment('a.exe', 'content')
+        path = self.store.add(first, {'email': 'm1'})
+        mtime = os.stat(path).st_mtime
+
+        # The same content under another name is stored once,
+        # but seen twice
+        second = Attachment('b.exe', 'content')
+        self.assertEqual(self.store.add(second, {'email': 'm2'}), path)
+        self.assertEqual(os.stat(path).st_mtime, mtime)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         [first.sha256, first.sha256 + '.sightings'])
+        self.assertEqual([(s['name'], s['email'])
+                          for s in self.store.sightings(first.sha256)],
+                         [('a.exe', 'm1'), ('b.exe', 'm2')])
+
+    def test_path_attachment(self):
+        fd, source = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write('content' * 100)
+
+        attachment = Attachment('a', path=source, keep=True)
+        path = self.store.add(attachment, {})
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), 'content' * 100)
+
+    def test_unseen(self):
+        self.assertEqual(list(self.store.sightings('0' * 64)), [])
+
+    def test_writer(self):
+        writer = StorageWriter()
+        store = AttachmentStore(self.directory, writer)
+        attachment = Attachment('a', 'content')
+        store.add(attachment, {'email': 'm1'})
+        store.add(attachment, {'email': 'm2'})
+        writer.close()
+
+        with open(store.path(attachment.sha256), 'rb') as f:
+            self.assertEqual(f.read(), 'content')
+
+        self.assertEqual([s['email']
+                          for s in store.sightings(attachment.sha256)],
+                         ['m1', 'm2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import unittest
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from email.mime.application import MIMEApplication
+
+# Bulk Imports
+from bulk.stream import MessageStream
+
+
+def build_data(attachments, body='Hello\n.dotted line\n'):
+    """
+    Build raw DATA, dot-stuffed as received over SMTP, for a message
+    carrying (filename, content) attachments.
+    """
+    mime = MIMEMultipart()
+    mime['Subject'] = 'test'
+    mime.attach(MIMEText(body))
+    for filename, content in attachments:
+        part = MIMEApplication(content)
+        part.add_header('Content-Disposition', 'attachment',
+                        filename=filename)
+        mime.attach(part)
+
+    lines = mime.as_string().split('\n')
+    return '\r\n'.join('.' + line if line.startswith('.') else line
+                       for line in lines)
+
+
+class MessageStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.found = []
+
+    def on_attachment(self, attachment):
+        self.found.append(attachment)
+        return attachment.name
+
+    def test_attachments(self):
+        stream = MessageStream(self.on_attachment)
+        stream.feed(build_data([('a.txt', 'first'), ('b.bin', 'second')]))
+        # Both parts have closed before the end of the data
+        self.assertEqual([attachment.name for attachment in self.found],
+                         ['a.txt', 'b.bin'])
+        self.assertEqual(self.found[1].content, 'second')
+
+        data = stream.close()
+        self.assertEqual(stream.results, ['a.txt', 'b.bin'])
+        self.assertEqual(stream.attachments, self.found)
+        self.assertEqual(stream.parsed_message['Subject'], 'test')
+        self.assertIn('\n.dotted line\n', data)
+        self.assertNotIn('\r\n', data)
+
+    def test_chunks(self):
+        # Lines and dots split across reads come out whole
+        data = build_data([('a.txt', 'content')])
+        whole = MessageStream()
+        whole.feed(data)
+
+        stream = MessageStream(self.on_attachment)
+        for i in xrange(0, len(data), 7):
+            stream.feed(data[i:i + 7])
+
+        self.assertEqual(stream.close(), whole.close())
+        self.assertEqual(self.found[0].content, 'content')
+
+    def test_split_crlf(self):
+        # A CRLF split between reads ends one line, not two
+        stream = MessageStream()
+        for piece in ['Subject: test\r', '\n\r', '\n', 'body\r',
+                      '\nlast']:
+            stream.feed(piece)
+
+        self.assertEqual(stream.close(), 'Subject: test\n\nbody\nlast')
+
+    def test_long_line(self):
+        # A line arriving a byte at a time, CRLF included
+        stream = MessageStream()
+        for c in 'Subject: test\r\n\r\n' + 'x' * 1000 + '\r\nlast':
+            stream.feed(c)
+
+        self.assertEqual(stream.close(),
+                         'Subject: test\n\n' + 'x' * 1000 + '\nlast')
+
+    def test_cr_pieces(self):
+        # A CR ending a read and not followed by LF stays in the line
+        stream = MessageStream()
+        for piece in ['Subject: test\r\n\r\none\r', 'two\r', '\r',
+                      '\nthree']:
+            stream.feed(piece)
+
+        self.assertEqual(stream.close(),
+                         'Subject: test\n\none\rtwo\r\nthree')
+
+    def test_bare_cr(self):
+        # Lines end with CRLF only, a lone CR is part of the line
+        stream = MessageStream()
+        stream.feed('Subject: test\r\n\r\none\rtwo\r\n')
+        self.assertEqual(stream.close(), 'Subject: test\n\none\rtwo\n')
+
+    def test_not_stuffed(self):
+        stream = MessageStream()
+        stream.stuffed = False
+        stream.feed('Subject: test\r\n\r\n..two dots\r\n')
+        self.assertEqual(stream.close(), 'Subject: test\n\n..two dots\n')
+
+    def test_memory_limit(self):
+        stream = MessageStream(self.on_attachment, memory_limit=100)
+        stream.feed(build_data([('small', 'x'), ('large', 'y' * 1000)]))
+        stream.close()
+        small, large = self.found
+        self.assertEqual(small.path, None)
+
+        path = large.path
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), 'y' * 1000)
+
+        del self.found[:], stream, large
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
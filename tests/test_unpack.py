@@ -0,0 +1,274 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import bz2
+import gzip
+import shutil
+import tarfile
+import tempfile
+import zipfile
+import unittest
+from StringIO import StringIO
+
+# Bulk Imports
+from bulk.proxy import BulkProxy
+from bulk.message import Attachment
+from bulk.unpack import Unpacker, archive_type
+from tests.processor import Processor
+from tests.test_pipeline import build_data
+
+
+def build_zip(members, compression=zipfile.ZIP_DEFLATED):
+    """
+    Build a zip archive of (name, content) members.
+    """
+    f = StringIO()
+    archive = zipfile.ZipFile(f, 'w', compression)
+    for name, content in members:
+        archive.writestr(name, content)
+
+    archive.close()
+    return f.getvalue()
+
+
+def build_tar(members):
+    """
+    Build a tar archive of (name, content) members.
+    """
+    f = StringIO()
+    archive = tarfile.open(fileobj=f, mode='w')
+    for name, content in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(content)
+        archive.addfile(info, StringIO(content))
+
+    archive.close()
+    return f.getvalue()
+
+
+def build_gzip(content):
+    """
+    Compress content into a gzip stream.
+    """
+    f = StringIO()
+    stream = gzip.GzipFile(fileobj=f, mode='wb')
+    stream.write(content)
+    stream.close()
+    return f.getvalue()
+
+
+class UnpackTest(unittest.TestCase):
+
+    def names(self, members):
+        return [member.name for member in members]
+
+    def test_archive_type(self):
+        self.assertEqual(archive_type(build_zip([('a', 'b')])), 'zip')
+        self.assertEqual(archive_type(build_tar([('a', 'b')])), 'tar')
+        self.assertEqual(archive_type(build_gzip('a')), 'gzip')
+        self.assertEqual(archive_type(bz2.compress('a')), 'bz2')
+        self.assertEqual(archive_type('plain text'), None)
+
+    def test_plain(self):
+        members, problems = Unpacker().expand(Attachment('a.txt', 'text'))
+        self.assertEqual(members, [])
+        self.assertEqual(problems, [])
+
+    def test_nested(self):
+        inner = build_tar([('payload.exe', 'MZ'), ('readme', 'hello')])
+        outer = build_zip([('inner.tar', inner)])
+        members, problems = Unpacker().expand(Attachment('outer.zip',
+                                                         outer))
+        self.assertEqual(problems, [])
+        self.assertEqual(self.names(members),
+                         ['outer.zip/inner.tar',
+                          'outer.zip/inner.tar/payload.exe',
+                          'outer.zip/inner.tar/readme'])
+        self.assertEqual(members[1].content, 'MZ')
+
+    def test_streams(self):
+        members, problems = Unpacker().expand(
+            Attachment('a.txt.gz', build_gzip('gzipped')))
+        self.assertEqual(self.names(members), ['a.txt.gz/a.txt'])
+        self.assertEqual(members[0].content, 'gzipped')
+
+        members, problems = Unpacker().expand(
+            Attachment('b.bz2', bz2.compress('bzipped')))
+        self.assertEqual(self.names(members), ['b.bz2/b'])
+        self.assertEqual(members[0].content, 'bzipped')
+
+    def assertIncomplete(self, problems, text):
+        self.assertEqual(len(problems), 1)
+        self.assertTrue(problems[0].incomplete)
+        # Not a scan failure, that is for scans that did not finish
+        self.assertFalse(problems[0].failed)
+        self.assertFalse(problems[0])
+        self.assertIn(text, problems[0].error)
+
+    def test_depth(self):
+        inner = build_zip([('c', 'd')])
+        outer = build_zip([('inner.zip', inner)])
+        members, problems = Unpacker(max_depth=1).expand(
+            Attachment('outer.zip', outer))
+        self.assertEqual(self.names(members), ['outer.zip/inner.zip'])
+        self.assertIncomplete(problems, 'nested deeper than 1')
+
+    def test_members(self):
+        content = build_zip([(str(i), 'x') for i in xrange(5)])
+        members, problems = Unpacker(max_members=3).expand(
+            Attachment('a.zip', content))
+        self.assertEqual(len(members), 3)
+        self.assertIncomplete(problems, 'more than 3 members')
+
+    def test_size(self):
+        content = build_zip([('a', 'x' * 100), ('b', 'x' * 100)])
+        members, problems = Unpacker(max_size=150).expand(
+            Attachment('a.zip', content))
+        self.assertEqual(self.names(members), ['a.zip/a'])
+        self.assertIncomplete(problems, 'more than 150 bytes')
+
+    def test_ratio(self):
+        content = build_zip([('bomb', '\0' * (4 * Unpacker.RATIO_FLOOR))])
+        members, problems = Unpacker(max_ratio=10).expand(
+            Attachment('a.zip', content))
+        self.assertEqual(members, [])
+        self.assertIncomplete(problems, 'compressed more than 10 to 1')
+
+    def test_encrypted(self):
+        content = build_zip([('secret', 'x'), ('open', 'y')],
+                            zipfile.ZIP_STORED)
+        # Flag the first member as encrypted in its local and central
+        # directory headers
+        content = content.replace('PK\x03\x04\x14\x00\x00\x00',
+                                  'PK\x03\x04\x14\x00\x01\x00', 1)
+        content = content.replace('PK\x01\x02\x14\x03\x14\x00\x00\x00',
+                                  'PK\x01\x02\x14\x03\x14\x00\x01\x00', 1)
+        members, problems = Unpacker().expand(Attachment('a.zip', content))
+        self.assertEqual(self.names(members), ['a.zip/open'])
+        self.assertIncomplete(problems, 'a.zip/secret: encrypted')
+
+    def test_broken(self):
+        content = build_zip([('a', 'x' * 1000)])[:100]
+        members, problems = Unpacker().expand(Attachment('a.zip', content))
+        self.assertEqual(members, [])
+        self.assertIncomplete(problems, 'cannot unpack zip')
+
+    def test_spill(self):
+        content = build_zip([('small', 'x' * 10), ('large', 'y' * 5000)])
+        members, problems = Unpacker(memory_limit=1000).expand(
+            Attachment('a.zip', content))
+        self.assertEqual(problems, [])
+        small, large = members
+        self.assertEqual(small.path, None)
+        self.assertEqual(small.content, 'x' * 10)
+
+        path = large.path
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(large.size, 5000)
+        f = large.open()
+        try:
+            self.assertEqual(f.read(), 'y' * 5000)
+
+        finally:
+            f.close()
+
+        del members, large
+        self.assertFalse(os.path.exists(path))
+
+    def test_tar_closed(self):
+        opened = []
+        extractfile = tarfile.TarFile.extractfile
+
+        def record(archive, member):
+            f = extractfile(archive, member)
+            opened.append(f)
+            return f
+
+        tarfile.TarFile.extractfile = record
+        try:
+            members, problems = Unpacker().expand(
+                Attachment('a.tar', build_tar([('a', 'x'), ('b', 'y')])))
+
+        finally:
+            tarfile.TarFile.extractfile = extractfile
+
+        self.assertEqual(self.names(members), ['a.tar/a', 'a.tar/b'])
+        self.assertEqual(len(opened), 2)
+        self.assertTrue(all(f.closed for f in opened))
+
+
+class ProxyUnpackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, 'quarantine'))
+        self.processor = Processor()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def process(self, content, **kwargs):
+        """
+        Run a message with a zip attachment holding content through a
+        proxy that cannot unpack it, as it is too deeply nested.
+
+        Returns the reply and the number of messages quarantined.
+        """
+        proxy = BulkProxy(('127.0.0.1', 0), ('127.0.0.1', 0),
+                          [self.processor], listen=False, block=True,
+                          always_block=True,
+                          base_directory=self.directory + '/',
+                          unpacker=Unpacker(max_depth=0), **kwargs)
+        data = build_data([('a.zip', build_zip([('a', content)],
+                                               zipfile.ZIP_STORED))])
+        status = proxy.process_message(('127.0.0.1', 0), 'a@b', ['c@d'],
+                                       data)
+        return status, len(os.listdir(os.path.join(self.directory,
+                                                   'quarantine')))
+
+    def test_pass(self):
+        self.assertEqual(self.process('clean'), (None, 0))
+        # The archive itself is still scanned
+        self.assertEqual(self.processor.calls, 1)
+
+    def test_quarantine(self):
+        self.assertEqual(self.process('clean',
+                                      unpack_failure_verdict='quarantine'),
+                         (None, 1))
+
+    def test_tempfail(self):
+        status, quarantined = self.process('clean',
+                                           unpack_failure_verdict='tempfail',
+                                           scan_failure_verdict='pass')
+        self.assertTrue(status.startswith('451'))
+        self.assertIn('not fully unpacked', status)
+
+    def test_matched(self):
+        # Unpacking failing does not stop the archive matching
+        self.assertEqual(self.process('dirty'), (None, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
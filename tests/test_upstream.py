@@ -0,0 +1,152 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import time
+import socket
+import smtplib
+import unittest
+
+# Bulk Imports
+from bulk.upstream import UpstreamPool
+
+
+class FakeSMTP(object):
+    """
+    Stands in for smtplib.SMTP, doing whatever the test lines up.
+    """
+
+    # Exceptions to raise from the next connects and sendmails
+    connect_errors = []
+    send_errors = []
+    opened = []
+
+    def __init__(self, host, port, local_hostname=None, timeout=None):
+        if FakeSMTP.connect_errors:
+            raise FakeSMTP.connect_errors.pop(0)
+
+        self.closed = False
+        FakeSMTP.opened.append(self)
+
+    def sendmail(self, mailfrom, rcpttos, data):
+        if FakeSMTP.send_errors:
+            raise FakeSMTP.send_errors.pop(0)
+
+        return {}
+
+    def rset(self):
+        pass
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class UpstreamPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.smtp = smtplib.SMTP
+        smtplib.SMTP = FakeSMTP
+        FakeSMTP.connect_errors = []
+        FakeSMTP.send_errors = []
+        FakeSMTP.opened = []
+
+    def tearDown(self):
+        smtplib.SMTP = self.smtp
+
+    def pool(self, **kwargs):
+        pool = UpstreamPool(('127.0.0.1', 25), **kwargs)
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_reuses_connections(self):
+        pool = self.pool(max_connections=2)
+        for i in range(5):
+            self.assertEqual(pool.send('a@b', ['c@d'], 'data'), {})
+
+        self.assertEqual(len(FakeSMTP.opened), 1)
+        self.assertEqual(pool._open, 1)
+
+    def test_retires_after_max_messages(self):
+        pool = self.pool(max_messages=2)
+        for i in range(4):
+            pool.send('a@b', ['c@d'], 'data')
+
+        self.assertEqual(len(FakeSMTP.opened), 2)
+        self.assertTrue(FakeSMTP.opened[0].closed)
+        self.assertEqual(pool._open, 0)
+
+    def test_failed_reconnect_counted_once(self):
+        pool = self.pool(max_connections=1)
+        pool.send('a@b', ['c@d'], 'data')
+
+        FakeSMTP.send_errors = [smtplib.SMTPServerDisconnected('gone')]
+        FakeSMTP.connect_errors = [socket.error('refused')]
+        self.assertRaises(socket.error, pool.send, 'a@b', ['c@d'], 'data')
+        self.assertEqual(pool._open, 0)
+
+        # The one connection allowed is still there to be had
+        self.assertEqual(pool.send('a@b', ['c@d'], 'data'), {})
+        self.assertEqual(pool._open, 1)
+
+    def test_reconnects_after_disconnect(self):
+        pool = self.pool()
+        pool.send('a@b', ['c@d'], 'data')
+
+        FakeSMTP.send_errors = [smtplib.SMTPServerDisconnected('gone')]
+        self.assertEqual(pool.send('a@b', ['c@d'], 'data'), {})
+        self.assertEqual(pool._open, 1)
+
+    def test_refused_recipients_keep_connection(self):
+        pool = self.pool()
+        FakeSMTP.send_errors = [smtplib.SMTPRecipientsRefused({'c@d': (550,
+                                                                      'no')})]
+        self.assertEqual(pool.deliver('a@b', ['c@d'], 'data'),
+                         {'c@d': (550, 'no')})
+        self.assertEqual(pool._open, 1)
+        self.assertFalse(FakeSMTP.opened[0].closed)
+
+    def test_deliver_reports_failure_as_refused(self):
+        pool = self.pool()
+        FakeSMTP.connect_errors = [socket.error('refused')]
+        refused = pool.deliver('a@b', ['c@d', 'e@f'], 'data')
+
+        self.assertEqual(sorted(refused), ['c@d', 'e@f'])
+        self.assertEqual(pool._open, 0)
+
+    def test_reaps_idle_connections(self):
+        pool = self.pool(idle_timeout=0.1)
+        pool.send('a@b', ['c@d'], 'data')
+
+        deadline = time.time() + 5
+        while pool._open and time.time() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(pool._open, 0)
+        self.assertTrue(FakeSMTP.opened[0].closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# Copyright (c) 2014 The MITRE Corporation. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR AND CONTRIBUTORS ``AS IS'' AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF
+# SUCH DAMAGE.
+
+# Standard Imports
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+
+# Bulk Imports
+from bulk.writer import StorageWriter
+
+
+class Broken(object):
+    """
+    A copy_once source that cannot be opened.
+    """
+
+    def open(self):
+        raise ValueError('broken')
+
+
+class StorageWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # The failures below are logged on purpose
+        logging.getLogger('bulk').disabled = True
+
+    def tearDown(self):
+        logging.getLogger('bulk').disabled = False
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        with open(self.path(name), 'rb') as f:
+            return f.read()
+
+    def test_writes(self):
+        writer = StorageWriter()
+        writer.write(self.path('a'), 'a')
+        writer.write_once(self.path('b'), 'b')
+        writer.close()
+        self.assertEqual(self.read('a'), 'a')
+        self.assertEqual(self.read('b'), 'b')
+        self.assertEqual(writer.writes, 2)
+
+    def test_failed_batch(self):
+        writer = StorageWriter(batch_size=1)
+        writer.copy_once(self.path('a'), Broken())
+        writer.write(self.path('b'), 'b')
+        writer.close()
+        self.assertEqual(writer.lost, 1)
+        self.assertEqual(self.read('b'), 'b')
+
+    def test_dead_thread(self):
+        writer = StorageWriter(max_queue=1)
+        writer.close()
+        writer.write(self.path('a'), 'a')
+        self.assertEqual(self.read('a'), 'a')
+
+        # Whatever was left in the queue is written too
+        writer._queue.put((('write', self.path('b'), 'b')))
+        writer.write(self.path('c'), 'c')
+        self.assertEqual(self.read('b'), 'b')
+        self.assertEqual(self.read('c'), 'c')
+        writer.close()
+
+    def test_dies_while_full(self):
+        writer = StorageWriter(max_queue=1)
+        writer.close()
+        writer.PUT_TIMEOUT = 0.01
+        writer._queue.put(('write', self.path('a'), 'a'))
+
+        # Looks alive until the caller has to wait
+        thread = threading.Thread(target=lambda: None)
+        writer._thread = thread
+        thread.is_alive = iter([True, False]).next
+        writer.write(self.path('b'), 'b')
+        self.assertEqual(self.read('a'), 'a')
+        self.assertEqual(self.read('b'), 'b')
+        self.assertEqual(writer.stalls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()